@@ -3,31 +3,50 @@
 
 import messages_pb2
 import zmq
-import random
-import string
 import os
 import sys
+import shutil
+import time
+import threading
+import argparse
+import zlib
+from disk_io import GROUP_COMMIT_DELAY, DiskWorkers, Completion, GroupCommit
+from object_store import STORE_KINDS, SEGMENT_SIZE, MAP_CACHE_SIZE, open_store
+from object_cache import CACHE_SIZE, CachedStore
+from scrubber import SCRUB_RATE, Scrubber
+from reclaimer import Reclaimer
+from membership import HEARTBEAT_INTERVAL
 
-# Generate a random file names for chunks
-def random_string(length = 8):
-    return ''.join(random.SystemRandom().choice(string.ascii_letters) for _ in range(length))
+# Allow the user to set a folder name and the storage node id via command line arguments,
+# e.g. python Storage-Node.py node1 1
+parser = argparse.ArgumentParser(description="Storage node")
+parser.add_argument('data_folder', nargs='?', default="./")
+parser.add_argument('node_id', nargs='?', default=None,
+                    help="id of the node in the storage_node table (defaults to the digits in the data folder name)")
+parser.add_argument('--window', type=int, default=8,
+                    help="number of unacknowledged chunks the controller may send to this node")
+parser.add_argument('--io-workers', type=int, default=4,
+                    help="number of threads that write and read chunks")
+parser.add_argument('--stats-interval', type=int, default=30,
+                    help="seconds between reports of the queue and service times of disk operations")
+parser.add_argument('--store', choices=STORE_KINDS, default='files',
+                    help="keep every chunk in a file of its own, or append chunks to large segment files")
+parser.add_argument('--segment-size', type=int, default=SEGMENT_SIZE // (1024 * 1024),
+                    help="size in MB of a segment file when chunks are kept in segments")
+parser.add_argument('--map-cache-size', type=int, default=MAP_CACHE_SIZE // (1024 * 1024),
+                    help="address space in MB of the memory maps chunks are sent from")
+parser.add_argument('--cache-size', type=int, default=CACHE_SIZE // (1024 * 1024),
+                    help="MB of recently stored and read chunks kept in memory, 0 disables the cache")
+parser.add_argument('--scrub-rate', type=int, default=SCRUB_RATE // (1024 * 1024),
+                    help="MB per second of stored chunks re-read in the background to find corrupt ones, 0 disables scrubbing")
+parser.add_argument('--group-commit-delay', type=float, default=GROUP_COMMIT_DELAY * 1000,
+                    help="milliseconds the first of the chunks stored with group commit waits for others to share its fsync")
+args = parser.parse_args()
 
-# Write replicated chunk to file so that it can be retrieved later
-def write_to_file(data, filename=None):
-    if filename is None:
-        filename = random_string(length=8)
-        filename += ".bin"
-    try: 
-        with open('./' + filename, 'wb') as f: 
-            f.write(data)
-    except EnvironmentError as e:
-        print("Error writing file: {}".format(e))
-        return None
-    return filename
-
-
-# Allow the user to set a folder name via command line argument
-data_folder = sys.argv[1] if len(sys.argv) > 1 else "./"
+data_folder = args.data_folder
+node_id = args.node_id or ''.join(c for c in data_folder if c.isdigit())
+if not node_id:
+    sys.exit("A storage node id is required when the data folder name has no digits")
 
 try:
     if data_folder != "./":
@@ -36,14 +55,16 @@ try:
 except FileExistsError as _:
     pass
 
-print(f"Data folder: {data_folder}")
+print(f"Data folder: {data_folder}, storage node id: {node_id}")
 
 # Set up zmq channels
 context = zmq.Context()
 
-# Socket to StoreData messages from controller
-socket_pull = context.socket(zmq.PULL)
-socket_pull.connect("tcp://localhost:5557")
+# Socket to receive StoreData messages from controller. The routing id registers this node
+# on the controller's ROUTER socket, so the controller can send chunks to this node only
+socket_dealer = context.socket(zmq.DEALER)
+socket_dealer.setsockopt(zmq.ROUTING_ID, node_id.encode('utf-8'))
+socket_dealer.connect("tcp://localhost:5557")
 
 # Socket to send results back to controller
 socket_push = context.socket(zmq.PUSH)
@@ -54,54 +75,230 @@ socket_sub = context.socket(zmq.SUB)
 socket_sub.connect("tcp://localhost:5559")
 socket_sub.setsockopt(zmq.SUBSCRIBE, b'')
 
+# Replies of the disk workers are sent on a PUSH socket of each worker thread, since zmq sockets
+# must not be shared between threads. The main thread replies on socket_push
+thread_sockets = threading.local()
+
+def reply_socket():
+    if threading.current_thread() is threading.main_thread():
+        return socket_push
+    if not hasattr(thread_sockets, 'socket_push'):
+        thread_sockets.socket_push = context.socket(zmq.PUSH)
+        thread_sockets.socket_push.connect("tcp://localhost:5558")
+    return thread_sockets.socket_push
+
+disk_workers = DiskWorkers(args.io_workers)
+
+# The store knows which chunks it holds, so requests for chunks we do not have are dropped without touching the disk
+disk_store = open_store(args.store, data_folder, segment_size = args.segment_size * 1024 * 1024,
+                        map_cache_size = args.map_cache_size * 1024 * 1024)
+store = disk_store
+if args.cache_size > 0:
+    store = CachedStore(disk_store, args.cache_size * 1024 * 1024)
+
+# Chunks sent with group commit durability are forced to disk in batches, on a thread of their own
+group_commit = GroupCommit(store.commit, disk_workers.stats, args.group_commit_delay / 1000)
+
+# A chunk that does not match its checksum is deleted, so requests for it are dropped from now on
+# and the controller reads another replica instead
+def drop_corrupt(filename):
+    print(f"Chunk {filename} does not match its checksum, deleting it", file=sys.stderr)
+    store.delete(filename)
+
+# The scrubber reads the store directly, so it does not fill the cache with chunks nobody asked for
+scrubber = None
+if args.scrub_rate > 0:
+    scrubber = Scrubber(disk_store, disk_workers, drop_corrupt, rate = args.scrub_rate * 1024 * 1024)
+    scrubber.start()
+
+# Chunks that no file refers to anymore are deleted in the background, after the reads and writes waiting for the disk
+reclaimer = Reclaimer(store, disk_workers)
+reclaimer.start()
+
 # To listen for multiple sockets, we can use a ZMQ Poller object
 poller = zmq.Poller()
-poller.register(socket_pull, zmq.POLLIN)
+poller.register(socket_dealer, zmq.POLLIN)
 poller.register(socket_sub, zmq.POLLIN)
 
+# Every reply starts with a header carrying the request_id of the controller operation it belongs to.
+# Store acknowledgements also carry our node id and window, which gives the controller its credit back
+def reply_header(request_type, request_id, window = 0):
+    header = messages_pb2.header()
+    header.request_type = request_type
+    header.request_id = request_id
+    if window:
+        header.node_id = node_id
+        header.window = window
+    return header.SerializeToString()
+
+# Advertise our window, so the controller knows how many chunks it may send before we acknowledge them
+socket_push.send(reply_header(messages_pb2.NODE_READY, 0, window = args.window))
+
+# Heartbeats tell the controller that we are up, how much disk space is free and how much disk work waits.
+# A heartbeat is dropped instead of queued when the controller has not been reachable for a while
+def send_heartbeat():
+    heartbeat = messages_pb2.Heartbeat(
+        node_id = node_id,
+        free_bytes = shutil.disk_usage(data_folder).free,
+        queue_depth = disk_workers.queue_depth()
+    )
+    try:
+        socket_push.send_multipart([
+            reply_header(messages_pb2.HEARTBEAT, 0),
+            heartbeat.SerializeToString()
+        ], flags = zmq.NOBLOCK)
+    except zmq.Again:
+        pass
+
+# Hand a chunk request to the disk workers if we hold the chunk
+def request_chunk(data_msg):
+    if data_msg.filename in store:
+        disk_workers.submit(data_msg.filename, 'fetch', send_chunk, data_msg)
+
+# Send the requested chunk as a multipart message back to controller. The chunk is sent from the cache,
+# or from a memory map of the file or segment that holds it, and is not copied into a zmq message.
+# A corrupt chunk is answered with its name only, so the controller asks another replica right away.
+# Runs on a disk worker thread
+def send_chunk(data_msg):
+    print(f"Chunk to retrieve: {data_msg.filename}")
+    data = store.view(data_msg.filename)
+    if data is None:
+        return
+    if not store.verify(data_msg.filename, data):
+        del data
+        drop_corrupt(data_msg.filename)
+        reply_socket().send_multipart([
+            reply_header(messages_pb2.GET_DATA_REQ, data_msg.request_id),
+            data_msg.filename.encode('utf-8')
+        ])
+        return
+    reply_socket().send_multipart([
+        reply_header(messages_pb2.GET_DATA_REQ, data_msg.request_id),
+        data_msg.filename.encode('utf-8'), 
+        data
+    ], copy = False)
+
+# Write a chunk on a disk worker thread, unless it does not match the checksum it was sent with.
+# A chunk counts as stored once it is as durable as its message asks: written (none), forced to disk with
+# an fsync of its own (fsync), or forced to disk together with the chunks written around it (group commit).
+# The names of the chunks that were stored are added to stored
+def store_chunk(data_msg, data, completion, stored):
+    try:
+        print(f"Chunk to store: {data_msg.filename} with size {len(data)} bytes")
+
+        if data_msg.HasField('checksum') and zlib.crc32(data) != data_msg.checksum:
+            print(f"Chunk {data_msg.filename} does not match its checksum, not storing it", file=sys.stderr)
+        elif store.write(data_msg.filename, data) is not None:
+            if data_msg.durability == messages_pb2.DURABILITY_GROUP_COMMIT:
+                group_commit.submit(data_msg.filename, lambda committed, completion = completion:
+                                    chunk_committed(data_msg.filename, committed, completion, stored))
+                completion = None
+                return
+            if data_msg.durability == messages_pb2.DURABILITY_FSYNC:
+                store.commit([data_msg.filename])
+            print(f"Data stored in data folder: /{data_msg.filename}")
+            stored.append(data_msg.filename)
+    finally:
+        if completion is not None:
+            completion.finish()
+
+def chunk_committed(filename, committed, completion, stored):
+    if committed:
+        print(f"Data stored in data folder: /{filename}")
+        stored.append(filename)
+    completion.finish()
+
+# Send back the filenames of the chunks that were written as a single acknowledgement for the whole message,
+# once all chunks are done. The controller fails the upload if a chunk is missing
+def acknowledge(header, stored):
+    reply_socket().send_multipart([
+        reply_header(header.request_type, header.request_id, window = args.window)
+    ] + [filename.encode('utf-8') for filename in stored])
+
+# Reply with the names of the chunks of a DeleteBatch that are gone, on the reclaimer thread
+def acknowledge_delete(request_id, deleted):
+    reply_socket().send_multipart([
+        reply_header(messages_pb2.DELETE_REQ, request_id)
+    ] + [filename.encode('utf-8') for filename in deleted])
+
+last_report = time.time()
+last_heartbeat = 0
 
 while True:
     # poll the sockets to check if we have any incoming messages
-    socks = dict(poller.poll())
+    socks = dict(poller.poll(HEARTBEAT_INTERVAL * 1000))
+
+    if time.time() - last_heartbeat >= HEARTBEAT_INTERVAL:
+        send_heartbeat()
+        last_heartbeat = time.time()
+
+    if time.time() - last_report >= args.stats_interval:
+        for line in disk_workers.stats.report():
+            print(f"Disk I/O {line}")
+        if isinstance(store, CachedStore):
+            print(f"Cache {store.stats()}")
+        if scrubber is not None:
+            print(f"Scrubbed {scrubber.stats()}")
+        print(f"Reclaimed {reclaimer.stats()}")
+        last_report = time.time()
 
     #if(socket_pull in socks and socks[socket_pull] == zmq.POLLIN):
 
-    if socket_pull in socks: 
+    if socket_dealer in socks: 
 
-        # If we have a StoreData message, parse it as multipart message that consists of
-        # filename (file metadata) and and the actual data content to be stored
-        message = socket_pull.recv_multipart()
-        data_msg = messages_pb2.StoreData()
-        data_msg.ParseFromString(message[0])
-        data = message[1]
-        print(f"Chunk to store: {data_msg.filename} with size {len(data)} bytes")
+        # Messages routed to this node start with a header that tells which request follows. 
+        # They are received without copying, and chunk data is written from a view of the zmq frame
+        message = socket_dealer.recv_multipart(copy = False)
+        header = messages_pb2.header()
+        header.ParseFromString(message[0].bytes)
 
-        # Store the data in the specified data folder with random filename
-        write_to_file(data, filename = os.path.join(data_folder, data_msg.filename))
-        print(f"Data stored in data folder: /{data_msg.filename}")
+        if header.request_type == messages_pb2.GET_DATA_REQ:
 
-        # Send back the filename as acknowledgement. 
-        socket_push.send_string(data_msg.filename)
+            # GetData routed to this node only, because the controller knows we hold the chunk
+            data_msg = messages_pb2.GetData()
+            data_msg.ParseFromString(message[1].bytes)
+            request_chunk(data_msg)
+
+        elif header.request_type in (messages_pb2.STORE_DATA_REQ, messages_pb2.STORE_BATCH_REQ):
+
+            # If we have a StoreData message, parse it as multipart message that consists of
+            # filename (file metadata) and and the actual data content to be stored.
+            # A StoreBatch message carries several chunks, followed by the data of each of them
+            if header.request_type == messages_pb2.STORE_DATA_REQ:
+                data_msg = messages_pb2.StoreData()
+                data_msg.ParseFromString(message[1].bytes)
+                chunks = [data_msg]
+            else:
+                batch = messages_pb2.StoreBatch()
+                batch.ParseFromString(message[1].bytes)
+                chunks = list(batch.chunks)
+
+            # The chunks are written by the disk workers, and the last one to finish acknowledges the message
+            pieces = list(zip(chunks, message[2:]))
+            stored = []
+            completion = Completion(len(pieces), lambda header = header, stored = stored: acknowledge(header, stored))
+            for data_msg, frame in pieces:
+                disk_workers.submit(data_msg.filename, 'store', store_chunk, data_msg, frame.buffer, completion, stored)
+
+        elif header.request_type == messages_pb2.DELETE_REQ:
+
+            # The chunks of a DeleteBatch are deleted by the reclaimer, which acknowledges them once they are gone
+            delete_msg = messages_pb2.DeleteBatch()
+            delete_msg.ParseFromString(message[1].bytes)
+            reclaimer.delete(delete_msg.filenames, lambda deleted, request_id = header.request_id: acknowledge_delete(request_id, deleted))
+
+        else:
+            print(f"Unknown request type: {header.request_type}")
 
     #if(socket_sub in socks and socks[socket_sub] == zmq.POLLIN):
 
     if socket_sub in socks:
 
-        # If we have a GetData message, we parse it as a single message that contains the filename
+        # If we have a broadcast GetData message, we parse it as a single message that contains the filename
         message = socket_sub.recv()
         data_msg = messages_pb2.GetData()
         data_msg.ParseFromString(message)
-        print(f"Chunk to retrieve: {data_msg.filename}")
-
-        # Read the data from the specified data folder and send it as a multipart message back to controller
-        try:
-            with open(os.path.join(data_folder, data_msg.filename), 'rb') as f:
-                data = f.read()
-            socket_push.send_multipart([
-                data_msg.filename.encode('utf-8'), 
-                data
-            ])
-        except FileNotFoundError as _:
-            pass
+        request_chunk(data_msg)
+
 
 
@@ -0,0 +1,126 @@
+import os
+import sys
+import time
+import threading
+import urllib.request
+
+# Measure the throughput of the controller when several clients upload and download files at the same
+# time. With one client the requests are served one at a time, like before the controller was threaded.
+# A large upload is then streamed while small files are uploaded next to it, which only works when
+# the controller does not lock the database for the whole transfer of the large file.
+# Start node_placement.py and the storage nodes first, then run: python benchmark_concurrency.py [requests per client]
+
+BASE_URL = "http://localhost:9000"
+FILE_SIZE = 2 * 1024 * 1024
+CONCURRENCY = [1, 2, 4, 8, 16]
+STRATEGY = "random_placement"
+REPLICATION_FACTOR = 2
+FIRST_FILE_ID = 300000
+LARGE_FILE_SIZE = 400 * 1024 * 1024
+SMALL_FILE_SIZE = 1024
+LARGE_FILE_ID = 299999
+
+
+def upload(file_id, data, size = None):
+    request = urllib.request.Request(BASE_URL + '/files/upload', data = data, method = 'POST', headers = {
+        'Content-Type': 'application/octet-stream',
+        'Content-Length': str(len(data) if size is None else size),
+        'X-File-Id': str(file_id),
+        'X-Filename': f'concurrency-{file_id}.bin',
+        'X-Node-Placement-Strategy': STRATEGY,
+        'X-Replication-Factor': str(REPLICATION_FACTOR)
+    })
+    with urllib.request.urlopen(request) as response:
+        response.read()
+
+
+def download(file_id):
+    with urllib.request.urlopen(f'{BASE_URL}/files/{file_id}/download') as response:
+        return response.read()
+
+
+# Every client uploads its own files and downloads them again, checking that it gets back what it sent
+def client(file_ids, data, errors):
+    for file_id in file_ids:
+        try:
+            upload(file_id, data)
+            if download(file_id) != data:
+                errors.append(f"File {file_id} was not downloaded correctly")
+        except Exception as e:
+            errors.append(f"File {file_id}: {e}")
+
+
+# Body of the large upload, generated a block at a time instead of being held in memory
+def large_body(size, block):
+    for start in range(0, size, len(block)):
+        yield block[:size - start]
+
+
+# Upload small files one after another while the large file is uploaded, and report their latency
+def benchmark_large_upload(first_file_id):
+    result = {}
+
+    def upload_large():
+        start = time.time()
+        try:
+            upload(LARGE_FILE_ID, large_body(LARGE_FILE_SIZE, os.urandom(1024 * 1024)), LARGE_FILE_SIZE)
+        except Exception as e:
+            result['error'] = e
+        result['time'] = time.time() - start
+
+    large = threading.Thread(target = upload_large)
+    large.start()
+    time.sleep(0.5)
+
+    latencies = []
+    errors = []
+    data = os.urandom(SMALL_FILE_SIZE)
+    file_id = first_file_id
+    while large.is_alive():
+        start = time.time()
+        try:
+            upload(file_id, data)
+        except Exception as e:
+            errors.append(f"File {file_id}: {e}")
+        latencies.append(time.time() - start)
+        file_id += 1
+    large.join()
+
+    print(f"\nLarge upload of {LARGE_FILE_SIZE // (1024 * 1024)} MB: {result['time']:.2f} s" +
+          (f", failed: {result['error']}" if 'error' in result else ""))
+    if latencies:
+        print(f"{len(latencies)} uploads of {SMALL_FILE_SIZE} bytes next to it: "
+              f"max {max(latencies):.3f} s, mean {sum(latencies) / len(latencies):.3f} s, {len(errors)} errors")
+    for error in errors[:3]:
+        print(f"    {error}")
+
+
+if __name__ == "__main__":
+    requests_per_client = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    data = os.urandom(FILE_SIZE)
+    file_id = FIRST_FILE_ID
+
+    print(f"{'clients':>8} {'files':>6} {'time (s)':>9} {'files/s':>8} {'MB/s':>8} {'errors':>7}")
+    for clients in CONCURRENCY:
+        errors = []
+        threads = []
+        for _ in range(clients):
+            file_ids = range(file_id, file_id + requests_per_client)
+            file_id += requests_per_client
+            threads.append(threading.Thread(target = client, args = (file_ids, data, errors)))
+
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        files = clients * requests_per_client
+        # Every file is both uploaded and downloaded
+        megabytes = 2 * files * FILE_SIZE / 1e6
+        print(f"{clients:>8} {files:>6} {elapsed:>9.2f} {files / elapsed:>8.2f} {megabytes / elapsed:>8.1f} {len(errors):>7}")
+        for error in errors[:3]:
+            print(f"    {error}")
+
+    benchmark_large_upload(file_id)
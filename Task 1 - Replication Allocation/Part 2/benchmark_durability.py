@@ -0,0 +1,68 @@
+import os
+import sys
+import time
+import threading
+import urllib.request
+
+# Measure the ingest throughput of the controller at every durability level, with several clients uploading
+# small files at the same time. With fsync every chunk waits for a disk flush of its own, with group commit
+# the chunks that reach a storage node within a few milliseconds wait for one flush together.
+# Start node_placement.py and the storage nodes first, then run: python benchmark_durability.py [files per client]
+
+BASE_URL = "http://localhost:9000"
+FILE_SIZES = [4 * 1024, 64 * 1024, 1024 * 1024]
+DURABILITY_LEVELS = ['none', 'fsync', 'group']
+CLIENTS = 16
+STRATEGY = "random_placement"
+REPLICATION_FACTOR = 2
+FIRST_FILE_ID = 400000
+
+
+def upload(file_id, data, durability):
+    request = urllib.request.Request(BASE_URL + '/files/upload', data = data, method = 'POST', headers = {
+        'Content-Type': 'application/octet-stream',
+        'X-File-Id': str(file_id),
+        'X-Filename': f'durability-{file_id}.bin',
+        'X-Node-Placement-Strategy': STRATEGY,
+        'X-Replication-Factor': str(REPLICATION_FACTOR),
+        'X-Durability': durability
+    })
+    with urllib.request.urlopen(request) as response:
+        response.read()
+
+
+def client(file_ids, data, durability, errors):
+    for file_id in file_ids:
+        try:
+            upload(file_id, data, durability)
+        except Exception as e:
+            errors.append(f"File {file_id}: {e}")
+
+
+if __name__ == "__main__":
+    files_per_client = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    file_id = FIRST_FILE_ID
+
+    print(f"{'size (KB)':>9} {'durability':>10} {'files':>6} {'time (s)':>9} {'files/s':>8} {'MB/s':>8} {'errors':>7}")
+    for file_size in FILE_SIZES:
+        data = os.urandom(file_size)
+        for durability in DURABILITY_LEVELS:
+            errors = []
+            threads = []
+            for _ in range(CLIENTS):
+                file_ids = range(file_id, file_id + files_per_client)
+                file_id += files_per_client
+                threads.append(threading.Thread(target = client, args = (file_ids, data, durability, errors)))
+
+            start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.time() - start
+
+            files = CLIENTS * files_per_client
+            megabytes = files * file_size / 1e6
+            print(f"{file_size // 1024:>9} {durability:>10} {files:>6} {elapsed:>9.2f} {files / elapsed:>8.2f} {megabytes / elapsed:>8.1f} {len(errors):>7}")
+            for error in errors[:3]:
+                print(f"    {error}")
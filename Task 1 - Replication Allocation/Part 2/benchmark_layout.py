@@ -0,0 +1,62 @@
+import os
+import sys
+import time
+import random
+import string
+import shutil
+import tempfile
+
+from object_store import FileStore
+
+# Compare the store and fetch latency of a storage node that keeps every object directly in its data folder
+# (flat) and one that spreads them over hashed directories (sharded), as the number of objects grows.
+# Runs on its own, no controller or storage nodes are needed: python benchmark_layout.py [max objects]
+# The default stops at 10^5 objects, 10^6 takes several minutes and a few GB of disk per layout.
+
+OBJECT_SIZE = 1024
+MAX_OBJECTS = 10 ** 5
+# Stores and fetches timed at every object count
+SAMPLE = 1000
+
+
+def random_string(length = 8):
+    return ''.join(random.choice(string.ascii_letters) for _ in range(length))
+
+
+# Returns the average latency in microseconds of storing and of fetching an object once the store holds count objects
+def measure(store, names, count, data):
+    while len(names) < count - SAMPLE:
+        name = random_string()
+        store.write(name, data)
+        names.append(name)
+
+    start = time.perf_counter()
+    for _ in range(SAMPLE):
+        name = random_string()
+        store.write(name, data)
+        names.append(name)
+    store_latency = (time.perf_counter() - start) / SAMPLE * 1e6
+
+    start = time.perf_counter()
+    for name in random.sample(names, SAMPLE):
+        store.read(name)
+    fetch_latency = (time.perf_counter() - start) / SAMPLE * 1e6
+    return store_latency, fetch_latency
+
+
+if __name__ == "__main__":
+    max_objects = int(sys.argv[1]) if len(sys.argv) > 1 else MAX_OBJECTS
+    counts = [10 ** exponent for exponent in range(3, 7) if 10 ** exponent <= max_objects]
+    data = os.urandom(OBJECT_SIZE)
+
+    print(f"{'layout':>8} {'objects':>9} {'store (us)':>11} {'fetch (us)':>11}")
+    for layout, sharded in (('flat', False), ('sharded', True)):
+        folder = tempfile.mkdtemp(prefix = 'benchmark-layout-')
+        try:
+            store = FileStore(folder, sharded = sharded)
+            names = []
+            for count in counts:
+                store_latency, fetch_latency = measure(store, names, count, data)
+                print(f"{layout:>8} {count:>9} {store_latency:>11.1f} {fetch_latency:>11.1f}")
+        finally:
+            shutil.rmtree(folder)
@@ -0,0 +1,77 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import tracemalloc
+
+import zmq
+from object_store import open_store
+
+# Compare how fast a storage node serves large chunks when every chunk is read into memory (store.read)
+# and when it is sent from a memory map of its file or segment (store.view), for both kinds of store.
+# Runs on its own, no controller or storage nodes are needed: python benchmark_reads.py [size in MB] [rounds]
+
+OBJECT_SIZE = 16 * 1024 * 1024
+OBJECTS = 8
+ADDRESS = "inproc://benchmark-reads-{}"
+
+
+# Controller side: receive every chunk and throw it away
+def sink(context, address, messages):
+    socket = context.socket(zmq.PULL)
+    socket.connect(address)
+    for _ in range(messages):
+        socket.recv_multipart(copy = False)
+    socket.close()
+
+
+# Send every object rounds times the way a storage node answers a GetData request. Returns the
+# throughput in MB/s and the bytes allocated for the largest read
+def serve(context, address, store, names, rounds, zero_copy):
+    socket = context.socket(zmq.PUSH)
+    socket.bind(address)
+    receiver = threading.Thread(target = sink, args = (context, address, len(names) * rounds))
+    receiver.start()
+
+    largest_read = 0
+    sent = 0
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for name in names:
+            tracemalloc.start()
+            data = store.view(name) if zero_copy else store.read(name)
+            largest_read = max(largest_read, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            socket.send_multipart([b'header', name.encode('utf-8'), data], copy = False)
+            sent += len(data)
+            del data
+    receiver.join()
+    elapsed = time.perf_counter() - start
+    socket.close()
+    return sent / elapsed / 1e6, largest_read
+
+
+if __name__ == "__main__":
+    object_size = int(sys.argv[1]) * 1024 * 1024 if len(sys.argv) > 1 else OBJECT_SIZE
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    context = zmq.Context()
+    addresses = (ADDRESS.format(i) for i in range(1000))
+
+    print(f"{'store':>9} {'read path':>10} {'MB/s':>9} {'allocated per read':>19}")
+    for kind in ('files', 'segments'):
+        folder = tempfile.mkdtemp(prefix = 'benchmark-reads-')
+        try:
+            store = open_store(kind, folder)
+            names = [f'object{i}' for i in range(OBJECTS)]
+            for name in names:
+                store.write(name, os.urandom(object_size))
+
+            for path, zero_copy in (('read', False), ('mmap', True)):
+                throughput, allocated = serve(context, next(addresses), store, names, rounds, zero_copy)
+                print(f"{kind:>9} {path:>10} {throughput:>9.1f} {allocated:>19}")
+        finally:
+            shutil.rmtree(folder)
+
+    context.term()
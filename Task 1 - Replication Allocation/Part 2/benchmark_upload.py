@@ -0,0 +1,85 @@
+import os
+import sys
+import time
+import json
+import uuid
+import base64
+import urllib.request
+
+# Compare the JSON/base64 upload (POST /files) with the raw binary uploads (POST /files/upload)
+# Start node_placement.py and the storage nodes first, then run: python benchmark_upload.py [repetitions]
+
+BASE_URL = "http://localhost:9000"
+FILE_SIZES = [100 * 1024, 1024 * 1024, 10 * 1024 * 1024, 50 * 1024 * 1024]
+STRATEGY = "min_copy_sets"
+REPLICATION_FACTOR = 2
+
+
+def post(path, body, headers):
+    request = urllib.request.Request(BASE_URL + path, data = body, headers = headers, method = 'POST')
+    with urllib.request.urlopen(request) as response:
+        response.read()
+
+
+def upload_json(file_id, data):
+    body = json.dumps({
+        'file_id': file_id,
+        'filename': f'benchmark-{file_id}.bin',
+        'content_type': 'application/octet-stream',
+        'contents_b64': base64.b64encode(data).decode('ascii'),
+        'node_placement_strategy': STRATEGY,
+        'replication_factor': REPLICATION_FACTOR
+    }).encode('utf-8')
+    post('/files', body, {'Content-Type': 'application/json'})
+    return len(body)
+
+
+def upload_octet_stream(file_id, data):
+    post('/files/upload', data, {
+        'Content-Type': 'application/octet-stream',
+        'X-File-Id': str(file_id),
+        'X-Filename': f'benchmark-{file_id}.bin',
+        'X-Node-Placement-Strategy': STRATEGY,
+        'X-Replication-Factor': str(REPLICATION_FACTOR)
+    })
+    return len(data)
+
+
+def upload_multipart(file_id, data):
+    boundary = uuid.uuid4().hex
+    fields = {
+        'file_id': str(file_id),
+        'node_placement_strategy': STRATEGY,
+        'replication_factor': str(REPLICATION_FACTOR)
+    }
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode('utf-8'))
+    parts.append((
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="benchmark-{file_id}.bin"\r\n'
+        'Content-Type: application/octet-stream\r\n\r\n'
+    ).encode('utf-8'))
+    parts.append(data)
+    parts.append(f'\r\n--{boundary}--\r\n'.encode('utf-8'))
+    body = b''.join(parts)
+    post('/files/upload', body, {'Content-Type': f'multipart/form-data; boundary={boundary}'})
+    return len(body)
+
+
+if __name__ == "__main__":
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    methods = [("json/base64", upload_json), ("octet-stream", upload_octet_stream), ("multipart", upload_multipart)]
+    file_id = 100000
+
+    print(f"{'size (KB)':>10} {'method':>14} {'wire bytes':>12} {'avg time (s)':>13} {'MB/s':>8}")
+    for size in FILE_SIZES:
+        data = os.urandom(size)
+        for name, upload in methods:
+            times = []
+            for _ in range(repetitions):
+                file_id += 1
+                start = time.time()
+                wire_bytes = upload(file_id, data)
+                times.append(time.time() - start)
+            average = sum(times) / len(times)
+            print(f"{size // 1024:>10} {name:>14} {wire_bytes:>12} {average:>13.3f} {size / average / 1e6:>8.1f}")
@@ -0,0 +1,109 @@
+import sys
+import time
+import itertools
+import threading
+
+import zmq
+
+# Compare the CPU time the controller spends sending and receiving chunk payloads when chunks are
+# copied (bytes slices and copying sends, like before) and when they are not (memoryview slices and
+# copy=False frames). Runs on its own, no controller or storage nodes are needed:
+# python benchmark_zero_copy.py [size in MB]
+
+CHUNK_SIZE = 1024 * 1024
+REPLICATION_FACTOR = 2
+# Every run binds a new address, since closed sockets release theirs in the background
+TRANSPORTS = {
+    "inproc": "inproc://benchmark-zero-copy-{}",
+    "tcp": "tcp://127.0.0.1:{}"
+}
+FIRST_PORT = 5600
+
+
+# Storage node side: receive every message and throw the payload away
+def sink(context, address, messages, copy):
+    socket = context.socket(zmq.PULL)
+    socket.connect(address)
+    for _ in range(messages):
+        socket.recv_multipart(copy = copy)
+    socket.close()
+
+
+# Send a file the way the controller sends chunk replicas, and return the CPU seconds used by the sending thread
+def send_file(socket, data, zero_copy):
+    start = time.thread_time()
+    view = memoryview(data)
+
+    for offset in range(0, len(data), CHUNK_SIZE):
+        if zero_copy:
+            chunk = zmq.Frame(view[offset:offset + CHUNK_SIZE], track = True)
+        else:
+            chunk = data[offset:offset + CHUNK_SIZE]
+        for _ in range(REPLICATION_FACTOR):
+            socket.send_multipart([b'header', b'StoreData', chunk], copy = not zero_copy)
+
+    # The tracker is only done once every reference to the frame is gone, including ours
+    if zero_copy:
+        tracker = chunk.tracker
+        del chunk
+        tracker.wait()
+    return time.thread_time() - start
+
+
+# Receive chunk replies the way the dispatcher does, and return the CPU seconds used by the receiving thread
+def receive_file(context, address, data, zero_copy):
+    socket = context.socket(zmq.PULL)
+    socket.bind(address)
+    chunks = (len(data) + CHUNK_SIZE - 1) // CHUNK_SIZE
+
+    def node():
+        push = context.socket(zmq.PUSH)
+        push.connect(address)
+        view = memoryview(data)
+        for offset in range(0, len(data), CHUNK_SIZE):
+            push.send_multipart([b'header', b'chunk name', view[offset:offset + CHUNK_SIZE]], copy = False)
+        push.close()
+
+    sender = threading.Thread(target = node)
+    sender.start()
+    start = time.thread_time()
+    for _ in range(chunks):
+        message = socket.recv_multipart(copy = not zero_copy)
+        payload = message[2].buffer if zero_copy else message[2]
+        len(payload)
+    elapsed = time.thread_time() - start
+    sender.join()
+    socket.close()
+    return elapsed
+
+
+def benchmark_send(context, address, data, zero_copy):
+    socket = context.socket(zmq.PUSH)
+    socket.bind(address)
+    messages = (len(data) + CHUNK_SIZE - 1) // CHUNK_SIZE * REPLICATION_FACTOR
+    receiver = threading.Thread(target = sink, args = (context, address, messages, True))
+    receiver.start()
+    elapsed = send_file(socket, data, zero_copy)
+    receiver.join()
+    socket.close()
+    return elapsed
+
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) * 1024 * 1024 if len(sys.argv) > 1 else 256 * 1024 * 1024
+    data = bytes(size)
+    gigabytes = size * REPLICATION_FACTOR / 1e9
+    context = zmq.Context()
+
+    print(f"{'transport':>10} {'path':>8} {'copying (s/GB)':>15} {'zero-copy (s/GB)':>17}")
+    ports = itertools.count(FIRST_PORT)
+    for transport, address in TRANSPORTS.items():
+        before = benchmark_send(context, address.format(next(ports)), data, zero_copy = False)
+        after = benchmark_send(context, address.format(next(ports)), data, zero_copy = True)
+        print(f"{transport:>10} {'send':>8} {before / gigabytes:>15.3f} {after / gigabytes:>17.3f}")
+
+        before = receive_file(context, address.format(next(ports)), data, zero_copy = False)
+        after = receive_file(context, address.format(next(ports)), data, zero_copy = True)
+        print(f"{transport:>10} {'receive':>8} {before / (size / 1e9):>15.3f} {after / (size / 1e9):>17.3f}")
+
+    context.term()
@@ -0,0 +1,135 @@
+import queue
+import sys
+import threading
+import time
+import zlib
+from collections import defaultdict
+
+# Disk work of a storage node runs on a few background threads, so the poll loop keeps receiving
+# messages and answering status requests while large pieces are written or read.
+
+
+class IOStats:
+    """
+        Time disk operations waited in a worker queue and the time the worker spent on them, per kind of operation
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # kind -> [operations, total queue time, max queue time, total service time, max service time]
+        self.totals = defaultdict(lambda: [0, 0.0, 0.0, 0.0, 0.0])
+
+    def record(self, kind, queue_time, service_time):
+        with self.lock:
+            totals = self.totals[kind]
+            totals[0] += 1
+            totals[1] += queue_time
+            totals[2] = max(totals[2], queue_time)
+            totals[3] += service_time
+            totals[4] = max(totals[4], service_time)
+
+    def report(self):
+        with self.lock:
+            return [
+                f"{kind}: {count} operations, queue time avg {queued / count * 1000:.2f} ms max {max_queued * 1000:.2f} ms, "
+                f"service time avg {service / count * 1000:.2f} ms max {max_service * 1000:.2f} ms"
+                for kind, (count, queued, max_queued, service, max_service) in sorted(self.totals.items())
+            ]
+
+
+class DiskWorkers:
+    """
+        A fixed number of disk I/O threads. Every operation is submitted with the name of the object
+        it works on, and operations on the same object always run on the same thread in the order they
+        were submitted, so the pieces of an object are written in order and a read of an object sees
+        the writes submitted before it. The queues are not bounded: the controller's flow control
+        already limits how many store messages wait for this node.
+    """
+    def __init__(self, workers):
+        self.queues = [queue.Queue() for _ in range(workers)]
+        self.stats = IOStats()
+        for operations in self.queues:
+            threading.Thread(target = self.run, args = (operations,), daemon = True).start()
+
+    # Number of operations waiting for a worker
+    def queue_depth(self):
+        return sum(operations.qsize() for operations in self.queues)
+
+    def submit(self, name, kind, function, *args):
+        operations = self.queues[zlib.crc32(name.encode('utf-8')) % len(self.queues)]
+        operations.put((kind, time.perf_counter(), function, args))
+
+    def run(self, operations):
+        while True:
+            kind, submitted, function, args = operations.get()
+            started = time.perf_counter()
+            try:
+                function(*args)
+            except Exception as e:
+                print(f"Disk operation {kind} failed: {e}", file = sys.stderr)
+            self.stats.record(kind, started - submitted, time.perf_counter() - started)
+
+
+class Completion:
+    """
+        Calls done once count operations have finished, on the thread that finishes the last of them.
+        Used to acknowledge a message with pieces of several objects once all of them are written.
+    """
+    def __init__(self, count, done):
+        self.count = count
+        self.done = done
+        self.lock = threading.Lock()
+
+    def finish(self):
+        with self.lock:
+            self.count -= 1
+            last = self.count == 0
+        if last:
+            self.done()
+
+
+# Seconds a group commit waits for more writes before it forces the first one to disk. Writes that arrive
+# while a commit runs are forced to disk together by the next one anyway, so by default it does not wait
+GROUP_COMMIT_DELAY = 0
+
+
+class GroupCommit:
+    """
+        Forces writes to disk in batches, on a thread of its own. commit is called once with the names of
+        all writes that were submitted while the previous commit ran, or within delay seconds of the first
+        of them, so concurrent small writes share their fsyncs instead of paying for one each.
+        done is called with True once a write is on disk, or with False if the commit failed.
+    """
+    def __init__(self, commit, stats, delay = GROUP_COMMIT_DELAY):
+        self.commit = commit
+        self.stats = stats
+        self.delay = delay
+        self.writes = queue.Queue()
+        threading.Thread(target = self.run, daemon = True).start()
+
+    def submit(self, name, done):
+        self.writes.put((name, done, time.perf_counter()))
+
+    def run(self):
+        while True:
+            batch = [self.writes.get()]
+            deadline = batch[0][2] + self.delay
+            while (remaining := deadline - time.perf_counter()) > 0:
+                try:
+                    batch.append(self.writes.get(timeout = remaining))
+                except queue.Empty:
+                    break
+            # Writes submitted while the previous commit ran are past their deadline already, and join this commit
+            for _ in range(self.writes.qsize()):
+                batch.append(self.writes.get_nowait())
+
+            started = time.perf_counter()
+            try:
+                self.commit([name for name, _, _ in batch])
+                committed = True
+            except Exception as e:
+                print(f"Group commit of {len(batch)} writes failed: {e}", file = sys.stderr)
+                committed = False
+            self.stats.record('commit', started - batch[0][2], time.perf_counter() - started)
+
+            for _, done, _ in batch:
+                done(committed)
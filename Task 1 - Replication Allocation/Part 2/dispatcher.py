@@ -0,0 +1,183 @@
+import itertools
+import queue
+import threading
+from collections import defaultdict
+
+import zmq
+import messages_pb2
+from membership import Membership
+
+# Every storage node replies on the same PULL socket, so replies for different uploads and
+# downloads arrive mixed together. The dispatcher owns that socket in a background thread and
+# hands each reply to the operation waiting for it, using the request_id in the reply header.
+
+# Number of unacknowledged store messages sent to a storage node that has not advertised its window yet
+DEFAULT_NODE_WINDOW = 8
+
+class Operation:
+    """
+        An upload or download waiting for replies from the storage nodes.
+        Use it as a context manager so it stops receiving replies when the request is done.
+    """
+    def __init__(self, dispatcher, request_id):
+        self.dispatcher = dispatcher
+        self.request_id = request_id
+        self.replies = queue.Queue()
+
+    def recv(self, timeout = None):
+        """
+            Wait for the next reply to this operation. Returns a (header, frames) tuple where frames
+            are the frames after the header, or None if no reply arrived within timeout seconds.
+            The frames are zmq.Frame objects received without copying: use .bytes for small frames
+            like names and messages, and .buffer for a view of payloads such as chunk data.
+        """
+        try:
+            return self.replies.get(timeout = timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.dispatcher.close(self.request_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FlowControl:
+    """
+        Credit-based flow control for the store messages sent to each storage node.
+
+        Every storage node advertises a window: the number of store messages it accepts that it 
+        has not acknowledged yet. A store message takes one credit from its node, and the node's
+        acknowledgement gives it back. When a node has no credit left, acquire() blocks until it 
+        does, so a slow or dead node makes the uploads that use it wait instead of piling up 
+        messages in the controller's zmq queues.
+    """
+    def __init__(self, default_window = DEFAULT_NODE_WINDOW):
+        self.default_window = default_window
+        self.windows = {}
+        self.in_flight = defaultdict(int)
+        self.condition = threading.Condition()
+
+    def window(self, node_id):
+        return self.windows.get(str(node_id), self.default_window)
+
+    def acquire(self, node_id, timeout = None):
+        """
+            Take a credit to send a store message to a storage node, waiting up to timeout seconds
+            for one to be given back. Raises TimeoutError if the node has no credit left by then.
+        """
+        node_id = str(node_id)
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.in_flight[node_id] < self.window(node_id), timeout):
+                raise TimeoutError(f"Storage node {node_id} has {self.in_flight[node_id]} unacknowledged messages")
+            self.in_flight[node_id] += 1
+
+    def release(self, node_id, window = 0):
+        """
+            Give back the credit of an acknowledged store message, or of one that could not be sent.
+            window is the window the node advertised in its acknowledgement, if any.
+        """
+        node_id = str(node_id)
+        with self.condition:
+            self.in_flight[node_id] = max(0, self.in_flight[node_id] - 1)
+            if window:
+                self.windows[node_id] = window
+            self.condition.notify_all()
+
+    def reset(self, node_id, window):
+        """
+            A storage node that (re)starts has lost the messages sent to its previous run, 
+            so it starts over with a full window
+        """
+        node_id = str(node_id)
+        with self.condition:
+            self.in_flight[node_id] = 0
+            self.windows[node_id] = window or self.default_window
+            self.condition.notify_all()
+
+    def queue_depths(self):
+        """
+            Number of unacknowledged store messages and the window of every storage node 
+        """
+        with self.condition:
+            return {
+                node_id: {'queued': self.in_flight[node_id], 'window': self.window(node_id)}
+                for node_id in set(self.in_flight) | set(self.windows)
+            }
+
+
+class ReplyDispatcher:
+    def __init__(self, context, address):
+        self.socket_pull = context.socket(zmq.PULL)
+        self.socket_pull.bind(address)
+        self.request_ids = itertools.count(1)
+        self.operations = {}
+        self.lock = threading.Lock()
+        self.flow_control = FlowControl()
+        self.membership = Membership()
+
+        # The socket is only used by the dispatcher thread from now on
+        threading.Thread(target = self.run, daemon = True).start()
+
+    def open(self):
+        operation = Operation(self, next(self.request_ids))
+        with self.lock:
+            self.operations[operation.request_id] = operation
+        return operation
+
+    def close(self, request_id):
+        with self.lock:
+            self.operations.pop(request_id, None)
+
+    def run(self):
+        while True:
+            message = self.socket_pull.recv_multipart(copy = False)
+            header = messages_pb2.header()
+            header.ParseFromString(message[0].bytes)
+
+            # Storage nodes announce their window when they start, and set their node_id and window
+            # on store acknowledgements, which give back the credit even if nobody waits for them anymore.
+            # Heartbeats only update the membership view
+            if header.request_type == messages_pb2.NODE_READY:
+                self.flow_control.reset(header.node_id, header.window)
+                self.membership.heartbeat(header.node_id)
+                continue
+            if header.request_type == messages_pb2.HEARTBEAT:
+                heartbeat = messages_pb2.Heartbeat()
+                heartbeat.ParseFromString(message[1].bytes)
+                self.membership.heartbeat(heartbeat.node_id, heartbeat.free_bytes, heartbeat.queue_depth)
+                continue
+            if header.node_id:
+                self.flow_control.release(header.node_id, header.window)
+
+            with self.lock:
+                operation = self.operations.get(header.request_id)
+
+            # Late replies, e.g. from a replica that was asked after a timeout, have nobody waiting for them
+            if operation is None:
+                print(f"Discarding reply for request {header.request_id} that is no longer waiting")
+                continue
+
+            operation.replies.put((header, message[1:]))
+
+
+class LockedSocket:
+    """
+        Serializes sends on a zmq socket that is shared by the Flask request threads,
+        since zmq sockets must not be used by several threads at the same time.
+    """
+    def __init__(self, socket):
+        self.socket = socket
+        self.lock = threading.Lock()
+
+    def send(self, data, *args, **kwargs):
+        with self.lock:
+            return self.socket.send(data, *args, **kwargs)
+
+    def send_multipart(self, frames, *args, **kwargs):
+        with self.lock:
+            return self.socket.send_multipart(frames, *args, **kwargs)
@@ -4,7 +4,8 @@ create  table `file` (
     `filename` TEXT, 
     `size` INTEGER, 
     `created` DATETIME DEFAULT CURRENT_TIMESTAMP, 
-    `content_type` TEXT
+    `content_type` TEXT,
+    `compression` TEXT -- codec the file is compressed with before it is split into chunks, NULL if it is stored as uploaded
 );
 
 
@@ -16,10 +17,28 @@ create table `chunk` (
     `replica_index` INTEGER,  -- r number of replicas that goes from 0 to r-1
     `chunk_index` INTEGER,   -- k number of chunks that goes from 0 to k-1
     `storage_node_id` INTEGER, -- id of the storage node where the chunk replica is stored
+    `checksum` INTEGER, -- CRC32 of the chunk, NULL for chunks stored before checksums
     FOREIGN KEY (file_id) REFERENCES file(id)   
 );
 
 
+-- Chunk replicas named by the digest of their contents, which several files can share.
+-- ref_count is the number of rows in the chunk table that refer to the replica
+create table `chunk_object` (
+    `chunk_name` TEXT,
+    `storage_node_id` INTEGER,
+    `ref_count` INTEGER,
+    PRIMARY KEY (chunk_name, storage_node_id)
+);
+
+
+-- Chunk replicas that no file refers to anymore, which the storage nodes have not deleted yet
+create table `deleted_chunk` (
+    `chunk_name` TEXT,
+    `storage_node_id` INTEGER
+);
+
+
 
 -- Store storage node information and whether they are active or inactive
 create table `storage_node` (
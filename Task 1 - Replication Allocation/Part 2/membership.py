@@ -0,0 +1,98 @@
+import sqlite3
+import threading
+import time
+
+# Storage nodes send a heartbeat with their free disk space and disk queue depth every HEARTBEAT_INTERVAL
+# seconds. The controller keeps the latest heartbeat of every node, counts a node as down once it
+# missed its heartbeats for NODE_TIMEOUT seconds, and mirrors that in the status column of the
+# storage_node table, adding nodes it has not seen before.
+
+HEARTBEAT_INTERVAL = 0.25
+NODE_TIMEOUT = 1.0
+
+# Nodes in the storage_node table count as up for this long after the controller starts,
+# so they have time to send their first heartbeat
+STARTUP_GRACE = 5.0
+
+# Seconds between updates of the storage_node table
+SYNC_INTERVAL = 0.25
+
+# Nodes with less free disk space than this get no new data
+MIN_FREE_BYTES = 64 * 1024 * 1024
+
+
+class Membership:
+    """
+        Live view of the storage nodes, built from their heartbeats. Safe to use from several threads.
+    """
+    def __init__(self, timeout = NODE_TIMEOUT):
+        self.timeout = timeout
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        # node id -> (time of the last heartbeat, free bytes, disk queue depth)
+        self.nodes = {}
+
+    def heartbeat(self, node_id, free_bytes = None, queue_depth = 0):
+        with self.lock:
+            previous = self.nodes.get(str(node_id))
+            if free_bytes is None:
+                free_bytes = previous[1] if previous else None
+            self.nodes[str(node_id)] = (time.monotonic(), free_bytes, queue_depth)
+
+    def alive(self, node_id):
+        with self.lock:
+            state = self.nodes.get(str(node_id))
+        if state is None:
+            return time.monotonic() - self.started < STARTUP_GRACE
+        return time.monotonic() - state[0] < self.timeout
+
+    # Nodes that are up and have room for new data
+    def writable(self, node_id):
+        with self.lock:
+            state = self.nodes.get(str(node_id))
+        free_bytes = state[1] if state else None
+        return self.alive(node_id) and (free_bytes is None or free_bytes >= MIN_FREE_BYTES)
+
+    def view(self):
+        now = time.monotonic()
+        with self.lock:
+            nodes = dict(self.nodes)
+        return {
+            node_id: {
+                'alive': now - last_seen < self.timeout,
+                'last_heartbeat': round(now - last_seen, 3),
+                'free_bytes': free_bytes,
+                'queue_depth': queue_depth
+            }
+            for node_id, (last_seen, free_bytes, queue_depth) in nodes.items()
+        }
+
+    def start_sync(self, db_path):
+        threading.Thread(target = self.sync, args = (db_path,), daemon = True).start()
+
+    # Keep the status column of the storage_node table in line with the heartbeats.
+    # Only nodes with numeric ids fit the table
+    def sync(self, db_path):
+        db = sqlite3.connect(db_path)
+        while True:
+            try:
+                self.update_statuses(db)
+            except sqlite3.Error as e:
+                db.rollback()
+                print(f"Error updating storage node statuses: {e}")
+            time.sleep(SYNC_INTERVAL)
+
+    def update_statuses(self, db):
+        known = {str(node_id): status for node_id, status in db.execute('SELECT id, status FROM storage_node')}
+        with self.lock:
+            seen = list(self.nodes)
+        for node_id in set(known) | set(seen):
+            status = 1 if self.alive(node_id) else 0
+            if known.get(node_id) == status or not node_id.isdigit():
+                continue
+            db.execute(
+                'INSERT INTO storage_node (id, status) VALUES (?, ?) ON CONFLICT(id) DO UPDATE SET status = excluded.status',
+                (int(node_id), status)
+            )
+            print(f"Storage node {node_id} is {'up' if status else 'down'}")
+        db.commit()
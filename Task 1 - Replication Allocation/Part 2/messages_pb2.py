@@ -2,7 +2,7 @@
 # Generated by the protocol buffer compiler.  DO NOT EDIT!
 # NO CHECKED-IN PROTOBUF GENCODE
 # source: messages.proto
-# Protobuf Python Version: 6.32.1
+# Protobuf Python Version: 6.31.1
 """Generated protocol buffer code."""
 from google.protobuf import descriptor as _descriptor
 from google.protobuf import descriptor_pool as _descriptor_pool
@@ -12,7 +12,7 @@ from google.protobuf.internal import builder as _builder
 _runtime_version.ValidateProtobufRuntimeVersion(
     _runtime_version.Domain.PUBLIC,
     6,
-    32,
+    31,
     1,
     '',
     'messages.proto'
@@ -24,15 +24,27 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0emessages.proto\"\x1d\n\tStoreData\x12\x10\n\x08\x66ilename\x18\x01 \x01(\t\"\x1b\n\x07GetData\x12\x10\n\x08\x66ilename\x18\x01 \x01(\tb\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0emessages.proto\"v\n\tStoreData\x12\x10\n\x08\x66ilename\x18\x01 \x01(\t\x12\x12\n\nrequest_id\x18\x02 \x01(\x04\x12\x15\n\x08\x63hecksum\x18\x03 \x01(\rH\x00\x88\x01\x01\x12\x1f\n\ndurability\x18\x04 \x01(\x0e\x32\x0b.DurabilityB\x0b\n\t_checksum\"<\n\nStoreBatch\x12\x1a\n\x06\x63hunks\x18\x01 \x03(\x0b\x32\n.StoreData\x12\x12\n\nrequest_id\x18\x02 \x01(\x04\"/\n\x07GetData\x12\x10\n\x08\x66ilename\x18\x01 \x01(\t\x12\x12\n\nrequest_id\x18\x02 \x01(\x04\"4\n\x0b\x44\x65leteBatch\x12\x11\n\tfilenames\x18\x01 \x03(\t\x12\x12\n\nrequest_id\x18\x02 \x01(\x04\"E\n\tHeartbeat\x12\x0f\n\x07node_id\x18\x01 \x01(\t\x12\x12\n\nfree_bytes\x18\x02 \x01(\x04\x12\x13\n\x0bqueue_depth\x18\x03 \x01(\r\"b\n\x06header\x12#\n\x0crequest_type\x18\x01 \x01(\x0e\x32\r.request_type\x12\x12\n\nrequest_id\x18\x02 \x01(\x04\x12\x0f\n\x07node_id\x18\x03 \x01(\t\x12\x0e\n\x06window\x18\x04 \x01(\r*T\n\nDurability\x12\x13\n\x0f\x44URABILITY_NONE\x10\x00\x12\x14\n\x10\x44URABILITY_FSYNC\x10\x01\x12\x1b\n\x17\x44URABILITY_GROUP_COMMIT\x10\x02*x\n\x0crequest_type\x12\x12\n\x0eSTORE_DATA_REQ\x10\x00\x12\x10\n\x0cGET_DATA_REQ\x10\x01\x12\x0e\n\nNODE_READY\x10\x02\x12\x13\n\x0fSTORE_BATCH_REQ\x10\x03\x12\r\n\tHEARTBEAT\x10\x04\x12\x0e\n\nDELETE_REQ\x10\x05\x62\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'messages_pb2', _globals)
 if not _descriptor._USE_C_DESCRIPTORS:
   DESCRIPTOR._loaded_options = None
+  _globals['_DURABILITY']._serialized_start=474
+  _globals['_DURABILITY']._serialized_end=558
+  _globals['_REQUEST_TYPE']._serialized_start=560
+  _globals['_REQUEST_TYPE']._serialized_end=680
   _globals['_STOREDATA']._serialized_start=18
-  _globals['_STOREDATA']._serialized_end=47
-  _globals['_GETDATA']._serialized_start=49
-  _globals['_GETDATA']._serialized_end=76
+  _globals['_STOREDATA']._serialized_end=136
+  _globals['_STOREBATCH']._serialized_start=138
+  _globals['_STOREBATCH']._serialized_end=198
+  _globals['_GETDATA']._serialized_start=200
+  _globals['_GETDATA']._serialized_end=247
+  _globals['_DELETEBATCH']._serialized_start=249
+  _globals['_DELETEBATCH']._serialized_end=301
+  _globals['_HEARTBEAT']._serialized_start=303
+  _globals['_HEARTBEAT']._serialized_end=372
+  _globals['_HEADER']._serialized_start=374
+  _globals['_HEADER']._serialized_end=472
 # @@protoc_insertion_point(module_scope)
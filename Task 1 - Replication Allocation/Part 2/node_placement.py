@@ -1,33 +1,76 @@
 
 import random
+import itertools
 import messages_pb2
 import zmq
+from dispatcher import ReplyDispatcher, LockedSocket
+from compression import compress_bytes, compress_stream, decompress_pieces
 import time
 import string
 import sqlite3
-import io 
+import zlib
+import hashlib
+import threading
 from logging import exception
 from base64 import b64decode
-from flask import Flask, g, make_response, request, send_file
+from flask import Flask, Response, g, make_response, request
 
 # Set up zmq channels
 context = zmq.Context()
 
-# Socket to send StoreData message
-socket_push = context.socket(zmq.PUSH)
-socket_push.bind("tcp://*:5557")
-
-# Socket to receive results from storage nodes
-socket_pull = context.socket(zmq.PULL)
-socket_pull.bind("tcp://*:5558")
+# Socket to route StoreData messages to the storage node chosen by the placement strategy.
+# Storage nodes connect with a DEALER socket whose routing id is their storage_node id, so
+# ROUTER_MANDATORY makes sending to a node that has not registered fail instead of dropping the chunk
+# The sockets we send on are shared by the request threads, so sends are serialized with a lock
+socket_router = context.socket(zmq.ROUTER)
+socket_router.setsockopt(zmq.ROUTER_MANDATORY, 1)
+# A storage node that restarts connects with the same routing id, and ROUTER_HANDOVER gives it
+# the id of its dead connection instead of leaving the node unreachable
+socket_router.setsockopt(zmq.ROUTER_HANDOVER, 1)
+socket_router.bind("tcp://*:5557")
+socket_router = LockedSocket(socket_router)
+
+# Socket to receive results from storage nodes. The dispatcher hands every reply 
+# to the upload or download with the request_id in the reply header
+dispatcher = ReplyDispatcher(context, "tcp://*:5558")
 
 # Socket to publish GetData messages
 socket_pub = context.socket(zmq.PUB)
 socket_pub.bind("tcp://*:5559")
+socket_pub = LockedSocket(socket_pub)
 
 # Give some time for sockets to bind
 time.sleep(1)
 
+# Maximum number of chunk requests in flight at the same time during a download
+DOWNLOAD_WINDOW = 8
+
+# Seconds to wait for a chunk before also requesting it from another replica
+CHUNK_TIMEOUT = 3
+
+# Seconds to wait for a storage node to acknowledge a stored chunk
+STORE_TIMEOUT = 10
+
+# Size of the chunks a file is split into
+CHUNK_SIZE = 1024 * 1024  # 1 MB chunk size
+
+# Chunk replicas for the same storage node are sent together in one StoreBatch message once they add 
+# up to BATCH_SIZE bytes, or when the upload waits for acknowledgements. A batch never holds a full
+# chunk, so only small files and the last chunk of a file wait in a batch
+BATCH_SIZE = CHUNK_SIZE
+
+# Maximum number of chunk replicas sent during an upload that have not been acknowledged yet.
+# This bounds the controller memory used by an upload to about INGEST_WINDOW * CHUNK_SIZE
+INGEST_WINDOW = 8
+
+# How far the storage nodes write chunks to disk before they acknowledge them, chosen per upload with
+# the durability field or the X-Durability header. Without it chunks are acknowledged once written
+DURABILITY_LEVELS = {
+    'none': messages_pb2.DURABILITY_NONE,
+    'fsync': messages_pb2.DURABILITY_FSYNC,
+    'group': messages_pb2.DURABILITY_GROUP_COMMIT
+}
+
 
 #-------------------------------------------
 
@@ -37,6 +80,432 @@ time.sleep(1)
 def random_string(length = 8):
     return ''.join(random.SystemRandom().choice(string.ascii_letters) for _ in range(length))
 
+# Seconds between rounds of the reclaimer, which asks the storage nodes to delete the chunk replicas
+# that no file refers to anymore, with at most DELETE_BATCH replicas per storage node in a round
+RECLAIM_INTERVAL = 1
+DELETE_BATCH = 256
+
+# Seconds to wait for a storage node to report the chunks of a DeleteBatch as deleted. Nodes delete in
+# the background and let uploads and downloads go first, so this is longer than STORE_TIMEOUT
+DELETE_TIMEOUT = 30
+
+# How chunks are named. Random names store every chunk of every upload again. Content names are the
+# SHA-256 digest of the chunk, so a chunk that is already stored on enough storage nodes that are up is
+# not sent again, and the upload only adds a reference to it in the chunk_object table
+CHUNK_NAMING = ('random', 'content')
+
+def chunk_naming(name):
+    if name not in CHUNK_NAMING:
+        raise ValueError(f"Unknown chunk naming: {name}. Available namings: {', '.join(CHUNK_NAMING)}")
+    return name
+
+# Integer value of a request parameter, which may arrive as a string in a form field or header
+def integer_param(value, name):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be an integer, got {value!r}") from None
+
+def durability_level(name):
+    if name not in DURABILITY_LEVELS:
+        raise ValueError(f"Unknown durability level: {name}. Available levels: {', '.join(DURABILITY_LEVELS)}")
+    return DURABILITY_LEVELS[name]
+
+# Routing id a storage node registers with on the ROUTER socket
+def node_identity(storage_node_id):
+    return str(storage_node_id).encode('utf-8')
+
+# Send a message to one storage node through the ROUTER socket. The frames are sent without
+# copying, so payloads can be memoryviews or zmq.Frame objects that share the caller's buffer
+def send_to_node(storage_node_id, request_type, request_id, frames):
+    header = messages_pb2.header()
+    header.request_type = request_type
+    header.request_id = request_id
+    socket_router.send_multipart([
+        node_identity(storage_node_id),
+        header.SerializeToString()
+    ] + frames, copy = False)
+
+# Ask only the storage node that holds the chunk for it. The GetData message is broadcast
+# to every storage node only when the chunk has no storage_node_id metadata
+def request_chunk(data_msg, storage_node_id):
+    if storage_node_id is None:
+        socket_pub.send(data_msg.SerializeToString())
+        return
+
+    send_to_node(storage_node_id, messages_pb2.GET_DATA_REQ, data_msg.request_id, [data_msg.SerializeToString()])
+
+class ChunkUnavailableError(Exception):
+    pass
+
+# Request the chunks of a file with up to window requests in flight at the same time, and yield
+# the chunks in file order as soon as they are available. Replies can arrive in any order, so each
+# one is placed in the slot of its chunk index until every chunk before it has been yielded.
+# If a chunk has not arrived after CHUNK_TIMEOUT seconds, the next replica is requested as well.
+# A replica that does not match the checksum of its chunk, or that its storage node found corrupt,
+# is skipped and the next replica is requested instead.
+def fetch_chunks(group_chunks, window):
+    with dispatcher.open() as operation:
+        yield from fetch_chunks_for(group_chunks, window, operation)
+
+def fetch_chunks_for(group_chunks, window, operation):
+    chunk_indices = sorted(group_chunks.keys())
+    slot_of_chunk = {chunk_idx: slot for slot, chunk_idx in enumerate(chunk_indices)}
+    slots = [None] * len(chunk_indices)
+
+    # Replicas that have not been requested yet, in random order, for each chunk index. Replicas on storage
+    # nodes that are down are moved to the front, so they are only requested when no other replica is left
+    membership = operation.dispatcher.membership
+    replicas_left = {
+        chunk_idx: sorted(
+            random.sample(replicas, len(replicas)),
+            key = lambda replica: replica['storage_node_id'] is None or membership.alive(replica['storage_node_id'])
+        )
+        for chunk_idx, replicas in group_chunks.items()
+    }
+    # chunk_name -> chunk index of every request for a replica with that name we are waiting for.
+    # Chunks with the same contents have the same name when chunks are named by their contents
+    requested_names = {}
+    # chunk_name -> CRC32 of the replica, None for chunks stored before checksums
+    checksums = {
+        replica['chunk_name']: replica.get('checksum')
+        for replicas in group_chunks.values() for replica in replicas
+    }
+    # chunk index -> time the latest replica was requested
+    in_flight = {}
+
+    # Request the next replica of a chunk, skipping replicas on storage nodes that are not reachable
+    def request_next_replica(chunk_idx):
+        while replicas_left[chunk_idx]:
+            replica = replicas_left[chunk_idx].pop()
+            data_msg = messages_pb2.GetData()
+            data_msg.filename = replica['chunk_name']
+            data_msg.request_id = operation.request_id
+            try:
+                request_chunk(data_msg, replica['storage_node_id'])
+            except zmq.ZMQError as e:
+                print(f"Storage node {replica['storage_node_id']} is not reachable: {e}")
+                continue
+            requested_names.setdefault(replica['chunk_name'], []).append(chunk_idx)
+            in_flight[chunk_idx] = time.time()
+            return True
+        return False
+
+    next_chunk = 0
+    # Slot of the next chunk to yield. Chunks before it are released from memory
+    next_slot = 0
+
+    while next_slot < len(slots):
+        # Keep the window full with requests for chunks that have not been requested yet. Chunks that
+        # arrived early count towards the window too, so the chunks held in memory stay bounded
+        while next_chunk < len(chunk_indices) and next_chunk - next_slot < window:
+            chunk_idx = chunk_indices[next_chunk]
+            next_chunk += 1
+            if not request_next_replica(chunk_idx):
+                raise ChunkUnavailableError(f"No replica of chunk {chunk_idx} is reachable")
+
+        reply = operation.recv(timeout = 0.1)
+        if reply is not None:
+            _, message = reply
+            chunk_name_part = message[0].bytes.decode('utf-8')
+            if chunk_name_part not in requested_names:
+                print(f"Discarding reply that does not belong to this download: {chunk_name_part}")
+                continue
+
+            # A reply without data comes from a storage node that found its replica corrupt.
+            # It answers one of the requests for the name
+            expected = checksums.get(chunk_name_part)
+            if len(message) < 2 or (expected is not None and zlib.crc32(message[1].buffer) != expected):
+                chunk_idx = requested_names[chunk_name_part].pop(0)
+                if not requested_names[chunk_name_part]:
+                    del requested_names[chunk_name_part]
+                print(f"Replica {chunk_name_part} of chunk {chunk_idx} is corrupt")
+                if any(chunk_idx in indices for indices in requested_names.values()) or slots[slot_of_chunk[chunk_idx]] is not None:
+                    continue
+                if not request_next_replica(chunk_idx):
+                    raise ChunkUnavailableError(f"No healthy replica of chunk {chunk_idx}")
+                continue
+
+            # A healthy replica is the data of every chunk we are waiting for with that name
+            for chunk_idx in set(requested_names.pop(chunk_name_part)):
+                if slot_of_chunk[chunk_idx] >= next_slot and slots[slot_of_chunk[chunk_idx]] is None:
+                    slots[slot_of_chunk[chunk_idx]] = message[1]
+                    in_flight.pop(chunk_idx, None)
+                    print(f"Received chunk: {chunk_name_part} (chunk index {chunk_idx})")
+
+            # The chunk stays in the zmq frame it was received in until it is yielded. WSGI servers
+            # only accept bytes, so this is the one place the chunk is copied in the controller
+            while next_slot < len(slots) and slots[next_slot] is not None:
+                chunk = slots[next_slot]
+                slots[next_slot] = None
+                next_slot += 1
+                yield chunk.bytes
+
+        # Ask another replica for chunks that are taking too long
+        now = time.time()
+        for chunk_idx, requested_at in list(in_flight.items()):
+            if now - requested_at > CHUNK_TIMEOUT:
+                if not request_next_replica(chunk_idx):
+                    raise ChunkUnavailableError(f"Timed out waiting for chunk {chunk_idx}")
+
+# Fill buffer from a stream and return the number of bytes read, which is less than 
+# the size of the buffer only at the end of the stream
+def read_into(stream, buffer):
+    filled = 0
+    while filled < len(buffer):
+        # Streams without readinto() are read into a temporary bytes object and copied instead
+        if hasattr(stream, 'readinto'):
+            n = stream.readinto(buffer[filled:])
+        else:
+            data = stream.read(len(buffer) - filled)
+            n = len(data)
+            buffer[filled:filled + n] = data
+        if not n:
+            break
+        filled += n
+    return filled
+
+# Read a stream in chunk_size pieces into a small pool of buffers that are reused, instead of
+# allocating a new bytes object for every chunk. Each chunk is yielded as a zmq.Frame that 
+# shares its buffer, so it can be sent to every replica without being copied. zmq may still be 
+# sending a chunk after its replicas have been handed to the socket, so a buffer is only refilled
+# once the tracker of its frame reports that zmq is done with it.
+def iter_chunks(stream, chunk_size, buffer_count):
+    buffers = [bytearray(chunk_size) for _ in range(buffer_count)]
+    trackers = [None] * buffer_count
+
+    for chunk_index in itertools.count():
+        slot = chunk_index % buffer_count
+        if trackers[slot] is not None:
+            trackers[slot].wait()
+
+        view = memoryview(buffers[slot])
+        n = read_into(stream, view)
+        if n == 0:
+            return
+
+        frame = zmq.Frame(view[:n], track = True)
+        trackers[slot] = frame.tracker
+        yield frame
+
+        if n < chunk_size:
+            return
+
+# Wait for the acknowledgement of one of the chunk replicas in pending_acks, which holds a
+# (storage node id, chunk name) pair for every replica, since replicas named by content share their name
+def wait_for_ack(operation, pending_acks):
+    reply = operation.recv(timeout = STORE_TIMEOUT)
+    if reply is None:
+        raise TimeoutError(f"Timed out waiting for {len(pending_acks)} chunk acknowledgements")
+    # A batch of chunk replicas is acknowledged at once, with the name of every replica
+    header, message = reply
+    for frame in message:
+        resp = frame.bytes.decode('utf-8')
+        pending_acks.discard((header.node_id, resp))
+        print(f"Received acknowledgement for chunk: {resp}")
+
+# Send chunk replicas to a storage node. Several replicas go in one StoreBatch message with a single
+# acknowledgement, instead of a StoreData message and an acknowledgement for each of them
+def send_replicas(storage_node_id, request_id, replicas):
+    # Wait until the storage node has credit for another message, so a slow or dead node makes
+    # the upload wait instead of piling up chunks for it in the controller's zmq queue
+    dispatcher.flow_control.acquire(storage_node_id, timeout = STORE_TIMEOUT)
+
+    # The replicas share the buffers of their chunks, which are not copied by zmq
+    try:
+        if len(replicas) == 1:
+            data_msg, chunk = replicas[0]
+            send_to_node(storage_node_id, messages_pb2.STORE_DATA_REQ, request_id, [data_msg.SerializeToString(), chunk])
+        else:
+            batch = messages_pb2.StoreBatch()
+            batch.request_id = request_id
+            batch.chunks.extend(data_msg for data_msg, _ in replicas)
+            send_to_node(storage_node_id, messages_pb2.STORE_BATCH_REQ, request_id, 
+                         [batch.SerializeToString()] + [chunk for _, chunk in replicas])
+    except zmq.ZMQError:
+        dispatcher.flow_control.release(storage_node_id)
+        raise
+
+# Storage nodes that hold a replica of a chunk named by its contents, are up, and may be used for this upload,
+# and the storage nodes whose replica no file refers to anymore. Those replicas wait to be deleted by the
+# reclaimer, so the chunk is not stored on those nodes again until they are gone
+def stored_replicas(db, chunk_name, nodes):
+    stored_nodes = []
+    reclaimed_nodes = []
+    for row in db.execute('SELECT storage_node_id, ref_count FROM chunk_object WHERE chunk_name = ?', (chunk_name,)):
+        if row['ref_count'] <= 0:
+            reclaimed_nodes.append(row['storage_node_id'])
+        elif row['storage_node_id'] in nodes and dispatcher.membership.alive(row['storage_node_id']):
+            stored_nodes.append(row['storage_node_id'])
+    return stored_nodes, reclaimed_nodes
+
+# Pick the storage nodes for a chunk that already has replicas on stored_nodes, leaving out excluded_nodes:
+# the nodes picked by the placement strategy come first, then the other nodes in random order
+def extra_nodes(strategy, replication_factor, chunk_index, nodes, stored_nodes, excluded_nodes):
+    needed = replication_factor - len(stored_nodes)
+    if needed <= 0:
+        return []
+    candidates = select_nodes(strategy, replication_factor, chunk_index, nodes) + random.sample(nodes, len(nodes))
+    extra = []
+    for storage_node_id in candidates:
+        if storage_node_id not in stored_nodes and storage_node_id not in excluded_nodes and storage_node_id not in extra:
+            extra.append(storage_node_id)
+    return extra[:needed]
+
+# Pick the storage nodes for a chunk named by its contents and count a reference to its replica on each of them
+# in the chunk_object table, in a transaction of its own. The reference keeps a replica another file shares
+# from being reclaimed while the upload is in progress, without holding the database lock for the whole upload.
+# Returns the selected nodes and the nodes that already hold the chunk
+def reserve_replicas(db, chunk_name, strategy, replication_factor, chunk_index, nodes):
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        stored_nodes, reclaimed_nodes = stored_replicas(db, chunk_name, nodes)
+        stored_nodes = stored_nodes[:replication_factor]
+        selected_nodes = stored_nodes + extra_nodes(strategy, replication_factor, chunk_index, nodes, stored_nodes, reclaimed_nodes)
+        db.executemany(
+            'INSERT INTO chunk_object (chunk_name, storage_node_id, ref_count) VALUES (?, ?, 1) ON CONFLICT(chunk_name, storage_node_id) DO UPDATE SET ref_count = ref_count + 1',
+            [(chunk_name, storage_node_id) for storage_node_id in selected_nodes]
+        )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return selected_nodes, stored_nodes
+
+# Send every chunk replica to the storage node selected by the placement strategy. At most INGEST_WINDOW
+# replicas wait for an acknowledgement at the same time, so the next chunk is only read when there is room,
+# and controller memory does not grow with file size. Chunks named by their contents are only sent to the
+# storage nodes that do not hold them yet, and every replica of them counts as a reference in the chunk_object table.
+# The (chunk name, storage node id) of every replica the upload sent, or holds a reference to, is appended
+# to placed, so the replicas can be reclaimed when the upload fails.
+# Returns the size of the file and the rows of the chunk table, which the caller inserts once every replica is stored
+def store_chunks(db, file_id, chunks, strategy, replication_factor, nodes, operation, durability, naming = 'random',
+                 placed = None):
+    # (storage node id, chunk name) of the chunk replicas that have not been acknowledged yet
+    pending_acks = set()
+    size = 0
+    rows = []
+
+    # storage_node_id -> chunk replicas that wait to be sent to the node in one batch
+    batches = {}
+    batch_sizes = {}
+
+    def send_batch(storage_node_id):
+        replicas = batches.pop(storage_node_id)
+        batch_sizes.pop(storage_node_id)
+        send_replicas(storage_node_id, operation.request_id, replicas)
+        if placed is not None and naming != 'content':
+            placed.extend((data_msg.filename, storage_node_id) for data_msg, _ in replicas)
+
+    def send_all_batches():
+        for storage_node_id in list(batches):
+            send_batch(storage_node_id)
+
+    for chunk_index, chunk in enumerate(chunks):
+        size += len(chunk)
+        checksum = zlib.crc32(chunk)
+        if naming == 'content':
+            chunk_name = hashlib.sha256(chunk).hexdigest()
+            selected_nodes, stored_nodes = reserve_replicas(db, chunk_name, strategy, replication_factor, chunk_index, nodes)
+            if placed is not None:
+                placed.extend((chunk_name, storage_node_id) for storage_node_id in selected_nodes)
+            chunk_names = [chunk_name] * len(selected_nodes)
+        else:
+            stored_nodes = []
+            selected_nodes = select_nodes(strategy, replication_factor, chunk_index, nodes)
+            chunk_names = [random_string(8) for _ in range(replication_factor)]
+
+        for replica_index, storage_node_id in enumerate(selected_nodes):
+            if storage_node_id not in stored_nodes:
+                data_msg = messages_pb2.StoreData()
+                data_msg.filename = chunk_names[replica_index]
+                data_msg.request_id = operation.request_id
+                data_msg.checksum = checksum
+                data_msg.durability = durability
+
+                # Route the chunk replica to the storage node the placement strategy picked, 
+                # together with the other replicas for that node
+                batches.setdefault(storage_node_id, []).append((data_msg, chunk))
+                batch_sizes[storage_node_id] = batch_sizes.get(storage_node_id, 0) + len(chunk)
+                if batch_sizes[storage_node_id] >= BATCH_SIZE:
+                    send_batch(storage_node_id)
+                pending_acks.add((str(storage_node_id), data_msg.filename))
+
+            rows.append((file_id, chunk_names[replica_index], replica_index, chunk_index, storage_node_id, checksum))
+
+        if len(pending_acks) >= INGEST_WINDOW:
+            send_all_batches()
+        while len(pending_acks) >= INGEST_WINDOW:
+            wait_for_ack(operation, pending_acks)
+
+    # Wait for every storage node to acknowledge its chunk replicas before the upload is committed
+    send_all_batches()
+    while pending_acks:
+        wait_for_ack(operation, pending_acks)
+
+    return size, rows
+
+# Remove rows of the chunk table, and queue the chunk replicas no file refers to anymore in the deleted_chunk
+# table, for the reclaimer. A replica named by its contents is only queued when its last reference is removed
+def release_chunks(db, rows):
+    for row in rows:
+        db.execute('DELETE FROM chunk WHERE id = ?', (row['id'],))
+        release_replica(db, (row['chunk_name'], row['storage_node_id']))
+
+# Remove a reference to a chunk replica, and queue the replica for the reclaimer when it was the last one.
+# Replicas with random names have no chunk_object row and are always queued
+def release_replica(db, key):
+    db.execute('UPDATE chunk_object SET ref_count = ref_count - 1 WHERE chunk_name = ? AND storage_node_id = ?', key)
+    shared = db.execute('SELECT ref_count FROM chunk_object WHERE chunk_name = ? AND storage_node_id = ?', key).fetchone()
+    if shared is None or shared['ref_count'] <= 0:
+        db.execute('INSERT INTO deleted_chunk (chunk_name, storage_node_id) VALUES (?, ?)', key)
+
+# Release the chunk replicas store_chunks placed for an upload that failed. No file refers to them, so
+# they are queued for the reclaimer, except replicas named by their contents that other files still refer to
+def abandon_chunks(db, replicas):
+    for key in replicas:
+        release_replica(db, key)
+    db.commit()
+
+# Ask a storage node to delete chunks, and return the names of the chunks it reports as deleted
+def delete_on_node(storage_node_id, chunk_names):
+    with dispatcher.open() as operation:
+        delete_msg = messages_pb2.DeleteBatch()
+        delete_msg.filenames.extend(chunk_names)
+        delete_msg.request_id = operation.request_id
+        try:
+            send_to_node(storage_node_id, messages_pb2.DELETE_REQ, operation.request_id, [delete_msg.SerializeToString()])
+        except zmq.ZMQError as e:
+            print(f"Storage node {storage_node_id} is not reachable: {e}")
+            return []
+        reply = operation.recv(timeout = DELETE_TIMEOUT)
+    if reply is None:
+        print(f"Storage node {storage_node_id} did not confirm deleting {len(chunk_names)} chunks")
+        return []
+    _, message = reply
+    return [frame.bytes.decode('utf-8') for frame in message]
+
+# Background thread of the controller that deletes the chunk replicas in the deleted_chunk table from the
+# storage nodes, in one DeleteBatch per storage node and round. Replicas on storage nodes that are down
+# stay queued until the node is back. A replica is forgotten once its storage node reports it as deleted
+def reclaim_space():
+    db = sqlite3.connect("database.db")
+    while True:
+        time.sleep(RECLAIM_INTERVAL)
+        try:
+            nodes = [row[0] for row in db.execute('SELECT DISTINCT storage_node_id FROM deleted_chunk')]
+            for storage_node_id in filter(dispatcher.membership.alive, nodes):
+                chunk_names = [row[0] for row in db.execute(
+                    'SELECT chunk_name FROM deleted_chunk WHERE storage_node_id = ? LIMIT ?', (storage_node_id, DELETE_BATCH)
+                )]
+                deleted = [(chunk_name, storage_node_id) for chunk_name in delete_on_node(storage_node_id, chunk_names)]
+                db.executemany('DELETE FROM deleted_chunk WHERE chunk_name = ? AND storage_node_id = ?', deleted)
+                db.executemany('DELETE FROM chunk_object WHERE chunk_name = ? AND storage_node_id = ? AND ref_count <= 0', deleted)
+                db.commit()
+        except sqlite3.Error as e:
+            db.rollback()
+            print(f"Error reclaiming deleted chunks: {e}")
+
 # Gets a database connection for the current request
 def get_db():
     if 'db' not in g:
@@ -44,16 +513,45 @@ def get_db():
         g.db.row_factory = sqlite3.Row
     return g.db
 
-# Initialize the database with the tables defined in file.sql
+# Columns that were added to the tables after databases were created with file.sql
+NEW_COLUMNS = {
+    'file': {
+        'compression': 'TEXT'
+    },
+    'chunk': {
+        'checksum': 'INTEGER'
+    }
+}
+
+# Tables that were added after databases were created with file.sql
+NEW_TABLES = {
+    'chunk_object': 'CREATE TABLE chunk_object (chunk_name TEXT, storage_node_id INTEGER, ref_count INTEGER, PRIMARY KEY (chunk_name, storage_node_id))',
+    'deleted_chunk': 'CREATE TABLE deleted_chunk (chunk_name TEXT, storage_node_id INTEGER)'
+}
+
+# Initialize the database with the tables defined in file.sql if it has no tables yet,
+# and add the tables and columns that are missing in databases created with an older file.sql
 def init_db():
     db = sqlite3.connect("database.db")
     #db.execute("PRAGMA journal_mode=WAL;")
-    if db is None:
+    tables = [row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    if 'file' not in tables:
         try: 
             with open('file.sql') as f:
                 db.executescript(f.read())
         except EnvironmentError as e:
-            pass
+            print("Error initializing database: {}".format(e))
+
+    for table, create in NEW_TABLES.items():
+        if 'file' in tables and table not in tables:
+            db.execute(create)
+
+    for table, new_columns in NEW_COLUMNS.items():
+        columns = [row[1] for row in db.execute(f"PRAGMA table_info({table})")]
+        for column, column_type in new_columns.items():
+            if column not in columns:
+                db.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+    db.commit()
     db.close()
 
 # Close the database connection at the end of the request
@@ -119,6 +617,8 @@ def buddy_approach(nodes, R, chunk_index):
 
 # Create Flask instance
 init_db()
+dispatcher.membership.start_sync("database.db")
+threading.Thread(target = reclaim_space, daemon = True).start()
 app = Flask(__name__)
 app.teardown_appcontext(close_db)
 
@@ -162,6 +662,21 @@ def get_file_metachunks(file_id):
 
     return make_response(f)
 
+@app.route('/files/<int:file_id>', methods=['DELETE'])
+def delete_file(file_id):
+    """
+        Delete a file with the given file ID. Its metadata is removed right away, and the storage nodes
+        delete the chunk replicas that no other file refers to in the background
+    """
+    db = get_db()
+    if db.execute('SELECT id FROM file where id = ?', [file_id]).fetchone() is None:
+        return make_response({'message': f'File {file_id} not found'}, 404)
+
+    release_chunks(db, db.execute('SELECT id, chunk_name, storage_node_id FROM chunk where file_id = ?', [file_id]).fetchall())
+    db.execute('DELETE FROM file where id = ?', [file_id])
+    db.commit()
+    return make_response({'message': f'File {file_id} deleted'}, 200)
+
 @app.route('/files/<int:file_id>/download',  methods=['GET'])
 def download_files(file_id): 
     """
@@ -172,10 +687,11 @@ def download_files(file_id):
         1. The controller receives a GET request for a file with the given file ID
         2. The controller looks up the file metadata in the sqlite database.
         3. The controller then queries the sqlite database to retrieve the list of chunks and replicas associated with the file.
-        4. For each chunk index, we select one of the replica and retrieve the chunk from the corresponding storage node. 
-        5. Receive the chunk data from the storage node
-        6. Reassemble the chunks to reconstruct the original file in the correct order (ascending order) using the chunk indices.
-        7. Send the reconstructed file back to the client in the HTTP response.
+        4. For each chunk index, we select one of the replica and request the chunk from the storage node that holds it. 
+           Up to "window" chunks are requested at the same time instead of one chunk at a time.
+        5. Receive the chunk data from the storage nodes in whatever order it arrives
+        6. Put the chunks back in the correct order (ascending order) using the chunk indices.
+        7. Stream each chunk to the client as soon as all chunks before it have been sent.
  
     """
     db = get_db()
@@ -208,29 +724,50 @@ def download_files(file_id):
             group_chunks[idx] = []
         group_chunks[idx].append(row)
     
-    file_data_part = []
-    for chunk_idx in sorted(group_chunks.keys()):
-        replicas = group_chunks[chunk_idx]
-        selected_replica = random.choice(replicas)
-        data_msg = messages_pb2.GetData()
-        data_msg.filename = selected_replica['chunk_name']
-        socket_pub.send(
-            data_msg.SerializeToString()
-        )
-        while True:
-            message = socket_pull.recv_multipart()
-            chunk_name_part = message[0].decode('utf-8')
-            chunk_data_part = message[1]
-            if chunk_name_part == selected_replica['chunk_name']:
-                file_data_part.append(chunk_data_part)
-                print(f"Received chunk: {chunk_name_part} for file ID: {file_id}")
-                break
-    print(f"All chunks received successfully for file ID: {file_id}")
-    file_data_part = b''.join(file_data_part)
-    return send_file(io.BytesIO(file_data_part),
-                     mimetype=f['content_type'],)
+    # The number of chunk requests in flight can be set with the "window" query parameter
+    try:
+        window = max(1, integer_param(request.args.get('window', DOWNLOAD_WINDOW), 'window'))
+    except ValueError as e:
+        return make_response({'message': str(e)}, 400)
+
+    # The first chunk is fetched before the response starts, so a file that cannot be 
+    # downloaded still gets an error status. A failure later on aborts the response.
+    # Compressed files are decompressed as their chunks arrive
+    file_data_part = decompress_pieces(fetch_chunks(group_chunks, window), f['compression'])
+    try:
+        first_chunk = next(file_data_part)
+    except ChunkUnavailableError as e:
+        return make_response({'message': str(e)}, 503)
+
+    def stream_chunks():
+        yield first_chunk
+        yield from file_data_part
+        print(f"All chunks received successfully for file ID: {file_id}")
+
+    response = Response(stream_chunks(), mimetype = f['content_type'])
+    if f['size'] is not None:
+        response.content_length = f['size']
+    return response
+
+
+
+@app.route('/storage_nodes', methods=['GET'])
+def get_storage_nodes():
+    """
+        Get whether each storage node is up, the seconds since its last heartbeat, its free disk space
+        and the number of disk operations waiting on it
+    """
+    return make_response(dispatcher.membership.view())
 
 
+@app.route('/storage_nodes/queues', methods=['GET'])
+def get_queue_depths():
+    """
+        Get the number of chunks sent to each storage node that it has not acknowledged yet,
+        and the window of unacknowledged chunks the node advertised
+    """
+    return make_response(dispatcher.flow_control.queue_depths())
+
 
 @app.route('/files', methods=['POST'])
 def add_files():
@@ -241,59 +778,183 @@ def add_files():
 
         1. The file arrives from the client in a HTTP POST request
         2. Decode the serialized file from base64 string to binary
-        3. Slice the file into k chunks
-        4. generate unique chunk names for each chunk
-        5. Select N storage nodes according to the selected node placement strategy
-        6. For each chunk-replica pair, send a "Store chunk" message to the selected storage node
-        7. Store the file metadata into the sqlite database
-        8. Store the chunk metadata (replica_index, chunk_index, storage_node_id) to the sqlite database
+        3. Compress the file if the "compression" field names a codec and the file compresses well.
+           The "durability" field picks how far the storage nodes write the chunks to disk (none, fsync or group)
+        4. Read the file one chunk at a time
+        5. generate unique chunk names for each chunk, or the digest of the chunk if the "chunk_naming" field is
+           "content", in which case chunks that are already stored are not sent again
+        6. Select N storage nodes according to the selected node placement strategy
+        7. For each chunk-replica pair, route a "Store chunk" message to the selected storage node,
+           waiting for acknowledgements whenever INGEST_WINDOW replicas are unacknowledged
+        8. Store the file metadata into the sqlite database
+        9. Store the chunk metadata (replica_index, chunk_index, storage_node_id) to the sqlite database
 
     """
     payload = request.get_json()
     file_id = payload.get('file_id')
     file_bytes = b64decode(payload.get('contents_b64'))
     strategy = payload.get('node_placement_strategy')
-    replication_factor = int(payload.get('replication_factor'))
-    chunk_size= 1024 * 1024  # 1 MB chunk size
-    split_file_bytes = [file_bytes[i: i + chunk_size] for i in range(0, len(file_bytes), chunk_size)]
+    size = len(file_bytes)
+
+    try:
+        replication_factor = integer_param(payload.get('replication_factor'), 'replication_factor')
+        durability = durability_level(payload.get('durability', 'none'))
+        naming = chunk_naming(payload.get('chunk_naming', 'random'))
+    except ValueError as e:
+        return make_response({'message': str(e)}, 400)
+
+    compression = payload.get('compression')
+    if compression:
+        try:
+            file_bytes, compression = compress_bytes(file_bytes, compression)
+        except ValueError as e:
+            return make_response({'message': str(e)}, 400)
+
+    # The JSON body has to be parsed as a whole, but the decoded file is sent one chunk at a time
+    # as a view of the decoded bytes, instead of being split into a list of copied chunks up front
+    file_view = memoryview(file_bytes)
+    chunks = (file_view[start:start + CHUNK_SIZE] for start in range(0, len(file_bytes), CHUNK_SIZE))
+
+    return ingest_file(file_id, payload.get('filename'), payload.get('content_type'), chunks, strategy, replication_factor,
+                       durability, naming, compression, lambda: size)
+
+
+@app.route('/files/upload', methods=['POST'])
+def upload_files():
+    """
+        Ingest a new file sent as raw bytes instead of base64 inside JSON
 
+        The file can be sent in two ways:
+
+        1. multipart/form-data with the file in the "file" field, and file_id, node_placement_strategy
+           and replication_factor as form fields (like the Task 2 controllers)
+        2. application/octet-stream with the file as the request body, and the parameters in the 
+           X-File-Id, X-Node-Placement-Strategy, X-Replication-Factor, X-Filename, X-Content-Type,
+           X-Compression, X-Durability and X-Chunk-Naming headers
+
+        In both cases the file is read one chunk at a time and stored like in add_files().
+        A compression codec can be chosen with the compression form field or the X-Compression header,
+        and a durability level with the durability form field or the X-Durability header.
+        Chunks are named by their contents, and only sent if they are not stored yet, when the chunk_naming
+        form field or the X-Chunk-Naming header is "content".
+    """
+    if request.mimetype == 'multipart/form-data':
+        file = request.files.get('file')
+        if file is None:
+            return make_response({'message': 'No file uploaded'}, 400)
+        params = request.form
+        filename = params.get('filename') or file.filename
+        content_type = params.get('content_type') or file.mimetype
+        stream = file.stream
+        
+    elif request.mimetype == 'application/octet-stream':
+        params = {
+            'file_id': request.headers.get('X-File-Id'),
+            'node_placement_strategy': request.headers.get('X-Node-Placement-Strategy'),
+            'replication_factor': request.headers.get('X-Replication-Factor'),
+            'compression': request.headers.get('X-Compression'),
+            'durability': request.headers.get('X-Durability'),
+            'chunk_naming': request.headers.get('X-Chunk-Naming')
+        }
+        filename = request.headers.get('X-Filename')
+        content_type = request.headers.get('X-Content-Type', 'application/octet-stream')
+        stream = request.stream
+
+    else:
+        return make_response({'message': 'Expected multipart/form-data or application/octet-stream'}, 415)
+
+    if params.get('file_id') is None or params.get('replication_factor') is None:
+        return make_response({'message': 'file_id and replication_factor are required'}, 400)
+
+    strategy = params.get('node_placement_strategy')
+
+    try:
+        file_id = integer_param(params.get('file_id'), 'file_id')
+        replication_factor = integer_param(params.get('replication_factor'), 'replication_factor')
+        durability = durability_level(params.get('durability') or 'none')
+        naming = chunk_naming(params.get('chunk_naming') or 'random')
+    except ValueError as e:
+        return make_response({'message': str(e)}, 400)
+
+    # The file is compressed as it is read, so the size of the upload is only known once it has been stored
+    compression = params.get('compression')
+    original_size = None
+    if compression:
+        try:
+            stream, compression = compress_stream(stream, compression)
+        except ValueError as e:
+            return make_response({'message': str(e)}, 400)
+        original_size = lambda: stream.size
+
+    # At most INGEST_WINDOW replicas are unacknowledged, so this many buffers are enough
+    # for the reader to rarely wait for zmq to finish sending a chunk
+    chunks = iter_chunks(stream, CHUNK_SIZE, INGEST_WINDOW + 1)
+
+    return ingest_file(file_id, filename, content_type, chunks, strategy, replication_factor, durability, naming, compression,
+                       original_size)
+
+
+# Store the metadata of a file and send its chunks to the storage nodes as they are read from chunks.
+# durability is the Durability level the storage nodes store the chunks with, and naming is one of
+# CHUNK_NAMING. compression is the codec the chunks are compressed with, and original_size returns the size of the
+# uploaded file once the chunks have been read, when it is not the number of bytes that were stored
+def ingest_file(file_id, filename, content_type, chunks, strategy, replication_factor, durability, naming,
+                compression = None, original_size = None):
     db = get_db()
 
-    # We get sqlite3.IntegrityError if the UNIQUE constraint of file.id is failed. 
-    db.execute(
-                'INSERT INTO file (id, filename, size, content_type) VALUES (?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET filename=excluded.filename, size=excluded.size, content_type=excluded.content_type', 
-                (file_id, payload.get('filename'), len(file_bytes), payload.get('content_type'))          
-            )
-    #db.commit()
     cursor = db.execute(
         'SELECT id FROM storage_node where status = 1'
     )
-    nodes = [row['id'] for row in cursor.fetchall()]
+    nodes = [row['id'] for row in cursor.fetchall() if dispatcher.membership.writable(row['id'])]
+
+    # The placement is checked before anything is stored, so that a strategy or replication factor
+    # that cannot place the chunks on the storage nodes that are up is an error of the request
+    if not 1 <= replication_factor <= len(nodes):
+        return make_response({'message': f'replication_factor must be between 1 and the number of storage nodes that are up ({len(nodes)})'}, 400)
+    try:
+        select_nodes(strategy, replication_factor, 0, nodes)
+    except ValueError as e:
+        return make_response({'message': str(e)}, 400)
 
     #random_select = payload.get('random_placement')
     #min_copysets_placemnet = payload.get('min_copy_sets')
 
-    for chunk_index, chunk in enumerate(split_file_bytes):
-        selected_nodes = select_nodes(strategy, replication_factor, chunk_index, nodes)
-        chunk_names = [random_string(8) for _ in range(replication_factor)]
-
-        for replica_index, storage_node_id in enumerate(selected_nodes):
-            data_msg = messages_pb2.StoreData()
-            data_msg.filename = chunk_names[replica_index]
-            socket_push.send_multipart([
-                data_msg.SerializeToString(), 
-                chunk
-            ]) 
-
-            db.execute(
-                'INSERT INTO chunk (file_id, chunk_name, replica_index, chunk_index, storage_node_id) VALUES (?, ?, ?, ?, ?)',
-                (file_id, data_msg.filename, replica_index, chunk_index, storage_node_id)
+    # Replicas the storage nodes may have stored, or the upload holds a reference to, before it failed
+    placed = []
+    try:
+        with dispatcher.open() as operation:
+            size, rows = store_chunks(db, file_id, chunks, strategy, replication_factor, nodes, operation, durability, naming, placed)
+    except zmq.ZMQError as e:
+        abandon_chunks(db, placed)
+        return make_response({'message': f'Storage node is not reachable: {e}'}, 503)
+    except TimeoutError as e:
+        abandon_chunks(db, placed)
+        return make_response({'message': str(e)}, 504)
+    except Exception:
+        abandon_chunks(db, placed)
+        raise
+
+    if original_size is not None:
+        size = original_size()
+
+    # The file and its chunks are written in one short transaction once every chunk is stored, so the
+    # database is not locked for other requests while the file is transferred.
+    # The chunks of a file that is uploaded again under the same id are released in the same transaction,
+    # and chunks named by their contents that are in both versions keep the references of the new version
+    db.execute(
+                'INSERT INTO file (id, filename, size, content_type, compression) VALUES (?, ?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET filename=excluded.filename, size=excluded.size, content_type=excluded.content_type, compression=excluded.compression', 
+                (file_id, filename, size, content_type, compression)          
             )
+    old_chunks = db.execute('SELECT id, chunk_name, storage_node_id FROM chunk WHERE file_id = ?', (file_id,)).fetchall()
+    db.executemany(
+        'INSERT INTO chunk (file_id, chunk_name, replica_index, chunk_index, storage_node_id, checksum) VALUES (?, ?, ?, ?, ?, ?)',
+        rows
+    )
+    release_chunks(db, old_chunks)
     db.commit()
     return make_response({'message': 'File chunks stored successfully'}, 200)
             
 
-
 @app.errorhandler(500)
 def server_error(e):
     exception("Internal error: %s", e)
@@ -302,6 +963,9 @@ def server_error(e):
 
 host_local_computer = "localhost"
 host_local_network = "0.0.0.0"
-app.run(host = host_local_computer, port = 9000) # The base url is http://localhost:9000
+# Every request is served in its own thread. This is safe because sends on the shared sockets are
+# serialized by LockedSocket, and replies are handed to the right request by the dispatcher. 
+# The controller binds its zmq ports itself, so it must run as a single process, not as several WSGI workers
+app.run(host = host_local_computer, port = 9000, threaded = True) # The base url is http://localhost:9000
 
 
@@ -0,0 +1,75 @@
+import queue
+import threading
+import time
+
+from disk_io import Completion
+
+# A storage node deletes the objects the controller no longer needs in the background, a batch at a time.
+# A batch waits while reads and writes are queued on the disk workers, so deleting a large file does not
+# stall downloads, but never for longer than MAX_DEFER seconds, so deletes are not starved either.
+
+# Objects deleted per batch
+RECLAIM_BATCH = 64
+
+# Longest time in seconds a batch waits for the disk workers to run out of other work
+MAX_DEFER = 1.0
+
+# Seconds between checks of the disk worker queues while a batch waits
+IDLE_POLL = 0.01
+
+
+class Reclaimer(threading.Thread):
+    """
+        Deletes the objects of store that are handed to delete(). The objects are deleted by the disk
+        workers like any other operation, so a delete never runs in the middle of a write or read of the
+        same object. done is called with the names of the objects that are gone once a request is finished.
+    """
+    def __init__(self, store, disk_workers, batch = RECLAIM_BATCH, max_defer = MAX_DEFER):
+        super().__init__(daemon = True)
+        self.store = store
+        self.disk_workers = disk_workers
+        self.batch = batch
+        self.max_defer = max_defer
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.objects = 0
+        self.deferred = 0.0
+
+    def delete(self, names, done):
+        self.requests.put((list(names), done))
+
+    def run(self):
+        while True:
+            names, done = self.requests.get()
+            deleted = []
+            for start in range(0, len(names), self.batch):
+                self.wait_for_idle()
+                batch = names[start:start + self.batch]
+                finished = threading.Event()
+                completion = Completion(len(batch), finished.set)
+                for name in batch:
+                    self.disk_workers.submit(name, 'delete', self.delete_object, name, completion, deleted)
+                finished.wait()
+            done(deleted)
+
+    def wait_for_idle(self):
+        started = time.monotonic()
+        while self.disk_workers.queue_depth() > 0 and time.monotonic() - started < self.max_defer:
+            time.sleep(IDLE_POLL)
+        with self.lock:
+            self.deferred += time.monotonic() - started
+
+    # An object that is not stored here counts as deleted, so a repeated delete request is answered
+    def delete_object(self, name, completion, deleted):
+        try:
+            if name in self.store:
+                self.store.delete(name)
+                with self.lock:
+                    self.objects += 1
+            deleted.append(name)
+        finally:
+            completion.finish()
+
+    def stats(self):
+        with self.lock:
+            return {'objects': self.objects, 'deferred': round(self.deferred, 3)}
@@ -1,13 +1,104 @@
 import math
+import os
+import shutil
+import sqlite3
+import struct
+import tempfile
 import random
 import string
 import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import zmq
 import messages_pb2
 import pyerasure
 import pyerasure.generator
 import pyerasure.finite_field
+from compression import compress_stream
+from database import deleted_fragments, forget_deleted
+
+# Seconds to wait for storage nodes to acknowledge stored fragments
+STORE_TIMEOUT = 10
+
+# Seconds to wait for a storage node to report the fragments of a DeleteBatch as deleted. Nodes delete
+# in the background and let uploads and downloads go first, so this is longer than STORE_TIMEOUT
+DELETE_TIMEOUT = 30
+
+# Seconds between rounds of the reclaimer, which asks the storage nodes to delete the fragments of
+# deleted files, with at most DELETE_BATCH fragments per storage node in a round
+RECLAIM_INTERVAL = 1
+DELETE_BATCH = 256
+
+# Bytes of every fragment that are encoded and sent at a time during an upload
+STREAM_WINDOW = 256 * 1024
+
+# Windows of an upload that may wait for acknowledgements before the next window is encoded
+WINDOWS_IN_FLIGHT = 4
+
+# Bytes of a file that are encoded into one stripe by default, chosen per upload with the stripe_size
+# form field. Every stripe is encoded on its own into k + l symbols, and symbol i of every stripe is
+# appended to fragment i, so a stripe can be decoded without the rest of the file
+STRIPE_SIZE = 4 * 1024 * 1024
+
+# Smallest stripe size an upload may choose. Every stripe is encoded and sent on its own, so tiny stripes would
+# turn a file into a message per storage node for every few bytes
+MIN_STRIPE_SIZE = 64 * 1024
+
+# Stripes of a download whose fragment ranges are requested ahead of the stripe that is being decoded,
+# and stripes that may be decoded at the same time
+STRIPES_IN_FLIGHT = 4
+
+# Threads that encode, decode and decompress files
+CODING_WORKERS = os.cpu_count() or 4
+coding_pool = ThreadPoolExecutor(max_workers = CODING_WORKERS)
+
+# How far the storage nodes write fragments to disk before they acknowledge them, chosen per upload
+# with the durability form field. Without it fragments are acknowledged once written
+DURABILITY_LEVELS = {
+    'none': messages_pb2.DURABILITY_NONE,
+    'fsync': messages_pb2.DURABILITY_FSYNC,
+    'group': messages_pb2.DURABILITY_GROUP_COMMIT
+}
+
+def durability_level(name):
+    if name not in DURABILITY_LEVELS:
+        raise ValueError(f"Unknown durability level: {name}. Available levels: {', '.join(DURABILITY_LEVELS)}")
+    return DURABILITY_LEVELS[name]
+
+# Stripe size of an upload, rounded up to a multiple of k so every symbol of a full stripe has the same size.
+# A stripe size of 0 stores the file as one stripe, which is how files were stored before stripes, and gives None
+def stripe_size_for(value, k):
+    try:
+        size = int(value)
+    except ValueError:
+        size = -1
+    if size == 0:
+        return None
+    if size < MIN_STRIPE_SIZE:
+        raise ValueError(f"Invalid stripe size: {value}. The stripe size is at least {MIN_STRIPE_SIZE} bytes, or 0 for one stripe")
+    return k * math.ceil(size / k)
+
+# Layout of the stripes of a file. Yields (file offset, length, fragment offset, symbol size) for every stripe.
+# The last stripe may be shorter than the others, and so are its symbols. Files without a stripe size are one stripe
+def stripe_layout(file_size, k, stripe_size):
+    stripe_size = stripe_size or file_size
+    fragment_offset = 0
+    for start in range(0, file_size, stripe_size):
+        length = min(stripe_size, file_size - start)
+        symbol_size = math.ceil(length / k)
+        yield start, length, fragment_offset, symbol_size
+        fragment_offset += symbol_size
+
+# The stripe checksums of a fragment are stored in one BLOB, as a little endian 32 bit integer per stripe
+def pack_checksums(checksums):
+    return struct.pack(f'<{len(checksums)}I', *checksums)
+
+def unpack_checksums(blob):
+    if blob is None:
+        return None
+    return list(struct.unpack(f'<{len(blob) // 4}I', blob))
 
 def random_string(length = 8):
     return ''.join(random.SystemRandom().choice(string.ascii_letters) for _ in range(length))
@@ -30,8 +121,158 @@ def rs_cauchy_coeffs(k, l):
     
     return matrix
 
-def store_file(file_data, send_task_socket, response_socket, k, l, storage_nodes_count):
-    file_data = bytearray(file_data)
+# Routing id a storage node registers with on the controller's ROUTER socket
+def node_identity(storage_node_id):
+    return str(storage_node_id).encode('utf-8')
+
+# Read the same window of every source symbol of the stripe that starts at stripe_start. Source symbol i is the 
+# bytes [stripe_start + i * symbol_size, stripe_start + (i + 1) * symbol_size) of the file, and bytes past the end
+# of the file are zero padding. The file is read straight into the block handed to the encoder, so no padded copy of it is made
+def read_column_window(file_stream, file_size, symbol_size, offset, window, symbols, stripe_start = 0):
+    block = bytearray(symbols * window)
+    view = memoryview(block)
+
+    for i in range(symbols):
+        start = stripe_start + i * symbol_size + offset
+        if start >= file_size:
+            break
+        file_stream.seek(start)
+        piece = view[i * window:(i + 1) * window]
+        while len(piece) > 0:
+            n = file_stream.readinto(piece)
+            if not n:
+                break
+            piece = piece[n:]
+
+    return block
+
+# Size of a compressed upload that is kept in memory before it is spooled to disk
+COMPRESSED_SPOOL_SIZE = 16 * 1024 * 1024
+
+# Compress an upload with the codec named codec_name, unless it does not compress well. Encoding reads 
+# the file window by window at any position, so the compressed file is written to a temporary file first.
+# Returns the stream to encode, its size and the codec it is compressed with, or None if it is not compressed
+def compress_upload(file_stream, size, codec_name):
+    stream, compression = compress_stream(file_stream, codec_name)
+    if compression is None:
+        file_stream.seek(0)
+        return file_stream, size, None
+
+    compressed = tempfile.SpooledTemporaryFile(max_size = COMPRESSED_SPOOL_SIZE)
+    shutil.copyfileobj(stream, compressed)
+    stored_size = compressed.tell()
+    compressed.seek(0)
+    return compressed, stored_size, compression
+
+# Wait for a storage node to acknowledge one of the messages we sent. The acknowledgement names
+# the pieces the node stored, which leaves out pieces that failed their checksum or could not be written.
+# Returns the number of pieces stored
+def wait_for_ack(operation):
+    reply = operation.recv(timeout = STORE_TIMEOUT)
+    if reply is None:
+        raise TimeoutError("Timed out waiting for storage nodes to store the fragments")
+    _, resp = reply
+    print("Received fragments %s" % ', '.join(frame.bytes.decode('utf-8') for frame in resp))
+    return len(resp)
+
+def check_stored(unacknowledged):
+    if unacknowledged > 0:
+        raise IOError(f"Storage nodes did not store {unacknowledged} fragment pieces")
+
+# Send fragment pieces to a storage node. Several pieces go in one StoreBatch message with a single
+# acknowledgement, instead of a StoreData message and an acknowledgement for each of them.
+# The node only gets the message once it has credit for it, so a slow node makes the upload
+# wait instead of piling up pieces in the controller's zmq queue
+def send_pieces(send_task_socket, dispatcher, operation, node, pieces):
+    header = messages_pb2.header()
+    header.request_id = operation.request_id
+    if len(pieces) == 1:
+        header.request_type = messages_pb2.STORE_FRAGMENT_DATA_REQ
+        task, symbol = pieces[0]
+        frames = [task.SerializeToString(), symbol]
+    else:
+        header.request_type = messages_pb2.STORE_BATCH_REQ
+        batch = messages_pb2.StoreBatch()
+        batch.request_id = operation.request_id
+        batch.fragments.extend(task for task, _ in pieces)
+        frames = [batch.SerializeToString()] + [symbol for _, symbol in pieces]
+
+    dispatcher.flow_control.acquire(node, timeout = STORE_TIMEOUT)
+    try:
+        send_task_socket.send_multipart([node_identity(node), header.SerializeToString()] + frames, copy = False)
+    except zmq.ZMQError:
+        dispatcher.flow_control.release(node)
+        raise
+
+# Name the c fragments of a file and pick the storage nodes for each of them.
+# Returns the names in fragment index order, name -> fragment index and name -> storage nodes
+def place_fragments(c, select_nodes):
+    fragment_meta = {}
+    fragment_nodes = {}
+    fragment_names = []
+
+    for i in range(c):
+        name = random_string(8)
+        fragment_names.append(name)
+        fragment_meta[name] = i
+        fragment_nodes[name] = select_nodes(i)
+
+    return fragment_names, fragment_meta, fragment_nodes
+
+# Windows an upload is encoded in. Yields (stripe start, offset in the symbols of the stripe,
+# fragment offset of the stripe, symbol size of the stripe) for every window of every stripe
+def stripe_windows(file_size, k, stripe_size):
+    for stripe_start, _, fragment_offset, symbol_size in stripe_layout(file_size, k, stripe_size):
+        for offset in range(0, symbol_size, STREAM_WINDOW):
+            yield stripe_start, offset, fragment_offset, symbol_size
+
+# StoreData message for the piece of a fragment at offset, with the checksum of the piece
+def store_task(name, request_id, offset, symbol, durability = messages_pb2.DURABILITY_NONE):
+    task = messages_pb2.StoreData()
+    task.filename = name
+    task.request_id = request_id
+    task.offset = offset
+    task.checksum = zlib.crc32(symbol)
+    task.durability = durability
+    return task
+
+# Encode the window at offset of every symbol of the stripe that starts at stripe_start.
+# Returns one encoded symbol per row of matrix
+def encode_window(file_stream, file_size, symbol_size, offset, matrix, symbols, field, stripe_start = 0):
+    window = min(STREAM_WINDOW, symbol_size - offset)
+    encoder = pyerasure.Encoder(
+        field = field, 
+        symbols = symbols, 
+        symbol_bytes = window
+    )
+    encoder.set_symbols(read_column_window(file_stream, file_size, symbol_size, offset, window, symbols, stripe_start))
+    return [encoder.encode_symbol(coeffs) for coeffs in matrix]
+
+"""
+    Store a file by encoding it into k + l fragments and sending them to the storage nodes
+
+    The file is split into stripes of stripe_size bytes, and every stripe is encoded on its own into
+    k + l symbols, which are appended to the k + l fragments. Every encoded symbol is a linear
+    combination of the k source symbols of its stripe, so each byte offset of the encoded symbols only
+    depends on the same byte offset of the source symbols. We therefore encode STREAM_WINDOW bytes of
+    every symbol of a stripe at a time, and send each piece with its offset in the fragment, so the
+    storage nodes assemble the same fragments as if every stripe had been encoded at once. At most
+    WINDOWS_IN_FLIGHT windows wait for acknowledgements, so memory is bounded by about
+    (k + l) * STREAM_WINDOW * WINDOWS_IN_FLIGHT, and a file with a stripe size of None is one stripe.
+    The CRC32 checksum of every fragment is computed over its pieces in order, and returned with
+    the placement so it can be stored with the fragment and verified when the fragment is fetched.
+    So is the CRC32 of every stripe of every fragment, which downloads fetch one at a time.
+
+    Params:
+    - file_stream: seekable binary stream with the file data
+    - file_size: size of the file in bytes
+    - select_nodes: function that returns the storage nodes for a fragment index
+    - stripe_size: bytes of the file per stripe, a multiple of k from stripe_size_for
+    - sent: set the (fragment name, storage node) of every fragment piece sent is added to, so the
+      fragments can be reclaimed when the upload fails
+"""
+def store_file(file_stream, file_size, send_task_socket, dispatcher, k, l, storage_nodes_count, select_nodes,
+               durability = messages_pb2.DURABILITY_NONE, stripe_size = None, sent = None):
     c = k + l
     
     assert c >= 0
@@ -39,102 +280,406 @@ def store_file(file_data, send_task_socket, response_socket, k, l, storage_nodes
     assert c <= storage_nodes_count
 
     symbols = k
-    symbol_size = math.ceil(len(file_data)/symbols)
     field = pyerasure.finite_field.Binary8()
-    encoder = pyerasure.Encoder(
-        field = field, 
-        symbols = symbols, 
-        symbol_bytes = symbol_size
-    )
-
-    encoder.set_symbols(file_data.ljust(symbols * symbol_size, b'\0'))
-    symbol = bytearray(encoder.symbol_bytes)
     matrix = rs_cauchy_coeffs(k, l)
-    fragment_meta = {}
+    fragment_names, fragment_meta, fragment_nodes = place_fragments(c, select_nodes)
+    fragment_checksums = dict.fromkeys(fragment_names, 0)
+    # fragment name -> CRC32 of the symbol of every stripe in the fragment
+    stripe_checksums = {name: [] for name in fragment_names}
 
-    for i in range(c):
-        coeffs = matrix[i]
-        symbol = encoder.encode_symbol(coeffs)
-        name = random_string(8)
-        fragment_meta[name] = i
+    # The pieces of a window that go to the same storage node are sent in one message
+    messages_per_window = len({node for nodes in fragment_nodes.values() for node in nodes})
+    pending = 0
+    unacknowledged = 0
 
-        task = messages_pb2.StoreData()
-        task.filename = name
+    with dispatcher.open() as operation:
+        for stripe_start, offset, fragment_offset, symbol_size in stripe_windows(file_size, k, stripe_size):
+            encoded = encode_window(file_stream, file_size, symbol_size, offset, matrix, symbols, field, stripe_start)
 
-        send_task_socket.send_multipart([
-            task.SerializeToString(),
-            symbol
-        ])
+            # storage node -> pieces of this window for the node
+            node_pieces = {}
 
-    for _ in range(c):
-        resp = response_socket.recv_string()
-        print("Received fragments %s" % resp)
-    
-    return fragment_meta, matrix
+            for name, symbol in zip(fragment_names, encoded):
+                task = store_task(name, operation.request_id, fragment_offset + offset, symbol, durability)
+                fragment_checksums[name] = zlib.crc32(symbol, fragment_checksums[name])
+                if offset == 0:
+                    stripe_checksums[name].append(0)
+                stripe_checksums[name][-1] = zlib.crc32(symbol, stripe_checksums[name][-1])
 
+                # Route the fragment piece to every storage node the placement strategy picked for it.
+                # The encoded symbol is a new buffer, so every copy of it can share it instead of copying
+                for node in fragment_nodes[name]:
+                    node_pieces.setdefault(node, []).append((task, symbol))
 
-def get_file(coded_fragments, fragment_meta, matrix, file_size, data_req_socket, response_socket, k, l):
-    
-    available_fragments = []
-    for fragments in coded_fragments:
+            for node, pieces in node_pieces.items():
+                send_pieces(send_task_socket, dispatcher, operation, node, pieces)
+                if sent is not None:
+                    sent.update((task.filename, node) for task, _ in pieces)
+                pending += 1
+                unacknowledged += len(pieces)
+
+            while pending > messages_per_window * (WINDOWS_IN_FLIGHT - 1):
+                unacknowledged -= wait_for_ack(operation)
+                pending -= 1
+
+        while pending > 0:
+            unacknowledged -= wait_for_ack(operation)
+            pending -= 1
+
+    check_stored(unacknowledged)
+    return fragment_meta, fragment_nodes, matrix, fragment_checksums, stripe_checksums
+
+
+# Send a fragment request only to the storage nodes recorded as holding the fragment, and
+# fall back to broadcasting it to every storage node when there is no placement metadata
+def send_fragment_request(header, task, nodes, data_req_socket, broadcast_socket):
+    frames = [header.SerializeToString(), task.SerializeToString()]
+
+    if not nodes:
+        broadcast_socket.send_multipart(frames)
+        return
+
+    for node in nodes:
+        try:
+            data_req_socket.send_multipart([node_identity(node)] + frames)
+        except zmq.ZMQError as e:
+            print(f"Storage node {node} not reachable: {e}")
+
+
+# Leave out the storage nodes that are down, and the fragments that are only on such nodes.
+# Fragments without placement metadata are kept, since they are looked for on every storage node
+def live_fragments(coded_fragments, fragment_nodes, alive):
+    live_nodes = {name: [node for node in nodes if alive(node)] for name, nodes in fragment_nodes.items()}
+    names = [name for name in coded_fragments if live_nodes.get(name) or not fragment_nodes.get(name)]
+    return names, live_nodes
+
+# Ask every storage node which of the fragments of a file it holds, with one bulk status request per node.
+# Returns (header, task, nodes) for every request, where nodes is None for a request broadcast to every
+# storage node, for the fragments that have no placement metadata
+def status_requests(coded_fragments, fragment_nodes, request_id):
+    node_fragments = {}
+    unplaced = []
+    for name in coded_fragments:
+        nodes = fragment_nodes.get(name)
+        if not nodes:
+            unplaced.append(name)
+        for node in nodes or []:
+            node_fragments.setdefault(node, []).append(name)
+
+    requests = [(names, [node]) for node, names in node_fragments.items()]
+    if unplaced:
+        requests.append((unplaced, None))
+
+    for names, nodes in requests:
         header = messages_pb2.header()
-        header.request_type = messages_pb2.FRAGMENT_STATUS_REQ
-        task = messages_pb2.Fragment_Status_Request()
-        task.fragment_name = fragments
-        data_req_socket.send_multipart([
-            header.SerializeToString(), 
-            task.SerializeToString()
-        ])
+        header.request_type = messages_pb2.FRAGMENT_STATUS_BULK_REQ
+        header.request_id = request_id
+        task = messages_pb2.Fragment_Status_Bulk_Request()
+        task.fragment_names.extend(names)
+        task.request_id = request_id
+        yield header, task, nodes
+
+# Returns the fragments a status reply reports as present, as (fragment name, storage node id) pairs
+def present_fragments(header, msg):
+    if header.request_type == messages_pb2.FRAGMENT_STATUS_BULK_REQ:
+        response_status = messages_pb2.Fragment_Status_Bulk_Response()
+        response_status.ParseFromString(msg[0].bytes)
+        return [(name, response_status.node_id) for name in response_status.present]
+
+    if header.request_type == messages_pb2.FRAGMENT_STATUS_REQ:
+        response_status = messages_pb2.Fragment_Status_Response()
+        response_status.ParseFromString(msg[0].bytes)
+        if response_status.is_present:
+            return [(response_status.fragment_name, response_status.node_id)]
+
+    return []
+
+
+# Header and GetData message of a request for the data of a fragment, or for length bytes of it at offset
+def data_request(name, request_id, offset = 0, length = None):
+    header = messages_pb2.header()
+    header.request_type = messages_pb2.FRAGMENT_DATA_REQ
+    header.request_id = request_id
+    task = messages_pb2.GetData()
+    task.filename = name
+    task.request_id = request_id
+    task.offset = offset
+    if length is not None:
+        task.length = length
+    return header, task
+
+
+class FragmentRequests:
+    """
+        Picks the fragments a download fetches. k fragments are requested first, each from one of the storage
+        nodes that reported it as present. A fragment whose data does not match its checksum, or that its
+        storage node found corrupt, is requested from another node that holds it, or replaced by another
+        fragment, so a corrupt fragment costs one more request instead of the download. So is a fragment
+        whose storage node did not answer in time. Status replies that arrive after the first k fragments
+        were found add more nodes and fragments to pick from.
+
+        available_fragments maps fragment names to the storage nodes that hold them, and checksums maps
+        fragment names to their CRC32, or None for fragments stored before checksums. Storage nodes in
+        slow_nodes timed out before, so they are only asked when no other node holds a fragment.
+    """
+    def __init__(self, available_fragments, checksums, k, slow_nodes = ()):
+        self.nodes = {
+            name: sorted(nodes, key = lambda node: node in slow_nodes)
+            for name, nodes in sorted(available_fragments.items(), key = lambda item: all(node in slow_nodes for node in item[1]))
+        }
+        self.checksums = checksums
+        self.k = k
+        self.unused = list(self.nodes)[k:]
+        # fragment name -> storage node it was requested from
+        self.pending = {}
+        # (fragment name, storage node) pairs that were requested already
+        self.tried = set()
+        # Fragments that turned out corrupt or timed out and still have to be replaced
+        self.failed = []
+        # Storage nodes that did not answer a request in time
+        self.timed_out_nodes = set()
+        self.symbols = {}
+
+    # Returns (fragment name, storage node) of the first k requests
+    def start(self):
+        return [self.request(name) for name in list(self.nodes)[:self.k]]
+
+    def complete(self):
+        return len(self.symbols) == self.k
+
+    def request(self, name):
+        node = self.nodes[name].pop(0)
+        self.pending[name] = node
+        self.tried.add((name, node))
+        return name, node
+
+    # Add (fragment name, storage node) pairs that were reported as present. Returns the requests to send next
+    def add_present(self, fragments):
+        for name, node in fragments:
+            if name not in self.nodes:
+                self.nodes[name] = []
+                self.unused.append(name)
+            if (name, node) not in self.tried and node not in self.nodes[name]:
+                self.nodes[name].append(node)
+        return self.replace_failed()
+
+    # Give up on the requests to the storage nodes in nodes, or on every request when nodes is None, because
+    # they were not answered in time. Returns the requests that replace them
+    def timed_out(self, nodes = None):
+        for name, node in list(self.pending.items()):
+            if nodes is None or node in nodes:
+                print(f"Timed out waiting for fragment {name} from storage node {node}")
+                del self.pending[name]
+                self.timed_out_nodes.add(node)
+                self.failed.append(name)
+        return self.replace_failed()
+
+    # Handle a reply. Returns the (fragment name, storage node) requests to send next
+    def receive(self, header, msg):
+        if header.request_type != messages_pb2.FRAGMENT_DATA_REQ:
+            return self.add_present(present_fragments(header, msg))
+
+        name = msg[0].bytes.decode("utf-8")
+        node = self.pending.pop(name, None)
+        if node is None:
+            return []
+
+        # The fragment data is handed to the decoder as a view of the zmq frame it was received in
+        if len(msg) >= 2:
+            checksum = self.checksums.get(name)
+            if checksum is None or zlib.crc32(msg[1].buffer) == checksum:
+                self.symbols[name] = {"chunkname": name, "data": msg[1].buffer}
+                return []
+
+        print(f"Fragment {name} from storage node {node} is corrupt")
+        self.failed.append(name)
+        return self.replace_failed()
 
-    poller = zmq.Poller()
-    poller.register(response_socket, zmq.POLLIN)
+    # Request a healthy copy of every failed fragment from another storage node, or another fragment instead
+    def replace_failed(self):
+        requests = []
+        for name in list(self.failed):
+            if self.nodes[name]:
+                requests.append(self.request(name))
+            elif self.unused:
+                requests.append(self.request(self.unused.pop(0)))
+            else:
+                continue
+            self.failed.remove(name)
+        return requests
 
+
+# Find the fragments of a file on the storage nodes that hold them. Returns fragment name -> ids of the
+# storage nodes that reported the fragment as present, with at least k fragments
+def find_fragments(coded_fragments, fragment_nodes, data_req_socket, broadcast_socket, operation, k):
+    coded_fragments, fragment_nodes = live_fragments(coded_fragments, fragment_nodes, operation.dispatcher.membership.alive)
+    if len(coded_fragments) < k:
+        raise Exception("Not enough fragments on storage nodes that are up to reconstruct the file")
+    
+    available_fragments = {}
+    requests = list(status_requests(coded_fragments, fragment_nodes, operation.request_id))
+    for header, task, nodes in requests:
+        send_fragment_request(header, task, nodes, data_req_socket, broadcast_socket)
+
+    # Every storage node that was asked answers once, so we stop waiting when all of them did.
+    # How many nodes answer a broadcast is not known, so then we wait for k fragments or the timeout
+    unanswered = len(requests) if all(nodes for _, _, nodes in requests) else None
     start_time = time.time()
 
-    while len(available_fragments) < k and time.time() - start_time < 3:
-        socks = dict(poller.poll(500))
-        if response_socket in socks: 
-            response_status = messages_pb2.Fragment_Status_Response()
-            response_status.ParseFromString(response_socket.recv())
-            if response_status.is_present:
-                available_fragments.append(response_status.fragment_name)
+    while len(available_fragments) < k and unanswered != 0 and time.time() - start_time < 3:
+        reply = operation.recv(timeout = 0.5)
+        if reply is not None: 
+            if unanswered is not None:
+                unanswered -= 1
+            add_present_fragments(reply, available_fragments)
         
     if len(available_fragments) < k:
         raise Exception("Not enough fragments to reconstruct the file")
-    
 
-    fragnames = available_fragments[:k]
+    return available_fragments
 
-    for name in fragnames:
-        header = messages_pb2.header()
-        header.request_type = messages_pb2.FRAGMENT_DATA_REQ
-        task = messages_pb2.GetData()
-        task.filename = name
-
-        data_req_socket.send_multipart([
-            header.SerializeToString(), 
-            task.SerializeToString()
-        ])
-    
-    symbols = []
+def add_present_fragments(reply, available_fragments):
+    present = present_fragments(*reply)
+    for name, node in present:
+        available_fragments.setdefault(name, []).append(node)
+    return present
 
-    while len(symbols) < len(fragnames):
-        msg = response_socket.recv_multipart()
-        if len(msg) < 3: 
-            continue
+# Add the status replies that arrived on the operation since it was last asked to available_fragments,
+# waiting up to timeout seconds for the first one, and return the (fragment name, storage node) pairs they
+# reported as present
+def late_fragments(operation, available_fragments, timeout = 0):
+    present = []
+    while (reply := operation.recv(timeout = timeout)) is not None:
+        present += add_present_fragments(reply, available_fragments)
+        timeout = 0
+    return present
 
-        header = messages_pb2.header()
-        header.ParseFromString(msg[0])
-        if header.request_type != messages_pb2.FRAGMENT_DATA_REQ:
-            continue
+# Ranges of the fragments a download fetches. Yields (length, symbol size, fragment range, checksums) for every
+# stripe, where fragment range is the (offset, length) of the symbols of the stripe in the fragments, and checksums
+# maps fragment names to the CRC32 of that range. A file that is one stripe is fetched as whole fragments, which
+# the storage nodes verify too, so its fragment range is None and its checksums are those of the fragments
+def stripe_fetches(file_size, k, stripe_size, fragment_checksums, stripe_checksums):
+    if not stripe_size or file_size <= stripe_size:
+        for _, length, _, symbol_size in stripe_layout(file_size, k, None):
+            yield length, symbol_size, None, fragment_checksums
+        return
+
+    for i, (_, length, fragment_offset, symbol_size) in enumerate(stripe_layout(file_size, k, stripe_size)):
+        checksums = {
+            name: checksums[i] if checksums is not None else None
+            for name, checksums in stripe_checksums.items()
+        }
+        yield length, symbol_size, (fragment_offset, symbol_size), checksums
+
+
+class StripeFetch:
+    """
+        Fetches the symbols of one stripe of a download from k fragments. Every stripe has an operation
+        of its own, so the replies for the stripes that are fetched at the same time do not mix.
+    """
+    def __init__(self, operation, stripe, available_fragments, k, slow_nodes = ()):
+        self.operation = operation
+        self.length, self.symbol_size, self.fragment_range, checksums = stripe
+        self.requests = FragmentRequests(available_fragments, checksums, k, slow_nodes)
+
+    # Header and GetData message of the request for the symbol of this stripe in fragment name
+    def request(self, name):
+        if self.fragment_range is None:
+            return data_request(name, self.operation.request_id)
+        return data_request(name, self.operation.request_id, *self.fragment_range)
+
+    def symbols(self):
+        return list(self.requests.symbols.values())
 
-        symbols.append({
-            "chunkname": msg[1].decode("utf-8"), "data": bytearray(msg[2])
-        })
-    
-    print("All fragments received")
 
-    symbol_size = len(symbols[0]["data"])
+# Open the operation of a stripe and request its symbols from k fragments, leaving out the slow nodes if possible
+def start_stripe(stripe, available_fragments, dispatcher, data_req_socket, broadcast_socket, k, slow_nodes):
+    fetch = StripeFetch(dispatcher.open(), stripe, available_fragments, k, slow_nodes)
+    send_stripe_requests(fetch, fetch.requests.start(), data_req_socket, broadcast_socket)
+    return fetch
+
+def send_stripe_requests(fetch, to_send, data_req_socket, broadcast_socket):
+    for name, node in to_send:
+        send_fragment_request(*fetch.request(name), [node], data_req_socket, broadcast_socket)
+
+# Wait for the symbols of a stripe, and request a healthy copy or another fragment for every corrupt one.
+# A symbol that is not sent in time is requested from another storage node or fragment the same way, with the
+# fragments found by status replies that arrived since (from spares(timeout)), and its storage node is added to
+# slow_nodes. Requests to storage nodes that are in slow_nodes already are replaced without waiting for them.
+# The download only fails when fewer than k fragments are left to ask for, and no status reply reports more
+def finish_stripe(fetch, data_req_socket, broadcast_socket, spares, slow_nodes):
+    try:
+        to_send = fetch.requests.timed_out(slow_nodes)
+        while True:
+            send_stripe_requests(fetch, to_send, data_req_socket, broadcast_socket)
+            if fetch.requests.complete():
+                return
+            if not fetch.requests.pending:
+                to_send = fetch.requests.add_present(spares(3))
+                if not to_send:
+                    raise Exception("Not enough healthy fragments to reconstruct the file")
+                continue
+            reply = fetch.operation.recv(timeout = 3)
+            if reply is not None:
+                to_send = fetch.requests.receive(*reply)
+                continue
+            fetch.requests.add_present(spares())
+            to_send = fetch.requests.timed_out()
+            slow_nodes.update(fetch.requests.timed_out_nodes)
+    finally:
+        fetch.operation.close()
+
+
+"""
+    Retrieve and reconstruct a file from its available fragments
+
+    This is a generator that yields the decoded file in pieces of STREAM_WINDOW bytes, so the
+    controller can stream it to the client. The file is fetched and decoded one stripe at a time:
+    the storage nodes send only the range of every fragment that holds the symbols of a stripe,
+    and at most STRIPES_IN_FLIGHT stripes are being fetched while at most STRIPES_IN_FLIGHT more are
+    decoded on the coding pool, so memory is bounded by the stripe size instead of the file size.
+    Status replies that arrive after the first k fragments were found are used for later stripes, and
+    as spares for the symbols of a stripe that a storage node does not send in time. Storage nodes that
+    timed out are only asked for later stripes when no other node holds a fragment.
+"""
+def get_file(coded_fragments, fragment_meta, fragment_nodes, fragment_checksums, matrix, file_size, data_req_socket, broadcast_socket, dispatcher, k, l,
+             stripe_size = None, stripe_checksums = None):
+    fetching = deque()
+    decoding = deque()
+    slow_nodes = set()
+
+    with dispatcher.open() as operation:
+        available_fragments = find_fragments(coded_fragments, fragment_nodes, data_req_socket, broadcast_socket, operation, k)
+        spares = lambda timeout = 0: late_fragments(operation, available_fragments, timeout)
+        sockets = data_req_socket, broadcast_socket
+        try:
+            for stripe in stripe_fetches(file_size, k, stripe_size, fragment_checksums, stripe_checksums or {}):
+                spares()
+                fetching.append(start_stripe(stripe, available_fragments, dispatcher, *sockets, k, slow_nodes))
+                yield from decoded_pieces(fetching, decoding, fragment_meta, matrix, k, STRIPES_IN_FLIGHT - 1, sockets, spares, slow_nodes)
+            yield from decoded_pieces(fetching, decoding, fragment_meta, matrix, k, 0, sockets, spares, slow_nodes)
+        finally:
+            for fetch in fetching:
+                fetch.operation.close()
+
+# Decode fetched stripes on the coding pool until at most pending stripes are still being fetched and
+# decoded, and yield the decoded stripes that are first in the file in pieces of STREAM_WINDOW bytes
+def decoded_pieces(fetching, decoding, fragment_meta, matrix, k, pending, sockets, spares, slow_nodes):
+    while len(fetching) > pending or len(decoding) > pending:
+        if len(fetching) > pending:
+            fetch = fetching.popleft()
+            finish_stripe(fetch, *sockets, spares, slow_nodes)
+            decoding.append(coding_pool.submit(
+                decode_stripe, fetch.symbols(), fragment_meta, matrix, k, fetch.length, fetch.symbol_size
+            ))
+        if len(decoding) > pending:
+            data_out = decoding.popleft().result()
+            for offset in range(0, len(data_out), STREAM_WINDOW):
+                yield bytes(data_out[offset:offset + STREAM_WINDOW])
+
+
+# Decode one stripe from its symbols in k fragments. Returns a view of the decoded stripe without its padding
+def decode_stripe(symbols, fragment_meta, matrix, k, length, symbol_size):
     field = pyerasure.finite_field.Binary8()
     decoder = pyerasure.Decoder(
         field = field, 
@@ -148,6 +693,46 @@ def get_file(coded_fragments, fragment_meta, matrix, file_size, data_req_socket,
         decoder.decode_symbol(i["data"], bytearray(coeffx[:k]))
     
     assert decoder.is_complete()
-    data_out = bytearray(decoder.block_data())
-    return data_out[:file_size]
+    return memoryview(decoder.block_data())[:length]
+
+
+def delete_request(names, request_id):
+    header = messages_pb2.header()
+    header.request_type = messages_pb2.DELETE_REQ
+    header.request_id = request_id
+    task = messages_pb2.DeleteBatch()
+    task.filenames.extend(names)
+    task.request_id = request_id
+    return header, task
+
+# Ask a storage node to delete fragments. Returns the names of the fragments it reports as deleted
+def delete_on_node(send_task_socket, dispatcher, node, names):
+    with dispatcher.open() as operation:
+        header, task = delete_request(names, operation.request_id)
+        try:
+            send_task_socket.send_multipart([node_identity(node), header.SerializeToString(), task.SerializeToString()])
+        except zmq.ZMQError as e:
+            print(f"Storage node {node} not reachable: {e}")
+            return []
+        reply = operation.recv(timeout = DELETE_TIMEOUT)
+
+    if reply is None:
+        print(f"Storage node {node} did not confirm deleting {len(names)} fragments")
+        return []
+    _, resp = reply
+    return [frame.bytes.decode('utf-8') for frame in resp]
 
+# Background thread of the controller that deletes the fragments in the deleted_fragment table from the
+# storage nodes, with one DeleteBatch per storage node and round. Fragments on storage nodes that are down
+# stay queued until the node is back, and a fragment is forgotten once its storage node reports it deleted
+def reclaim_space(db_path, send_task_socket, dispatcher):
+    db = sqlite3.connect(db_path)
+    while True:
+        time.sleep(RECLAIM_INTERVAL)
+        try:
+            for node, names in deleted_fragments(db, dispatcher.membership.alive, DELETE_BATCH).items():
+                forget_deleted(db, node, delete_on_node(send_task_socket, dispatcher, node, names))
+                db.commit()
+        except sqlite3.Error as e:
+            db.rollback()
+            print(f"Error reclaiming deleted fragments: {e}")
@@ -5,6 +5,7 @@ import time
 import random
 import threading
 import sqlite3
+from database import init_db
 
 PYTHON = sys.executable
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -14,18 +15,18 @@ NUM_NODES = 24
 master_process = None
 storage_processes = {}  # node_id -> process
 
-# After each restart, re-initialize the database and storage nodes
-def init_storage_nodes(db_path, N):
+# After each restart, re-initialize the database. The storage nodes add themselves to the
+# storage_node table with their first heartbeat, and the controller keeps their status up to date.
+# Fragments that were queued for deletion belong to the files of the last run, so they are forgotten too
+def init_storage_nodes(db_path):
+    init_db()
     conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
 
     cursor.execute('DELETE FROM file')
     cursor.execute('DELETE FROM file_fragment')
+    cursor.execute('DELETE FROM deleted_fragment')
     cursor.execute('DELETE FROM storage_node')
-    cursor.executemany(
-        "INSERT INTO storage_node (id, status) VALUES (?, ?)",
-        [(i+1, 1) for i in range(N)]
-    )
     conn.commit()
     conn.close()
 
@@ -44,7 +45,7 @@ def start_storage_nodes():
         data_dir = f"node{node_id}"
         print(f"Starting storage node {node_id} ({data_dir})")
         p = subprocess.Popen(
-            [PYTHON, "storage_node.py", data_dir],
+            [PYTHON, "storage_node.py", data_dir, str(node_id)],
             cwd=BASE_DIR
         )
         storage_processes[node_id] = p
@@ -107,7 +108,7 @@ def shutdown():
 
 if __name__ == "__main__":
     try:
-        init_storage_nodes("database.db", NUM_NODES)
+        init_storage_nodes("database.db")
         start_master()
         time.sleep(2)
         start_storage_nodes()
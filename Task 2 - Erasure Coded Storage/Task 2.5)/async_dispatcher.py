@@ -0,0 +1,162 @@
+import asyncio
+import itertools
+from collections import defaultdict
+
+import zmq
+import messages_pb2
+from dispatcher import DEFAULT_NODE_WINDOW
+from membership import Membership
+
+# asyncio version of dispatcher.py for the asyncio controller. The PULL socket that all storage
+# nodes reply on is read by one task on the event loop, which hands each reply to the operation
+# with the request_id in the reply header. Waiting for a reply only suspends the coroutine that
+# waits, so any number of uploads and downloads can wait for storage nodes at the same time.
+
+class AsyncOperation:
+    """
+        An upload or download waiting for replies from the storage nodes.
+        Use it as a context manager so it stops receiving replies when the request is done.
+    """
+    def __init__(self, dispatcher, request_id):
+        self.dispatcher = dispatcher
+        self.request_id = request_id
+        self.replies = asyncio.Queue()
+
+    async def recv(self, timeout = None):
+        """
+            Wait for the next reply to this operation. Returns a (header, frames) tuple where frames
+            are the zmq.Frame objects after the header, or None if no reply arrived within timeout seconds.
+        """
+        try:
+            return await asyncio.wait_for(self.replies.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self.dispatcher.close(self.request_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncFlowControl:
+    """
+        Credit-based flow control for the store messages sent to each storage node, like
+        dispatcher.FlowControl, but acquire() suspends the upload instead of blocking a thread.
+    """
+    def __init__(self, default_window = DEFAULT_NODE_WINDOW):
+        self.default_window = default_window
+        self.windows = {}
+        self.in_flight = defaultdict(int)
+        self.condition = asyncio.Condition()
+
+    def window(self, node_id):
+        return self.windows.get(str(node_id), self.default_window)
+
+    async def acquire(self, node_id, timeout = None):
+        """
+            Take a credit to send a store message to a storage node, waiting up to timeout seconds
+            for one to be given back. Raises TimeoutError if the node has no credit left by then.
+        """
+        node_id = str(node_id)
+        async with self.condition:
+            try:
+                await asyncio.wait_for(
+                    self.condition.wait_for(lambda: self.in_flight[node_id] < self.window(node_id)), timeout
+                )
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"Storage node {node_id} has {self.in_flight[node_id]} unacknowledged messages")
+            self.in_flight[node_id] += 1
+
+    async def release(self, node_id, window = 0):
+        """
+            Give back the credit of an acknowledged store message, or of one that could not be sent.
+            window is the window the node advertised in its acknowledgement, if any.
+        """
+        node_id = str(node_id)
+        async with self.condition:
+            self.in_flight[node_id] = max(0, self.in_flight[node_id] - 1)
+            if window:
+                self.windows[node_id] = window
+            self.condition.notify_all()
+
+    async def reset(self, node_id, window):
+        """
+            A storage node that (re)starts has lost the messages sent to its previous run,
+            so it starts over with a full window
+        """
+        node_id = str(node_id)
+        async with self.condition:
+            self.in_flight[node_id] = 0
+            self.windows[node_id] = window or self.default_window
+            self.condition.notify_all()
+
+    def queue_depths(self):
+        """
+            Number of unacknowledged store messages and the window of every storage node
+        """
+        return {
+            node_id: {'queued': self.in_flight[node_id], 'window': self.window(node_id)}
+            for node_id in set(self.in_flight) | set(self.windows)
+        }
+
+
+class AsyncReplyDispatcher:
+    """
+        Reads the replies of the storage nodes from a zmq.asyncio PULL socket.
+        Call start() from the event loop before opening operations.
+    """
+    def __init__(self, context, address):
+        self.socket_pull = context.socket(zmq.PULL)
+        self.socket_pull.bind(address)
+        self.request_ids = itertools.count(1)
+        self.operations = {}
+        self.flow_control = None
+        self.membership = Membership()
+        self.task = None
+
+    def start(self):
+        # asyncio primitives belong to the event loop they are created on
+        self.flow_control = AsyncFlowControl()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def open(self):
+        operation = AsyncOperation(self, next(self.request_ids))
+        self.operations[operation.request_id] = operation
+        return operation
+
+    def close(self, request_id):
+        self.operations.pop(request_id, None)
+
+    async def run(self):
+        while True:
+            message = await self.socket_pull.recv_multipart(copy = False)
+            header = messages_pb2.header()
+            header.ParseFromString(message[0].bytes)
+
+            # Storage nodes announce their window when they start, and set their node_id and window
+            # on store acknowledgements, which give back the credit even if nobody waits for them anymore.
+            # Heartbeats only update the membership view
+            if header.request_type == messages_pb2.NODE_READY:
+                await self.flow_control.reset(header.node_id, header.window)
+                self.membership.heartbeat(header.node_id)
+                continue
+            if header.request_type == messages_pb2.HEARTBEAT:
+                heartbeat = messages_pb2.Heartbeat()
+                heartbeat.ParseFromString(message[1].bytes)
+                self.membership.heartbeat(heartbeat.node_id, heartbeat.free_bytes, heartbeat.queue_depth)
+                continue
+            if header.node_id:
+                await self.flow_control.release(header.node_id, header.window)
+
+            operation = self.operations.get(header.request_id)
+
+            # Late replies, e.g. from a replica that was asked after a timeout, have nobody waiting for them
+            if operation is None:
+                print(f"Discarding reply for request {header.request_id} that is no longer waiting")
+                continue
+
+            operation.replies.put_nowait((header, message[1:]))
@@ -0,0 +1,563 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import zmq
+import zmq.asyncio
+import pyerasure.finite_field
+from aiohttp import web
+
+import messages_pb2
+from Reed_Solomon import (
+    CODING_WORKERS, DELETE_BATCH, DELETE_TIMEOUT, RECLAIM_INTERVAL, STORE_TIMEOUT, STREAM_WINDOW, STRIPE_SIZE, STRIPES_IN_FLIGHT,
+    WINDOWS_IN_FLIGHT, StripeFetch, add_present_fragments, check_stored, compress_upload, decode_stripe, delete_request,
+    durability_level, encode_window, live_fragments, node_identity, pack_checksums, place_fragments, rs_cauchy_coeffs,
+    status_requests, store_task, stripe_fetches, stripe_size_for, stripe_windows, unpack_checksums
+)
+from async_dispatcher import AsyncReplyDispatcher
+from compression import get_codec
+from database import abandon_fragments, deleted_fragments, forget_deleted, init_db, insert_file, release_file
+from placement import placement_strategy
+
+# Alternative to rest_node_placement.py that serves the same REST API from one asyncio event loop.
+# Waiting for storage nodes only suspends a coroutine instead of holding a request thread, so
+# thousands of fragment requests can be in flight at once. Encoding, decoding, decompression and
+# file reads run in an executor, so they overlap with the network waits of other requests.
+# Run it instead of rest_node_placement.py: python async_rest_node_placement.py
+
+logging.basicConfig(
+    level = logging.INFO,
+    format="%(asctime)s - [%(levelname)s] - %(message)s"
+)
+
+# Seconds to wait for storage nodes to report the fragments they hold, and to send fragment data
+FRAGMENT_TIMEOUT = 3
+
+#-----------------ZMQ Setup-----------------#
+context = zmq.asyncio.Context()
+
+# The sockets are only used from the event loop, so unlike in rest_node_placement.py they need no lock
+socket_router = context.socket(zmq.ROUTER)
+socket_router.setsockopt(zmq.ROUTER_MANDATORY, 1)
+# A storage node that restarts connects with the same routing id, and ROUTER_HANDOVER gives it
+# the id of its dead connection instead of leaving the node unreachable
+socket_router.setsockopt(zmq.ROUTER_HANDOVER, 1)
+socket_router.bind("tcp://*:5557")
+
+dispatcher = AsyncReplyDispatcher(context, "tcp://*:5558")
+
+socket_pub = context.socket(zmq.PUB)
+socket_pub.bind("tcp://*:5559")
+
+executor = ThreadPoolExecutor(max_workers = CODING_WORKERS)
+
+# Run a blocking function in the coding executor without blocking the event loop
+def run_blocking(function, *args):
+    return asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+#-----------------Database-----------------#
+
+# sqlite calls are short, but they still block, so they run in the default executor
+# with a connection of their own
+def query(sql, params = (), one = False):
+    db = sqlite3.connect("database.db", detect_types = sqlite3.PARSE_DECLTYPES)
+    db.row_factory = sqlite3.Row
+    try:
+        cursor = db.execute(sql, params)
+        rows = [dict(row) for row in cursor.fetchall()]
+    finally:
+        db.close()
+    if one:
+        return rows[0] if rows else None
+    return rows
+
+def run_query(*args, **kwargs):
+    return asyncio.get_running_loop().run_in_executor(None, lambda: query(*args, **kwargs))
+
+# Run a function of database.py with a connection of its own in the default executor, and commit
+def run_with_db(function, *args):
+    def run():
+        db = sqlite3.connect("database.db")
+        try:
+            result = function(db, *args)
+            db.commit()
+        finally:
+            db.close()
+        return result
+    return asyncio.get_running_loop().run_in_executor(None, run)
+
+#-----------------Erasure Coding-----------------#
+
+# Returns the number of pieces a storage node acknowledged, like Reed_Solomon.wait_for_ack
+async def wait_for_ack(operation):
+    reply = await operation.recv(timeout = STORE_TIMEOUT)
+    if reply is None:
+        raise TimeoutError("Timed out waiting for storage nodes to store the fragments")
+    _, resp = reply
+    print("Received fragments %s" % ', '.join(frame.bytes.decode('utf-8') for frame in resp))
+    return len(resp)
+
+# Send fragment pieces to a storage node once it has credit for them, like Reed_Solomon.send_pieces
+async def send_pieces(operation, node, pieces):
+    header = messages_pb2.header()
+    header.request_id = operation.request_id
+    if len(pieces) == 1:
+        header.request_type = messages_pb2.STORE_FRAGMENT_DATA_REQ
+        task, symbol = pieces[0]
+        frames = [task.SerializeToString(), symbol]
+    else:
+        header.request_type = messages_pb2.STORE_BATCH_REQ
+        batch = messages_pb2.StoreBatch()
+        batch.request_id = operation.request_id
+        batch.fragments.extend(task for task, _ in pieces)
+        frames = [batch.SerializeToString()] + [symbol for _, symbol in pieces]
+
+    await dispatcher.flow_control.acquire(node, timeout = STORE_TIMEOUT)
+    try:
+        await socket_router.send_multipart([node_identity(node), header.SerializeToString()] + frames, copy = False)
+    except zmq.ZMQError:
+        await dispatcher.flow_control.release(node)
+        raise
+
+"""
+    Store a file the same way as Reed_Solomon.store_file. The next window is encoded in the
+    executor while the storage nodes are still storing the windows that were sent before it.
+"""
+async def store_file(file_stream, file_size, k, l, storage_nodes_count, select_nodes, durability = messages_pb2.DURABILITY_NONE,
+                     stripe_size = None, sent = None):
+    c = k + l
+
+    assert c >= 0
+
+    assert c <= storage_nodes_count
+
+    symbols = k
+    field = pyerasure.finite_field.Binary8()
+    matrix = rs_cauchy_coeffs(k, l)
+    fragment_names, fragment_meta, fragment_nodes = place_fragments(c, select_nodes)
+    fragment_checksums = dict.fromkeys(fragment_names, 0)
+    stripe_checksums = {name: [] for name in fragment_names}
+
+    # The pieces of a window that go to the same storage node are sent in one message
+    messages_per_window = len({node for nodes in fragment_nodes.values() for node in nodes})
+    pending = 0
+    unacknowledged = 0
+
+    with dispatcher.open() as operation:
+        for stripe_start, offset, fragment_offset, symbol_size in stripe_windows(file_size, k, stripe_size):
+            encoded = await run_blocking(
+                encode_window, file_stream, file_size, symbol_size, offset, matrix, symbols, field, stripe_start
+            )
+
+            # storage node -> pieces of this window for the node
+            node_pieces = {}
+
+            for name, symbol in zip(fragment_names, encoded):
+                task = store_task(name, operation.request_id, fragment_offset + offset, symbol, durability)
+                fragment_checksums[name] = zlib.crc32(symbol, fragment_checksums[name])
+                if offset == 0:
+                    stripe_checksums[name].append(0)
+                stripe_checksums[name][-1] = zlib.crc32(symbol, stripe_checksums[name][-1])
+
+                for node in fragment_nodes[name]:
+                    node_pieces.setdefault(node, []).append((task, symbol))
+
+            for node, pieces in node_pieces.items():
+                await send_pieces(operation, node, pieces)
+                if sent is not None:
+                    sent.update((task.filename, node) for task, _ in pieces)
+                pending += 1
+                unacknowledged += len(pieces)
+
+            while pending > messages_per_window * (WINDOWS_IN_FLIGHT - 1):
+                unacknowledged -= await wait_for_ack(operation)
+                pending -= 1
+
+        while pending > 0:
+            unacknowledged -= await wait_for_ack(operation)
+            pending -= 1
+
+    check_stored(unacknowledged)
+    return fragment_meta, fragment_nodes, matrix, fragment_checksums, stripe_checksums
+
+
+# Send a fragment request to the storage nodes that hold the fragment, or to every storage node
+# when there is no placement metadata
+async def send_fragment_request(header, task, nodes):
+    frames = [header.SerializeToString(), task.SerializeToString()]
+
+    if not nodes:
+        await socket_pub.send_multipart(frames)
+        return
+
+    for node in nodes:
+        try:
+            await socket_router.send_multipart([node_identity(node)] + frames)
+        except zmq.ZMQError as e:
+            print(f"Storage node {node} not reachable: {e}")
+
+
+# Find the fragments of a file, like Reed_Solomon.find_fragments
+async def find_fragments(coded_fragments, fragment_nodes, operation, k):
+    coded_fragments, fragment_nodes = live_fragments(coded_fragments, fragment_nodes, dispatcher.membership.alive)
+    if len(coded_fragments) < k:
+        raise Exception("Not enough fragments on storage nodes that are up to reconstruct the file")
+
+    available_fragments = {}
+    requests = list(status_requests(coded_fragments, fragment_nodes, operation.request_id))
+    for header, task, nodes in requests:
+        await send_fragment_request(header, task, nodes)
+
+    # Stop waiting once every storage node that was asked has answered, unless a request was broadcast
+    unanswered = len(requests) if all(nodes for _, _, nodes in requests) else None
+    deadline = time.time() + FRAGMENT_TIMEOUT
+
+    while len(available_fragments) < k and unanswered != 0 and time.time() < deadline:
+        reply = await operation.recv(timeout = deadline - time.time())
+        if reply is not None:
+            if unanswered is not None:
+                unanswered -= 1
+            add_present_fragments(reply, available_fragments)
+
+    if len(available_fragments) < k:
+        raise Exception("Not enough fragments to reconstruct the file")
+
+    return available_fragments
+
+# Open the operation of a stripe and request its symbols from k fragments, like Reed_Solomon.start_stripe
+async def start_stripe(stripe, available_fragments, k, slow_nodes):
+    fetch = StripeFetch(dispatcher.open(), stripe, available_fragments, k, slow_nodes)
+    await send_stripe_requests(fetch, fetch.requests.start())
+    return fetch
+
+async def send_stripe_requests(fetch, to_send):
+    for name, node in to_send:
+        await send_fragment_request(*fetch.request(name), [node])
+
+# Wait for the symbols of a stripe, and replace the corrupt ones and the ones that time out,
+# like Reed_Solomon.finish_stripe
+async def finish_stripe(fetch, spares, slow_nodes):
+    try:
+        to_send = fetch.requests.timed_out(slow_nodes)
+        while True:
+            await send_stripe_requests(fetch, to_send)
+            if fetch.requests.complete():
+                return
+            if not fetch.requests.pending:
+                to_send = fetch.requests.add_present(await spares(FRAGMENT_TIMEOUT))
+                if not to_send:
+                    raise Exception("Not enough healthy fragments to reconstruct the file")
+                continue
+            reply = await fetch.operation.recv(timeout = FRAGMENT_TIMEOUT)
+            if reply is not None:
+                to_send = fetch.requests.receive(*reply)
+                continue
+            fetch.requests.add_present(await spares())
+            to_send = fetch.requests.timed_out()
+            slow_nodes.update(fetch.requests.timed_out_nodes)
+    finally:
+        fetch.operation.close()
+
+# Add the status replies that arrived on the operation to available_fragments like Reed_Solomon.late_fragments
+async def late_fragments(operation, available_fragments, timeout = 0):
+    present = []
+    if timeout and operation.replies.empty():
+        reply = await operation.recv(timeout = timeout)
+        if reply is None:
+            return present
+        present += add_present_fragments(reply, available_fragments)
+    while not operation.replies.empty():
+        present += add_present_fragments(await operation.recv(), available_fragments)
+    return present
+
+# Decode fetched stripes in the executor like Reed_Solomon.decoded_pieces, and yield the decoded stripes
+async def decoded_stripes(fetching, decoding, fragment_meta, matrix, k, pending, spares, slow_nodes):
+    while len(fetching) > pending or len(decoding) > pending:
+        if len(fetching) > pending:
+            fetch = fetching.popleft()
+            await finish_stripe(fetch, spares, slow_nodes)
+            decoding.append(run_blocking(
+                decode_stripe, fetch.symbols(), fragment_meta, matrix, k, fetch.length, fetch.symbol_size
+            ))
+        if len(decoding) > pending:
+            yield await decoding.popleft()
+
+# Fetch and decode the stripes of a file like Reed_Solomon.get_file, and yield the decoded stripes in order
+async def decode_stripes(coded_fragments, fragment_meta, fragment_nodes, fragment_checksums, stripe_checksums, matrix, file_size, k, stripe_size):
+    fetching = deque()
+    decoding = deque()
+    slow_nodes = set()
+
+    with dispatcher.open() as operation:
+        available_fragments = await find_fragments(coded_fragments, fragment_nodes, operation, k)
+        spares = lambda timeout = 0: late_fragments(operation, available_fragments, timeout)
+        try:
+            for stripe in stripe_fetches(file_size, k, stripe_size, fragment_checksums, stripe_checksums):
+                # Status replies that arrive after the first k fragments were found are used for later stripes
+                await spares()
+                fetching.append(await start_stripe(stripe, available_fragments, k, slow_nodes))
+                async for data_out in decoded_stripes(fetching, decoding, fragment_meta, matrix, k, STRIPES_IN_FLIGHT - 1, spares, slow_nodes):
+                    yield data_out
+            async for data_out in decoded_stripes(fetching, decoding, fragment_meta, matrix, k, 0, spares, slow_nodes):
+                yield data_out
+        finally:
+            for fetch in fetching:
+                fetch.operation.close()
+
+#-----------------HTTP Handlers-----------------#
+
+routes = web.RouteTableDef()
+
+@routes.get('/files/{file_id:\\d+}')
+async def get_file_metadata(request):
+    file_id = int(request.match_info['file_id'])
+    f = await run_query('SELECT * FROM file where id = ?', [file_id], one = True)
+    if f is None:
+        return web.json_response({'message': f'File {file_id} not found'}, status = 404)
+
+    return web.json_response(f)
+
+@routes.get('/files/{file_id:\\d+}/fragments')
+async def get_file_fragments(request):
+    file_id = int(request.match_info['file_id'])
+    fragments = await run_query('SELECT * FROM file_fragment where file_id = ? order by fragment_index', [file_id])
+    for d in fragments:
+        d.pop('coefficients', None)
+        d.pop('stripe_checksums', None)
+
+    return web.json_response(fragments)
+
+
+# The file and its fragment rows are deleted right away, and the storage nodes delete
+# the fragments in the background
+@routes.delete('/files/{file_id:\\d+}')
+async def delete_file(request):
+    file_id = int(request.match_info['file_id'])
+    if not await run_with_db(release_file, file_id):
+        return web.json_response({'message': f'File {file_id} not found'}, status = 404)
+
+    return web.json_response({'message': f'File {file_id} deleted'})
+
+
+@routes.get('/files/{file_id:\\d+}/download')
+async def download_file(request):
+    start = time.time()
+    file_id = int(request.match_info['file_id'])
+    f = await run_query('SELECT * FROM file where id = ?', [file_id], one = True)
+    if f is None:
+        return web.json_response({'message': f'File {file_id} not found'}, status = 404)
+
+    print(f"Requested file metadata: {f}")
+
+    fragment_rows = await run_query(
+        'SELECT fragment_name, fragment_index, coefficients, checksum, stripe_checksums, storage_node_id FROM file_fragment WHERE file_id = ? ORDER BY fragment_index',
+        [file_id]
+    )
+    coded_fragments = []
+    fragment_meta = {}
+    fragment_nodes = {}
+    fragment_checksums = {}
+    stripe_checksums = {}
+    matrix = []
+
+    # Every replica of a fragment has its own row, so we also collect which storage nodes hold it
+    for row in fragment_rows:
+        name = row['fragment_name']
+        if name not in fragment_meta:
+            coded_fragments.append(name)
+            fragment_meta[name] = row['fragment_index']
+            fragment_nodes[name] = []
+            fragment_checksums[name] = row['checksum']
+            stripe_checksums[name] = unpack_checksums(row['stripe_checksums'])
+            matrix.append(bytearray(row['coefficients']))
+        if row['storage_node_id'] is not None:
+            fragment_nodes[name].append(row['storage_node_id'])
+
+    k = f['k_fragments']
+    file_size = f['stored_size'] if f['stored_size'] is not None else f['size']
+    stripes = decode_stripes(
+        coded_fragments, fragment_meta, fragment_nodes, fragment_checksums, stripe_checksums, matrix, file_size, k, f['stripe_size']
+    )
+    try:
+        # The first stripe is decoded before the response starts, so a file that cannot be decoded still gets an error status
+        try:
+            first_stripe = await anext(stripes, b'')
+        except Exception as e:
+            logging.error(f"Downloading file {file_id} failed: {e}")
+            return web.json_response({'message': 'Internal server error'}, status = 500)
+
+        # Compressed files are decompressed one stripe at a time in the executor as they are sent
+        decompressor = get_codec(f['compression']).decompressor() if f['compression'] else None
+
+        response = web.StreamResponse(headers = {'Content-Type': f['content_type']})
+        response.content_length = f['size']
+        await response.prepare(request)
+        data_out = first_stripe
+        while data_out is not None:
+            if decompressor is not None:
+                data_out = await run_blocking(decompressor.decompress, bytes(data_out))
+            for offset in range(0, len(data_out), STREAM_WINDOW):
+                await response.write(bytes(data_out[offset:offset + STREAM_WINDOW]))
+            data_out = await anext(stripes, None)
+        if hasattr(decompressor, 'flush'):
+            await response.write(decompressor.flush())
+        await response.write_eof()
+    finally:
+        # Closes the operations of the stripes that are still being fetched when the client went away
+        await stripes.aclose()
+
+    end = time.time()
+    download_time = end - start
+    logging.info(f"File {f['filename']} with id {file_id}, size {f['size']}, k {f['k_fragments']}, l {f['node_losses']} downloaded in {download_time:.2f} seconds")
+    return response
+
+
+@routes.get('/storage_nodes')
+async def get_storage_nodes(request):
+    return web.json_response(dispatcher.membership.view())
+
+
+@routes.get('/storage_nodes/queues')
+async def get_queue_depths(request):
+    return web.json_response(dispatcher.flow_control.queue_depths())
+
+
+@routes.post('/files')
+async def add_files(request):
+    start = time.time()
+
+    # aiohttp spools the uploaded file to a temporary file, and store_file reads it window by window
+    payload = await request.post()
+    k = int(payload.get('k'))
+    l = int(payload.get('l'))
+    replication_factor = int(payload.get('r'))
+    strategy = payload.get('fragment_strategy')
+    file = payload.get('file')
+
+    if not isinstance(file, web.FileField):
+        logging.error("No file was uploaded in the request")
+        return web.json_response({'message': 'No file uploaded'}, status = 400)
+
+    filename = file.filename
+    content_type = file.content_type
+    file_stream = file.file
+    file_stream.seek(0, os.SEEK_END)
+    size = file_stream.tell()
+    file_stream.seek(0)
+    c = k + l
+
+    # A compression codec can be chosen with the compression form field
+    compression = payload.get('compression')
+    stored_size = size
+    if compression:
+        try:
+            file_stream, stored_size, compression = await run_blocking(compress_upload, file_stream, size, compression)
+        except ValueError as e:
+            return web.json_response({'message': str(e)}, status = 400)
+
+    # How far the storage nodes write the fragments to disk before acknowledging them, with the durability form field
+    try:
+        durability = durability_level(payload.get('durability', 'none'))
+    except ValueError as e:
+        return web.json_response({'message': str(e)}, status = 400)
+
+    # Bytes per encoded stripe with the stripe_size form field, 0 encodes the file as one stripe
+    try:
+        stripe_size = stripe_size_for(payload.get('stripe_size', STRIPE_SIZE), k)
+    except ValueError as e:
+        return web.json_response({'message': str(e)}, status = 400)
+
+    storage_nodes = [
+        row['id'] for row in await run_query('SELECT id from storage_node where status = 1')
+        if dispatcher.membership.writable(row['id'])
+    ]
+    storage_nodes_count = len(storage_nodes)
+
+    # Fragments the storage nodes may have stored before the upload failed
+    sent = set()
+    try:
+        fragment_meta, fragment_nodes, matrix, fragment_checksums, stripe_checksums = await store_file(
+            file_stream = file_stream,
+            file_size = stored_size,
+            k = k,
+            l = l,
+            storage_nodes_count = storage_nodes_count,
+            select_nodes = lambda index: placement_strategy(strategy, replication_factor, index, storage_nodes),
+            durability = durability,
+            stripe_size = stripe_size,
+            sent = sent
+        )
+    except (zmq.ZMQError, IOError) as e:
+        await run_with_db(abandon_fragments, sent)
+        logging.error(f"Storing fragments failed: {e}")
+        return web.json_response({'message': f'Storing fragments failed: {e}'}, status = 503)
+
+    fragment_rows = [
+        (node, name, index, bytes(matrix[index]), fragment_checksums[name],
+         pack_checksums(stripe_checksums[name]) if stripe_size else None)
+        for name, index in fragment_meta.items()
+        for node in fragment_nodes[name]
+    ]
+    file_id = await run_with_db(
+        insert_file, (filename, size, content_type, k, l, c, compression, stored_size, stripe_size), fragment_rows
+    )
+
+    end = time.time()
+    ingest_time = end - start
+    logging.info(f"File {filename} ingested with id {file_id}, size {size}, N {storage_nodes_count}, k {k}, l {l}, strategy {strategy} in {ingest_time:.2f} seconds")
+
+    return web.json_response({'file_id': file_id}, status = 201)
+
+
+#-----------------Space Reclamation-----------------#
+
+# Ask a storage node to delete fragments, like Reed_Solomon.delete_on_node
+async def delete_on_node(node, names):
+    with dispatcher.open() as operation:
+        header, task = delete_request(names, operation.request_id)
+        try:
+            await socket_router.send_multipart([node_identity(node), header.SerializeToString(), task.SerializeToString()])
+        except zmq.ZMQError as e:
+            print(f"Storage node {node} not reachable: {e}")
+            return []
+        reply = await operation.recv(timeout = DELETE_TIMEOUT)
+
+    if reply is None:
+        print(f"Storage node {node} did not confirm deleting {len(names)} fragments")
+        return []
+    _, resp = reply
+    return [frame.bytes.decode('utf-8') for frame in resp]
+
+# Delete the fragments of deleted files from the storage nodes in the background, like Reed_Solomon.reclaim_space.
+# The storage nodes of a round are asked at the same time
+async def reclaim_space():
+    while True:
+        await asyncio.sleep(RECLAIM_INTERVAL)
+        try:
+            node_names = await run_with_db(deleted_fragments, dispatcher.membership.alive, DELETE_BATCH)
+            deleted = await asyncio.gather(*(delete_on_node(node, names) for node, names in node_names.items()))
+            for node, names in zip(node_names, deleted):
+                await run_with_db(forget_deleted, node, names)
+        except sqlite3.Error as e:
+            print(f"Error reclaiming deleted fragments: {e}")
+
+
+async def start_dispatcher(app):
+    dispatcher.start()
+    app['reclaimer'] = asyncio.create_task(reclaim_space())
+
+host_local_computer = "localhost"
+
+if __name__ == "__main__":
+    init_db()
+    dispatcher.membership.start_sync("database.db")
+    # client_max_size = 0 accepts uploads of any size, like the Flask controller
+    app = web.Application(client_max_size = 0)
+    app.add_routes(routes)
+    app.on_startup.append(start_dispatcher)
+    web.run_app(app, host = host_local_computer, port = 9000) # The base url is http://localhost:9000
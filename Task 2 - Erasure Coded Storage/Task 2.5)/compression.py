@@ -0,0 +1,146 @@
+import lzma
+import zlib
+
+# Optional compression of files before they are split into chunks or encoded into fragments.
+# The codec a file was stored with is recorded in the compression column of the file table,
+# and NULL means the file is stored as it was uploaded.
+
+# Files smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 4 * 1024
+
+# The start of a file is compressed as a sample before deciding to compress the whole file.
+# If the sample does not shrink to at most MAX_COMPRESS_RATIO of its size, the file is stored as is
+SAMPLE_SIZE = 64 * 1024
+MAX_COMPRESS_RATIO = 0.9
+
+
+class Codec:
+    """
+        A compression codec. compressor() and decompressor() return objects with the streaming
+        compress()/flush() and decompress() methods of zlib.compressobj and zlib.decompressobj,
+        so files can be compressed and decompressed one piece at a time.
+    """
+    def __init__(self, name, compressor, decompressor):
+        self.name = name
+        self.compressor = compressor
+        self.decompressor = decompressor
+
+    def compress(self, data):
+        compressor = self.compressor()
+        return compressor.compress(data) + compressor.flush()
+
+
+CODECS = {}
+
+def register_codec(codec):
+    CODECS[codec.name] = codec
+
+def get_codec(name):
+    if name not in CODECS:
+        raise ValueError(f"Unknown compression codec: {name}. Available codecs: {', '.join(sorted(CODECS))}")
+    return CODECS[name]
+
+register_codec(Codec('zlib', zlib.compressobj, zlib.decompressobj))
+register_codec(Codec('lzma', lzma.LZMACompressor, lzma.LZMADecompressor))
+
+
+# Decide from the start of a file if it should be compressed with codec
+def worth_compressing(codec, sample):
+    if len(sample) < MIN_COMPRESS_SIZE:
+        return False
+    return len(codec.compress(sample)) <= len(sample) * MAX_COMPRESS_RATIO
+
+
+class CompressedStream:
+    """
+        Read-only stream with the compressed contents of another stream, which is read
+        one piece at a time. size is the number of bytes read from the other stream so far.
+    """
+    def __init__(self, stream, codec, first_piece = b''):
+        self.stream = stream
+        self.compressor = codec.compressor()
+        self.buffer = bytearray()
+        self.size = 0
+        self.done = False
+        self.compress_piece(first_piece)
+
+    def compress_piece(self, piece):
+        self.size += len(piece)
+        self.buffer += self.compressor.compress(piece)
+
+    def read(self, n = -1):
+        while not self.done and (n < 0 or len(self.buffer) < n):
+            piece = self.stream.read(SAMPLE_SIZE)
+            if piece:
+                self.compress_piece(piece)
+            else:
+                self.buffer += self.compressor.flush()
+                self.done = True
+
+        n = len(self.buffer) if n < 0 else n
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+
+class PrefixedStream:
+    """
+        Stream that returns the bytes that were already read from another stream, then the rest of it
+    """
+    def __init__(self, stream, prefix):
+        self.stream = stream
+        self.prefix = prefix
+        self.size = 0
+
+    def read(self, n = -1):
+        if self.prefix:
+            n = len(self.prefix) if n < 0 else n
+            data, self.prefix = self.prefix[:n], self.prefix[n:]
+        else:
+            data = self.stream.read(n)
+        self.size += len(data)
+        return data
+
+
+def compress_stream(stream, codec_name):
+    """
+        Compress a stream with the codec named codec_name, unless the start of the stream shows that
+        compression does not pay off. Returns the stream to store and the name of the codec it is
+        compressed with, or None if it is stored as is. Either way, the returned stream's size
+        attribute is the number of bytes of the original stream read so far.
+    """
+    codec = get_codec(codec_name)
+    sample = stream.read(SAMPLE_SIZE)
+    if not worth_compressing(codec, sample):
+        return PrefixedStream(stream, sample), None
+    return CompressedStream(stream, codec, sample), codec.name
+
+
+def compress_bytes(data, codec_name):
+    """
+        Compress a file that is already in memory. Returns the bytes to store and the name of 
+        the codec they are compressed with, or None if compression does not pay off
+    """
+    codec = get_codec(codec_name)
+    if not worth_compressing(codec, data[:SAMPLE_SIZE]):
+        return data, None
+    return codec.compress(data), codec.name
+
+
+def decompress_pieces(pieces, codec_name):
+    """
+        Decompress a file that is stored in pieces, yielding the decompressed file one piece at a time
+    """
+    if codec_name is None:
+        yield from pieces
+        return
+
+    decompressor = get_codec(codec_name).decompressor()
+    for piece in pieces:
+        data = decompressor.decompress(piece)
+        if data:
+            yield data
+    if hasattr(decompressor, 'flush'):
+        data = decompressor.flush()
+        if data:
+            yield data
@@ -0,0 +1,89 @@
+import sqlite3
+
+# Columns that were added to the tables after databases were created with file.sql
+NEW_COLUMNS = {
+    'file': {
+        'compression': 'TEXT',
+        'stored_size': 'INTEGER',
+        'stripe_size': 'INTEGER'
+    },
+    'file_fragment': {
+        'checksum': 'INTEGER',
+        'stripe_checksums': 'BLOB'
+    }
+}
+
+# Tables that were added after databases were created with file.sql
+NEW_TABLES = {
+    'deleted_fragment': 'CREATE TABLE deleted_fragment (fragment_name TEXT, storage_node_id INTEGER)'
+}
+
+# Create the tables in file.sql if the database has none yet, and add the tables and columns
+# that are missing in databases created with an older file.sql
+def init_db():
+    db = sqlite3.connect("database.db")
+    tables = [row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    if 'file' not in tables:
+        try:
+            with open("file.sql") as f: 
+                db.executescript(f.read())
+        
+        except EnvironmentError as e: 
+            print("Error initializing database: {}".format(e))
+
+    for table, create in NEW_TABLES.items():
+        if 'file' in tables and table not in tables:
+            db.execute(create)
+
+    for table, new_columns in NEW_COLUMNS.items():
+        columns = [row[1] for row in db.execute(f"PRAGMA table_info({table})")]
+        for column, column_type in new_columns.items():
+            if column not in columns:
+                db.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+    db.commit()
+    db.close()
+
+# Insert a file and the rows of all its fragments, once the fragments are stored, so the transaction
+# is short and the database is not locked while the file is transferred. Returns the id of the file.
+# The caller commits
+def insert_file(db, file_row, fragment_rows):
+    cursor = db.execute(
+        'INSERT INTO file (filename, size, content_type, k_fragments, node_losses, c_fragments, compression, stored_size, stripe_size) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        file_row
+    )
+    file_id = cursor.lastrowid
+    db.executemany(
+        'INSERT INTO file_fragment (file_id, storage_node_id, fragment_name, fragment_index, coefficients, checksum, stripe_checksums) VALUES (?, ?, ?, ?, ?, ?, ?)',
+        [(file_id,) + row for row in fragment_rows]
+    )
+    return file_id
+
+# Delete a file and its fragment rows, and queue its fragments in the deleted_fragment table, where the
+# reclaimer picks them up. Returns False if there is no such file. The caller commits
+def release_file(db, file_id):
+    if db.execute('SELECT id FROM file WHERE id = ?', (file_id,)).fetchone() is None:
+        return False
+    db.execute(
+        'INSERT INTO deleted_fragment (fragment_name, storage_node_id) SELECT fragment_name, storage_node_id FROM file_fragment WHERE file_id = ?',
+        (file_id,)
+    )
+    db.execute('DELETE FROM file_fragment WHERE file_id = ?', (file_id,))
+    db.execute('DELETE FROM file WHERE id = ?', (file_id,))
+    return True
+
+# Queue the fragments that were sent for an upload that failed, which no file refers to, for the reclaimer.
+# The caller commits
+def abandon_fragments(db, fragments):
+    db.executemany('INSERT INTO deleted_fragment (fragment_name, storage_node_id) VALUES (?, ?)', fragments)
+
+# Fragments that wait to be deleted, at most limit for every storage node that alive accepts
+def deleted_fragments(db, alive, limit):
+    nodes = [row[0] for row in db.execute('SELECT DISTINCT storage_node_id FROM deleted_fragment')]
+    return {
+        node: [row[0] for row in db.execute('SELECT fragment_name FROM deleted_fragment WHERE storage_node_id = ? LIMIT ?', (node, limit))]
+        for node in nodes if alive(node)
+    }
+
+# Forget the fragments a storage node reported as deleted. The caller commits
+def forget_deleted(db, node, names):
+    db.executemany('DELETE FROM deleted_fragment WHERE fragment_name = ? AND storage_node_id = ?', [(name, node) for name in names])
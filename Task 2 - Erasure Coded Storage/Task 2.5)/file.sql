@@ -8,7 +8,10 @@ CREATE TABLE `file`
     `created` DATETIME DEFAULT CURRENT_TIMESTAMP,
     `k_fragments` INTEGER, -- k (number of data fragments)
     `node_losses` INTEGER, -- l (number of tolerable node losses)
-    `c_fragments` INTEGER -- c (total fragments = k + l)
+    `c_fragments` INTEGER, -- c (total fragments = k + l)
+    `compression` TEXT, -- codec the file is compressed with before it is encoded, NULL if it is stored as uploaded
+    `stored_size` INTEGER, -- size of the data encoded into the fragments, which is smaller than size for compressed files
+    `stripe_size` INTEGER -- bytes of the stored data per encoded stripe, NULL if the file is encoded as one stripe
 );
 
 CREATE TABLE `storage_node`
@@ -25,6 +28,15 @@ CREATE TABLE `file_fragment`
     `fragment_name` TEXT,
     `fragment_index` INTEGER,
     `coefficients` BLOB,
+    `checksum` INTEGER, -- CRC32 of the whole fragment, NULL for fragments stored before checksums
+    `stripe_checksums` BLOB, -- CRC32 of every stripe of the fragment, NULL for files stored as one stripe
     FOREIGN KEY(file_id) REFERENCES file(id),
     FOREIGN KEY(storage_node_id) REFERENCES storage_node(id)
+);
+
+-- Fragments of deleted files that the storage nodes have not deleted yet
+CREATE TABLE `deleted_fragment`
+(
+    `fragment_name` TEXT,
+    `storage_node_id` INTEGER
 );
\ No newline at end of file
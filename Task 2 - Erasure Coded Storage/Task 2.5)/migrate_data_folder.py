@@ -0,0 +1,41 @@
+import os
+import sys
+
+from object_store import CHECKPOINT_FILE, CHECKSUM_FILE, SEGMENT_PREFIX, SEGMENT_SUFFIX, shard_dir
+
+# One-time migration of storage node data folders that keep every object directly in the folder
+# to the directories picked by object_store.shard_dir. Stop the storage node first, then run:
+# python migrate_data_folder.py node1 [node2 ...]
+
+
+# Every regular file in the folder is an object, except the files of the segment store and the checksum log
+def is_object(entry):
+    if not entry.is_file():
+        return False
+    if entry.name.startswith(SEGMENT_PREFIX) and entry.name.endswith(SEGMENT_SUFFIX):
+        return False
+    return entry.name not in (CHECKPOINT_FILE, CHECKSUM_FILE) and not entry.name.endswith('.tmp')
+
+
+def migrate(folder):
+    moved = 0
+    for entry in list(os.scandir(folder)):
+        if not is_object(entry):
+            continue
+        directory = os.path.join(folder, shard_dir(entry.name))
+        os.makedirs(directory, exist_ok = True)
+        os.replace(entry.path, os.path.join(directory, entry.name))
+        moved += 1
+    return moved
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit("Usage: python migrate_data_folder.py data_folder [data_folder ...]")
+
+    for folder in sys.argv[1:]:
+        # A storage node started without a data folder keeps its objects next to the code
+        if os.path.abspath(folder) == os.getcwd():
+            print(f"Skipping {folder}: the current directory holds more than objects, move the objects to a data folder first")
+            continue
+        print(f"Moved {migrate(folder)} objects in {folder}")
@@ -0,0 +1,126 @@
+import threading
+from collections import OrderedDict
+
+# Recently stored and recently read objects of a storage node are kept in memory, so a file that is
+# downloaded again and again is served from RAM instead of being read from the store every time.
+
+# Default number of bytes of objects kept in memory
+CACHE_SIZE = 128 * 1024 * 1024
+
+# Objects larger than this fraction of the cache are not cached, so one large object cannot evict everything else
+MAX_OBJECT_FRACTION = 0.25
+
+
+class CachedStore:
+    """
+        Wraps a store from object_store.py with a least recently used cache of whole objects, bounded
+        to max_bytes. An object that arrives in pieces is cached while its pieces arrive in order,
+        and joined into one buffer the first time it is read.
+    """
+    def __init__(self, store, max_bytes = CACHE_SIZE):
+        self.store = store
+        self.max_bytes = max_bytes
+        self.max_object = int(max_bytes * MAX_OBJECT_FRACTION)
+        # name -> list of pieces of the object, a single bytes object once it has been joined
+        self.objects = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, name):
+        return name in self.store
+
+    def verify(self, name, data):
+        return self.store.verify(name, data)
+
+    def commit(self, names):
+        self.store.commit(names)
+
+    def write(self, name, data, offset = 0):
+        result = self.store.write(name, data, offset)
+        with self.lock:
+            pieces = self.objects.get(name)
+            size = sum(len(piece) for piece in pieces) if pieces is not None else 0
+            if result is None or (offset != 0 and (pieces is None or offset != size)):
+                self.remove(name)
+            elif offset == 0:
+                self.remove(name)
+                self.add(name, [bytes(data)])
+            elif size + len(data) > self.max_object:
+                self.remove(name)
+            else:
+                pieces.append(bytes(data))
+                self.size += len(data)
+                self.objects.move_to_end(name)
+                self.evict()
+        return result
+
+    def read(self, name):
+        data = self.lookup(name)
+        if data is not None:
+            return data
+
+        data = self.store.read(name)
+        if data is not None:
+            with self.lock:
+                self.remove(name)
+                self.add(name, [data])
+        return data
+
+    # Cached objects are sent from memory. An object that is too large to cache is sent from the store's
+    # view, and any other object is read into the cache first
+    def view(self, name):
+        data = self.lookup(name)
+        if data is None:
+            data = self.store.view(name)
+            if data is None or len(data) > self.max_object:
+                return data
+            data = bytes(data)
+            with self.lock:
+                self.remove(name)
+                self.add(name, [data])
+        return memoryview(data)
+
+    def delete(self, name):
+        with self.lock:
+            self.remove(name)
+        self.store.delete(name)
+
+    def lookup(self, name):
+        with self.lock:
+            pieces = self.objects.get(name)
+            if pieces is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.objects.move_to_end(name)
+            if len(pieces) > 1:
+                pieces[:] = [b''.join(pieces)]
+            return pieces[0]
+
+    def add(self, name, pieces):
+        size = sum(len(piece) for piece in pieces)
+        if size > self.max_object:
+            return
+        self.objects[name] = pieces
+        self.size += size
+        self.evict()
+
+    def remove(self, name):
+        pieces = self.objects.pop(name, None)
+        if pieces is not None:
+            self.size -= sum(len(piece) for piece in pieces)
+
+    def evict(self):
+        while self.size > self.max_bytes and self.objects:
+            self.remove(next(iter(self.objects)))
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'objects': len(self.objects), 'bytes': self.size
+            }
@@ -0,0 +1,678 @@
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+# How a storage node keeps the objects (chunks or fragments) it stores. FileStore keeps every object
+# in a file of its own, SegmentStore appends them to a few large segment files. Both are safe to use
+# from several disk worker threads, and answer "is this object here?" from memory.
+# Both keep the length and CRC32 checksum of every object, so reads and the scrubber can tell when the
+# data on disk no longer is what was written.
+
+# Default size of a segment file, after which appends go to a new segment
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+# The index is written to a checkpoint after this many bytes were appended, or this many seconds passed.
+# On start, only the records appended after the checkpoint are read back from the segments
+CHECKPOINT_BYTES = 64 * 1024 * 1024
+CHECKPOINT_INTERVAL = 60
+
+# Address space of the memory maps that a store keeps open to serve reads without copying
+MAP_CACHE_SIZE = 1024 * 1024 * 1024
+
+# Sealed segments where less than this fraction of the bytes belongs to live objects are compacted
+COMPACT_RATIO = 0.5
+
+# Seconds the background thread of a segment store waits after an error before it tries again
+COMPACT_RETRY = 1.0
+
+# Every record in a segment file starts with its kind, the length of the object name, the offset of
+# the data in the object, the length of the data, and the length and checksum of the object up to the
+# end of the data (UNKNOWN_LENGTH if the object cannot be checked). The name and the data follow the header
+RECORD = struct.Struct('<BHQQQI')
+PUT = 1
+DELETE = 2
+UNKNOWN_LENGTH = 2 ** 64 - 1
+
+# Bytes a record takes in its segment, with its header and name
+def record_size(name, length):
+    return RECORD.size + len(name.encode('utf-8')) + length
+
+SEGMENT_PREFIX = 'segment-'
+SEGMENT_SUFFIX = '.log'
+CHECKPOINT_FILE = 'index.checkpoint'
+
+# Checksums of the objects of a FileStore, one line per write or delete
+CHECKSUM_FILE = 'checksums.log'
+
+
+# Checksum of an object after data is written at offset, given its (length, checksum) before the write.
+# Pieces that extend the object in order keep a running checksum. A piece written anywhere else leaves
+# the object without one, returns None, until the object is written again from offset 0
+def extend_checksum(previous, data, offset):
+    if offset == 0:
+        return len(data), zlib.crc32(data)
+    if previous is None or previous[0] != offset:
+        return None
+    return offset + len(data), zlib.crc32(data, previous[1])
+
+# True if data matches the (length, checksum) of an object, or the object has no checksum
+def verify(expected, data):
+    if expected is None:
+        return True
+    length, checksum = expected
+    return len(data) == length and zlib.crc32(data) == checksum
+
+def sync_file(path):
+    fd = os.open(path, os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# Make the entries of a directory durable, e.g. a file that was created or renamed in it.
+# Directories cannot be opened on Windows, where the entry is durable with the file
+def sync_directory(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class MapCache:
+    """
+        Read-only memory maps of files, most recently used last. When the maps take more than max_bytes
+        of address space, the least recently used ones are closed. A map that zmq is still sending from
+        cannot be closed yet: it leaves the cache, and is unmapped once the last view of it is released.
+    """
+    def __init__(self, max_bytes = MAP_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.maps = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    # Returns the map of key if it covers at least length bytes, or None if it has to be mapped (again)
+    def lookup(self, key, length = 0):
+        with self.lock:
+            mapped = self.maps.get(key)
+            if mapped is None:
+                return None
+            if len(mapped) < length:
+                self.remove(key)
+                return None
+            self.maps.move_to_end(key)
+            return mapped
+
+    def add(self, key, mapped):
+        with self.lock:
+            if key in self.maps:
+                self.remove(key)
+            self.maps[key] = mapped
+            self.size += len(mapped)
+            while self.size > self.max_bytes and len(self.maps) > 1:
+                self.remove(next(iter(self.maps)))
+        return mapped
+
+    def discard(self, key):
+        with self.lock:
+            if key in self.maps:
+                self.remove(key)
+
+    def remove(self, key):
+        mapped = self.maps.pop(key)
+        self.size -= len(mapped)
+        try:
+            mapped.close()
+        except BufferError:
+            pass
+
+
+# Files of objects are spread over two levels of directories named after a hash of the object name,
+# e.g. 3f/a2/GxiMIdwe, so no directory gets more than a few hundred entries even with millions of objects
+def shard_dir(name):
+    digest = '%08x' % zlib.crc32(name.encode('utf-8'))
+    return os.path.join(digest[0:2], digest[2:4])
+
+def is_shard_dir(entry):
+    return entry.is_dir() and len(entry.name) == 2 and all(c in '0123456789abcdef' for c in entry.name)
+
+
+class FileStore:
+    """
+        One file per object, named after the object, in a directory picked by shard_dir. With sharded
+        set to False, every file is directly in the data folder, like before migrate_data_folder.py
+    """
+    def __init__(self, folder, map_cache_size = MAP_CACHE_SIZE, sharded = True):
+        self.folder = folder
+        self.sharded = sharded
+        self.names = set()
+        self.maps = MapCache(map_cache_size)
+
+        # Directories that exist already, so writes do not have to create them, and the
+        # directories created since the last commit
+        self.dirs = set()
+        self.new_dirs = set()
+        if not sharded:
+            self.names = {entry.name for entry in os.scandir(folder) if entry.is_file() and entry.name != CHECKSUM_FILE}
+        for first in filter(is_shard_dir, os.scandir(folder)) if sharded else []:
+            for second in filter(is_shard_dir, os.scandir(first.path)):
+                self.dirs.add(second.path)
+                self.names.update(entry.name for entry in os.scandir(second.path) if entry.is_file())
+
+        # name -> (length, checksum). The log is read back and rewritten with one line per object on start.
+        # The lock guards the log and new_dirs
+        self.checksums = {}
+        self.lock = threading.Lock()
+        checksum_path = os.path.join(folder, CHECKSUM_FILE)
+        try:
+            with open(checksum_path) as f:
+                for line in f:
+                    name, _, value = line.rstrip('\n').partition(' ')
+                    if value:
+                        length, checksum = value.split()
+                        self.checksums[name] = (int(length), int(checksum))
+                    else:
+                        self.checksums.pop(name, None)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            print(f"Ignoring the rest of an unreadable checksum log: {e}", file = sys.stderr)
+
+        self.checksums = {name: value for name, value in self.checksums.items() if name in self.names}
+        with open(checksum_path + '.tmp', 'w') as f:
+            f.writelines(f"{name} {length} {checksum}\n" for name, (length, checksum) in self.checksums.items())
+        os.replace(checksum_path + '.tmp', checksum_path)
+        self.checksum_log = open(checksum_path, 'a')
+
+    def __contains__(self, name):
+        return name in self.names
+
+    # A line with only the name removes the checksum of the object
+    def log_checksum(self, name, value):
+        with self.lock:
+            if value is None:
+                self.checksums.pop(name, None)
+                self.checksum_log.write(f"{name}\n")
+            else:
+                self.checksums[name] = value
+                self.checksum_log.write(f"{name} {value[0]} {value[1]}\n")
+            self.checksum_log.flush()
+
+    def verify(self, name, data):
+        return verify(self.checksums.get(name), data)
+
+    def path(self, name):
+        if not self.sharded:
+            return os.path.join(self.folder, name)
+        return os.path.join(self.folder, shard_dir(name), name)
+
+    # Large objects arrive in several pieces, and every piece after the first is written at its offset.
+    # The first piece replaces the file instead of truncating it, since a memory map of a file that is
+    # truncated crashes the process when it is read. Returns the name of the object, or None if it could not be written
+    def write(self, name, data, offset = 0):
+        path = self.path(name)
+        self.maps.discard(path)
+        try:
+            directory = os.path.dirname(path)
+            if directory not in self.dirs:
+                os.makedirs(directory, exist_ok = True)
+                self.dirs.add(directory)
+                with self.lock:
+                    self.new_dirs.add(directory)
+
+            if offset == 0 or not os.path.exists(path):
+                with open(path + '.tmp', 'wb') as f:
+                    f.seek(offset)
+                    f.write(data)
+                os.replace(path + '.tmp', path)
+            else:
+                with open(path, 'r+b') as f:
+                    f.seek(offset)
+                    f.write(data)
+        except EnvironmentError as e:
+            print(f"Error writing to file: {e}", file = sys.stderr)
+            return None
+
+        self.names.add(name)
+        self.log_checksum(name, extend_checksum(self.checksums.get(name), data, offset))
+        return name
+
+    # Force the objects written so far to disk: their files, the directories they were created in,
+    # and the checksum log
+    def commit(self, names):
+        directories = set()
+        for name in names:
+            path = self.path(name)
+            try:
+                sync_file(path)
+            except FileNotFoundError:
+                continue
+            directories.add(os.path.dirname(path))
+
+        # New directories are forgotten only once they are synced, so a concurrent commit syncs them as well
+        with self.lock:
+            new_dirs = set(self.new_dirs)
+        for directory in new_dirs:
+            directories.update((os.path.dirname(directory), os.path.dirname(os.path.dirname(directory))))
+        for directory in directories:
+            sync_directory(directory)
+        with self.lock:
+            self.new_dirs -= new_dirs
+
+        with self.lock:
+            self.checksum_log.flush()
+            os.fsync(self.checksum_log.fileno())
+
+    # Returns a read-only view of an object in a memory map of its file, or None if it is not stored here
+    def view(self, name):
+        path = self.path(name)
+        mapped = self.maps.lookup(path)
+        if mapped is None:
+            try:
+                with open(path, 'rb') as f:
+                    if os.fstat(f.fileno()).st_size == 0:
+                        return memoryview(b'')
+                    mapped = self.maps.add(path, mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ))
+            except FileNotFoundError:
+                return None
+        return memoryview(mapped)
+
+    # Returns the contents of an object, or None if it is not stored here
+    def read(self, name):
+        try:
+            with open(self.path(name), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, name):
+        self.names.discard(name)
+        self.maps.discard(self.path(name))
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
+        self.log_checksum(name, None)
+
+
+class Segment:
+    """
+        An append-only segment file. live is the number of bytes of the records in it that hold data of
+        stored objects, headers and names included, and objects maps the name of every stored object with
+        data in the segment to its number of records there
+    """
+    def __init__(self, folder, segment_id):
+        self.id = segment_id
+        self.path = os.path.join(folder, f'{SEGMENT_PREFIX}{segment_id:06d}{SEGMENT_SUFFIX}')
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.size = os.fstat(self.fd).st_size
+        self.live = 0
+        self.objects = {}
+
+    def add_record(self, name, length):
+        self.live += record_size(name, length)
+        self.objects[name] = self.objects.get(name, 0) + 1
+
+    def remove_record(self, name, length):
+        self.live -= record_size(name, length)
+        self.objects[name] -= 1
+        if self.objects[name] == 0:
+            del self.objects[name]
+
+    def append(self, kind, name, offset, data, checksum):
+        name = name.encode('utf-8')
+        length, checksum = checksum or (UNKNOWN_LENGTH, 0)
+        header = RECORD.pack(kind, len(name), offset, len(data), length, checksum)
+        position = self.size
+        os.pwritev(self.fd, [header, name, data], position)
+        self.size += RECORD.size + len(name) + len(data)
+        return position + RECORD.size + len(name)
+
+    def records(self, start):
+        """
+            Yield (kind, name, offset in the object, position of the data, length of the data, checksum) of every
+            record from start on. A record that was cut off by a crash ends the segment and is truncated away.
+        """
+        position = start
+        while position + RECORD.size <= self.size:
+            kind, name_length, offset, length, object_length, checksum = RECORD.unpack(os.pread(self.fd, RECORD.size, position))
+            data_position = position + RECORD.size + name_length
+            if kind not in (PUT, DELETE) or data_position + length > self.size:
+                break
+            name = os.pread(self.fd, name_length, position + RECORD.size).decode('utf-8')
+            yield kind, name, offset, data_position, length, None if object_length == UNKNOWN_LENGTH else (object_length, checksum)
+            position = data_position + length
+
+        if position < self.size:
+            print(f"Truncating {self.path} after an incomplete record at {position}", file = sys.stderr)
+            os.ftruncate(self.fd, position)
+            self.size = position
+
+    def close(self):
+        os.close(self.fd)
+
+
+class SegmentStore:
+    """
+        Log-structured store: objects are appended to large segment files, and an in-memory index maps
+        every object to the extents (offset in the object, segment, position in the segment, length)
+        that hold its data. Overwritten and deleted objects leave garbage in their segments, which a
+        background thread reclaims by copying the live objects of mostly-garbage segments to the end of the log.
+        The same thread writes the checkpoints of the index, from which the store starts without replaying every segment.
+
+        All reads and writes take one lock, so a segment is never closed by a compaction while it is read.
+        The background thread takes it for one object at a time, and only to copy the index for a checkpoint,
+        so reads and writes go on in between.
+        Views of objects are memory maps of segments, which stay valid after their segment is removed.
+    """
+    def __init__(self, folder, segment_size = SEGMENT_SIZE, map_cache_size = MAP_CACHE_SIZE):
+        self.folder = folder
+        self.segment_size = segment_size
+        self.maps = MapCache(map_cache_size)
+        self.lock = threading.Lock()
+        # Held while segments are synced, so a commit does not return before one that started earlier
+        # has synced the appends it took over
+        self.commit_lock = threading.Lock()
+        self.index = {}
+        self.segments = {}
+
+        checkpoint = self.load_checkpoint()
+        positions = {int(segment_id): size for segment_id, size in checkpoint.get('segments', {}).items()}
+        self.index = {name: [tuple(extent) for extent in extents] for name, extents in checkpoint.get('index', {}).items()}
+        # name -> (length, checksum) of the objects that have one
+        self.checksums = {name: tuple(value) for name, value in checkpoint.get('checksums', {}).items()}
+
+        for filename in sorted(os.listdir(folder)):
+            if filename.startswith(SEGMENT_PREFIX) and filename.endswith(SEGMENT_SUFFIX):
+                segment_id = int(filename[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+                self.segments[segment_id] = Segment(folder, segment_id)
+
+        # Extents in segments that were compacted away after the checkpoint are gone
+        for name in list(self.index):
+            self.index[name] = [extent for extent in self.index[name] if extent[1] in self.segments]
+            if not self.index[name]:
+                del self.index[name]
+        self.checksums = {name: value for name, value in self.checksums.items() if name in self.index}
+
+        # Replay the records that were appended after the checkpoint, oldest segment first
+        for segment in self.segments.values():
+            for kind, name, offset, position, length, checksum in segment.records(positions.get(segment.id, 0)):
+                self.apply(kind, name, (offset, segment.id, position, length), checksum)
+
+        for name, extents in self.index.items():
+            for _, segment_id, _, length in extents:
+                self.segments[segment_id].add_record(name, length)
+
+        # Segments appended to since the last commit, and whether segment files were created since then
+        self.dirty = set()
+        self.created = False
+        self.active = self.segments[max(self.segments)] if self.segments else self.new_segment()
+        self.appended = 0
+        self.last_checkpoint = time.time()
+        self.checkpoint_due = False
+
+        # Set when a checkpoint is due, or a sealed segment may have become mostly garbage
+        self.work_due = threading.Event()
+        self.work_due.set()
+        threading.Thread(target = self.background_work, daemon = True).start()
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def verify(self, name, data):
+        return verify(self.checksums.get(name), data)
+
+    def new_segment(self):
+        segment = Segment(self.folder, max(self.segments, default = 0) + 1)
+        self.segments[segment.id] = segment
+        self.created = True
+        return segment
+
+    # Update the index for a record, and return the extents it made garbage. The extent list of an object is
+    # replaced instead of changed, so a copy of the index for a checkpoint can share the lists
+    def apply(self, kind, name, extent, checksum):
+        extents = self.index.get(name, [])
+        if kind == DELETE or checksum is None:
+            self.checksums.pop(name, None)
+        else:
+            self.checksums[name] = checksum
+        if kind == DELETE:
+            self.index.pop(name, None)
+            return extents
+
+        # A piece at offset 0 starts the object over, a piece at another offset replaces the piece there
+        if extent[0] == 0:
+            garbage, kept = extents, []
+        else:
+            garbage = [e for e in extents if e[0] == extent[0]]
+            kept = [e for e in extents if e[0] != extent[0]]
+        self.index[name] = kept + [extent]
+        return garbage
+
+    def append(self, kind, name, offset, data):
+        segment = self.active
+        checksum = extend_checksum(self.checksums.get(name), data, offset) if kind == PUT else None
+        position = segment.append(kind, name, offset, data, checksum)
+        self.dirty.add(segment)
+        extent = (offset, segment.id, position, len(data))
+        for _, segment_id, _, length in self.apply(kind, name, extent, checksum):
+            garbage = self.segments[segment_id]
+            garbage.remove_record(name, length)
+            if self.needs_compaction(garbage):
+                self.work_due.set()
+        if kind == PUT:
+            segment.add_record(name, len(data))
+        self.appended += len(data)
+
+    # Returns the name of the object, or None if it could not be written
+    def write(self, name, data, offset = 0):
+        with self.lock:
+            try:
+                self.append(PUT, name, offset, data)
+                self.maintain()
+            except EnvironmentError as e:
+                print(f"Error writing to segment: {e}", file = sys.stderr)
+                return None
+        return name
+
+    # Force everything appended so far to disk. Appends go on while the segments are synced, and a
+    # segment that is compacted away in the meantime no longer needs it. Objects in the same segment
+    # share one fsync, whatever names are given
+    def commit(self, names):
+        with self.commit_lock:
+            with self.lock:
+                segments, self.dirty = self.dirty, set()
+                created, self.created = self.created, False
+            for segment in segments:
+                try:
+                    os.fsync(segment.fd)
+                except OSError:
+                    if segment.id in self.segments:
+                        raise
+            if created:
+                sync_directory(self.folder)
+
+    # Returns the contents of an object, or None if it is not stored here
+    def read(self, name):
+        with self.lock:
+            return self.read_locked(name)
+
+    def read_locked(self, name):
+        extents = self.index.get(name)
+        if not extents:
+            return None
+        if len(extents) == 1 and extents[0][0] == 0:
+            _, segment_id, position, length = extents[0]
+            return os.pread(self.segments[segment_id].fd, length, position)
+
+        data = bytearray(max(offset + length for offset, _, _, length in extents))
+        view = memoryview(data)
+        for offset, segment_id, position, length in extents:
+            os.preadv(self.segments[segment_id].fd, [view[offset:offset + length]], position)
+        return bytes(data)
+
+    # Returns a read-only view of an object in a memory map of its segment, or None if it is not stored here.
+    # Objects in several pieces that were not compacted yet are read into memory instead
+    def view(self, name):
+        with self.lock:
+            extents = self.index.get(name)
+            if not extents:
+                return None
+            if len(extents) != 1 or extents[0][0] != 0:
+                return memoryview(self.read_locked(name))
+
+            _, segment_id, position, length = extents[0]
+            segment = self.segments[segment_id]
+            mapped = self.maps.lookup(segment_id, position + length)
+            if mapped is None:
+                mapped = self.maps.add(segment_id, mmap.mmap(segment.fd, segment.size, access = mmap.ACCESS_READ))
+        return memoryview(mapped)[position:position + length]
+
+    def delete(self, name):
+        with self.lock:
+            if name in self.index:
+                self.append(DELETE, name, 0, b'')
+                self.maintain()
+
+    # Start a new segment when the active one is full, and have the background thread write a checkpoint
+    # when one is due
+    def maintain(self):
+        if self.active.size >= self.segment_size:
+            # The sealed segment is compacted by the same thread if it is mostly garbage
+            self.active = self.new_segment()
+            self.checkpoint_due = True
+            self.work_due.set()
+
+        if self.appended >= CHECKPOINT_BYTES or time.time() - self.last_checkpoint >= CHECKPOINT_INTERVAL:
+            self.checkpoint_due = True
+            self.work_due.set()
+
+    def needs_compaction(self, segment):
+        return segment is not self.active and segment.live < segment.size * COMPACT_RATIO
+
+    # Background thread: write the checkpoints that are due, and compact the sealed segments that are
+    # mostly garbage, one at a time
+    def background_work(self):
+        while True:
+            self.work_due.wait()
+            with self.lock:
+                checkpoint_due = self.checkpoint_due
+                segment = next((segment for segment in self.segments.values() if self.needs_compaction(segment)), None)
+                if not checkpoint_due and segment is None:
+                    self.work_due.clear()
+                    continue
+            try:
+                if checkpoint_due:
+                    self.checkpoint()
+                if segment is not None:
+                    self.compact(segment)
+            except EnvironmentError as e:
+                print(f"Error maintaining segments in {self.folder}: {e}", file = sys.stderr)
+                # The checkpoint may not have been written, so it is tried again as well
+                with self.lock:
+                    self.checkpoint_due = True
+                time.sleep(COMPACT_RETRY)
+
+    # Copy every object with data in a sealed segment to the end of the log as one piece, then remove the segment.
+    # The segment is only removed after a checkpoint without it, so a crash never loses the objects in it.
+    # A corrupt object is deleted instead of being copied with a new checksum of the corrupt data.
+    # Deletes in the segment are copied too while an older segment still has data of the deleted object,
+    # or a replay of the log without a checkpoint would bring the object back
+    def compact(self, segment):
+        with self.lock:
+            names = list(segment.objects)
+        for name in names:
+            with self.lock:
+                if name not in segment.objects:
+                    continue
+                data = self.read_locked(name)
+                if self.verify(name, data):
+                    self.append(PUT, name, 0, data)
+                else:
+                    print(f"Dropping corrupt object {name} while compacting {segment.path}", file = sys.stderr)
+                    self.append(DELETE, name, 0, b'')
+                self.maintain()
+
+        # Sealed segments are never appended to, and only this thread removes segments,
+        # so their records are read without the lock
+        deleted = {name for kind, name, *_ in segment.records(0) if kind == DELETE}
+        if deleted:
+            with self.lock:
+                older = [older for older in self.segments.values() if older.id < segment.id]
+            deleted &= {name for older in older for kind, name, *_ in older.records(0) if kind == PUT}
+        for name in deleted:
+            with self.lock:
+                if name not in self.index:
+                    self.append(DELETE, name, 0, b'')
+                    self.maintain()
+
+        # The checkpoint syncs the copies to disk before it is written, and the segment is only removed after it
+        with self.lock:
+            del self.segments[segment.id]
+        try:
+            self.checkpoint()
+        except EnvironmentError:
+            with self.lock:
+                self.segments[segment.id] = segment
+            raise
+
+        with self.lock:
+            print(f"Compacted {segment.path}: {len(names)} objects moved, {len(deleted)} deletes kept, {segment.size} bytes reclaimed")
+            self.maps.discard(segment.id)
+            self.dirty.discard(segment)
+            segment.close()
+            os.remove(segment.path)
+
+    def load_checkpoint(self):
+        try:
+            with open(os.path.join(self.folder, CHECKPOINT_FILE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            print(f"Ignoring unreadable index checkpoint: {e}", file = sys.stderr)
+            return {}
+
+    # Write the index and the size of every segment it covers, replacing the previous checkpoint at once.
+    # Only a copy of the index is taken under the lock, and it is written out without it. The segments are
+    # synced first, so a checkpoint never covers appends that a crash can still lose, and the checkpoint is
+    # synced before it replaces the previous one, so a crash leaves one of the two complete.
+    # Only called by the background thread, so checkpoints are never written at the same time
+    def checkpoint(self):
+        with self.lock:
+            state = {
+                'segments': {segment_id: segment.size for segment_id, segment in self.segments.items()},
+                'index': dict(self.index),
+                'checksums': dict(self.checksums)
+            }
+            self.checkpoint_due = False
+            self.appended = 0
+            self.last_checkpoint = time.time()
+
+        self.commit(())
+        path = os.path.join(self.folder, CHECKPOINT_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        sync_directory(self.folder)
+
+
+STORE_KINDS = ['files', 'segments']
+
+def open_store(kind, folder, segment_size = SEGMENT_SIZE, map_cache_size = MAP_CACHE_SIZE):
+    if kind == 'segments':
+        return SegmentStore(folder, segment_size, map_cache_size)
+    return FileStore(folder, map_cache_size)
@@ -0,0 +1,41 @@
+import random
+
+#------------------Configurable Placement of Fragments------------------#
+
+def placement_strategy(strategy, R, chunk_index, nodes):
+    if strategy == "random_placement":
+        return random_placement(nodes, R)
+
+    elif strategy == "min_copy_sets":
+        return min_copy_sets(nodes, R, chunk_index)
+
+    elif strategy == "buddy_approach": 
+        return buddy_approach(nodes, R, chunk_index)
+    
+    else:
+        raise ValueError("Invalid node placement strategy")
+    
+def random_placement(nodes, R):
+    return random.sample(nodes, R)
+
+def min_copy_sets(nodes, R, chunk_index):
+    divide_nodes = [[nodes[(i + j) % len(nodes)] for j in range(R)] for i in range(len(nodes))]
+    return divide_nodes[chunk_index % len(nodes)]
+
+def buddy_approach(nodes, R, chunk_index):
+    if R != 2:
+        raise ValueError("R needs to be bigger than 2")
+
+    if len(nodes) % 2 != 0:
+        raise ValueError("Must have even number of nodes")
+
+    # Create buddy groups
+    buddy_groups = [
+        nodes[i:i + 2]
+        for i in range(0, len(nodes), 2)
+    ]
+
+    # Select buddy group based on chunk index
+    group = buddy_groups[chunk_index % len(buddy_groups)]
+
+    return group
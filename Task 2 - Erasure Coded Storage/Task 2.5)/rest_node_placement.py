@@ -3,10 +3,18 @@ import random
 import string
 import time
 import sqlite3
-import io
+import os
+import threading
 import logging
-from Reed_Solomon import store_file, get_file
-from flask import Flask, g, make_response, request, send_file, jsonify
+from Reed_Solomon import (
+    STRIPE_SIZE, store_file, get_file, compress_upload, durability_level, pack_checksums, reclaim_space, stripe_size_for,
+    unpack_checksums
+)
+from dispatcher import ReplyDispatcher, LockedSocket
+from compression import decompress_pieces
+from database import abandon_fragments, init_db, insert_file, release_file
+from placement import placement_strategy
+from flask import Flask, Response, g, make_response, request, jsonify
 from logging import exception
 
 logging.basicConfig(
@@ -17,14 +25,23 @@ logging.basicConfig(
 #-----------------ZMQ Setup-----------------#
 context = zmq.Context()
 
-socket_push = context.socket(zmq.PUSH)
-socket_push.bind("tcp://*:5557")
+# Storage nodes connect with a DEALER socket whose routing id is their storage_node id,
+# so every fragment can be routed to the node the placement strategy picked
+socket_router = context.socket(zmq.ROUTER)
+socket_router.setsockopt(zmq.ROUTER_MANDATORY, 1)
+# A storage node that restarts connects with the same routing id, and ROUTER_HANDOVER gives it
+# the id of its dead connection instead of leaving the node unreachable
+socket_router.setsockopt(zmq.ROUTER_HANDOVER, 1)
+socket_router.bind("tcp://*:5557")
+socket_router = LockedSocket(socket_router)
 
-socket_pull = context.socket(zmq.PULL)
-socket_pull.bind("tcp://*:5558")
+# Replies from all storage nodes arrive on one PULL socket, the dispatcher hands
+# each of them to the upload or download with the request_id in the reply header
+dispatcher = ReplyDispatcher(context, "tcp://*:5558")
 
 socket_pub = context.socket(zmq.PUB)
 socket_pub.bind("tcp://*:5559")
+socket_pub = LockedSocket(socket_pub)
 
 time.sleep(1)
 
@@ -57,18 +74,6 @@ def get_db():
 
     return g.db 
 
-def init_db():
-    db = sqlite3.connect("database.db")
-    if db is None:
-        try:
-            with open("file.sql") as f: 
-                db.executescript(f.read())
-        
-        except EnvironmentError as e: 
-            print("Error initializing database: {}".format(e))
-    
-    db.close()
-
 def close_db(e=None):
     db = g.pop('db', None)
     if db is not None:
@@ -76,49 +81,11 @@ def close_db(e=None):
 
 
 
-#------------------Configurable Placement of Fragments------------------#
-
-def placement_strategy(strategy, R, chunk_index, nodes):
-    if strategy == "random_placement":
-        return random_placement(nodes, R)
-
-    elif strategy == "min_copy_sets":
-        return min_copy_sets(nodes, R, chunk_index)
-
-    elif strategy == "buddy_approach": 
-        return buddy_approach(nodes, R, chunk_index)
-    
-    else:
-        raise ValueError("Invalid node placement strategy")
-    
-def random_placement(nodes, R):
-    return random.sample(nodes, R)
-
-def min_copy_sets(nodes, R, chunk_index):
-    divide_nodes = [[nodes[(i + j) % len(nodes)] for j in range(R)] for i in range(len(nodes))]
-    return divide_nodes[chunk_index % len(nodes)]
-
-def buddy_approach(nodes, R, chunk_index):
-    if R != 2:
-        raise ValueError("R needs to be bigger than 2")
-
-    if len(nodes) % 2 != 0:
-        raise ValueError("Must have even number of nodes")
-
-    # Create buddy groups
-    buddy_groups = [
-        nodes[i:i + 2]
-        for i in range(0, len(nodes), 2)
-    ]
-
-    # Select buddy group based on chunk index
-    group = buddy_groups[chunk_index % len(buddy_groups)]
-
-    return group
-
 #-----------------Flask Setup-----------------#
 
 init_db()
+dispatcher.membership.start_sync("database.db")
+threading.Thread(target = reclaim_space, args = ("database.db", socket_router, dispatcher), daemon = True).start()
 app = Flask(__name__)
 app.teardown_appcontext(close_db)
 
@@ -151,11 +118,24 @@ def get_file_fragments(file_id):
     for row in f: 
         d = dict(row)
         d.pop('coefficients', None)
+        d.pop('stripe_checksums', None)
         fragments.append(d)
 
     return jsonify(fragments)
 
 
+# The file and its fragment rows are deleted right away, and the storage nodes delete
+# the fragments in the background
+@app.route('/files/<int:file_id>', methods=['DELETE'])
+def delete_file(file_id):
+    db = get_db()
+    if not release_file(db, file_id):
+        return make_response({'message': f'File {file_id} not found'}, 404)
+
+    db.commit()
+    return make_response({'message': f'File {file_id} deleted'}, 200)
+
+
 @app.route('/files/<int:file_id>/download', methods=['GET'])
 def download_file(file_id):
     start = time.time()
@@ -172,37 +152,88 @@ def download_file(file_id):
     print(f"Requested file metadata: {f}")
 
     get_id = db.execute(
-        'SELECT fragment_name, fragment_index, coefficients FROM file_fragment WHERE file_id = ? GROUP BY fragment_name ORDER BY fragment_index',
+        'SELECT fragment_name, fragment_index, coefficients, checksum, stripe_checksums, storage_node_id FROM file_fragment WHERE file_id = ? ORDER BY fragment_index',
         [file_id]
     )
     fragment_rows = get_id.fetchall()
-    coded_fragments = [row['fragment_name'] for row in fragment_rows]
+    coded_fragments = []
     fragment_meta = {}
+    fragment_nodes = {}
+    fragment_checksums = {}
+    stripe_checksums = {}
     matrix = []
 
+    # Every replica of a fragment has its own row, so we also collect which storage nodes hold it
     for row in fragment_rows:
-        fragment_meta[row['fragment_name']] = row['fragment_index']
-        matrix.append(bytearray(row['coefficients']))
+        name = row['fragment_name']
+        if name not in fragment_meta:
+            coded_fragments.append(name)
+            fragment_meta[name] = row['fragment_index']
+            fragment_nodes[name] = []
+            fragment_checksums[name] = row['checksum']
+            stripe_checksums[name] = unpack_checksums(row['stripe_checksums'])
+            matrix.append(bytearray(row['coefficients']))
+        if row['storage_node_id'] is not None:
+            fragment_nodes[name].append(row['storage_node_id'])
     
     file_data = get_file(
         coded_fragments = coded_fragments, 
         fragment_meta = fragment_meta, 
+        fragment_nodes = fragment_nodes,
+        fragment_checksums = fragment_checksums,
         matrix = matrix, 
-        file_size = f['size'],
-        data_req_socket = socket_pub,
-        response_socket = socket_pull,
+        file_size = f['stored_size'] if f['stored_size'] is not None else f['size'],
+        data_req_socket = socket_router,
+        broadcast_socket = socket_pub,
+        dispatcher = dispatcher,
         k = f['k_fragments'],
-        l = f['node_losses']
+        l = f['node_losses'],
+        stripe_size = f['stripe_size'],
+        stripe_checksums = stripe_checksums
     )
 
-    end = time.time()
-    download_time = end - start
-    logging.info(f"File {f['filename']} with id {file_id}, size {f['size']}, k {f['k_fragments']}, l {f['node_losses']} downloaded in {download_time:.2f} seconds")
+    # Compressed files are decompressed as they are decoded
+    file_data = decompress_pieces(file_data, f['compression'])
 
-    return send_file(
-        io.BytesIO(file_data), 
-        mimetype = f['content_type']
-    )
+    # Fetch the first piece before the response starts, so a file that 
+    # cannot be reconstructed still gets an error status
+    first_piece = next(file_data, b'')
+
+    # The file is fetched and decoded a few stripes ahead of the piece that is sent, so the memory of a
+    # download does not grow with the file. Closing file_data stops the stripes that are still being
+    # fetched when the client goes away before the end of the file
+    def stream_file():
+        try:
+            yield first_piece
+            yield from file_data
+        finally:
+            file_data.close()
+
+        end = time.time()
+        download_time = end - start
+        logging.info(f"File {f['filename']} with id {file_id}, size {f['size']}, k {f['k_fragments']}, l {f['node_losses']} downloaded in {download_time:.2f} seconds")
+
+    response = Response(stream_file(), mimetype = f['content_type'])
+    response.content_length = f['size']
+    return response
+
+
+@app.route('/storage_nodes', methods=['GET'])
+def get_storage_nodes():
+    """
+        Get whether each storage node is up, the seconds since its last heartbeat, its free disk space
+        and the number of disk operations waiting on it
+    """
+    return make_response(dispatcher.membership.view())
+
+
+@app.route('/storage_nodes/queues', methods=['GET'])
+def get_queue_depths():
+    """
+        Get the number of fragment pieces sent to each storage node that it has not acknowledged yet,
+        and the window of unacknowledged pieces the node advertised
+    """
+    return make_response(dispatcher.flow_control.queue_depths())
 
 
 @app.route('/files', methods=['POST'])
@@ -222,41 +253,71 @@ def add_files():
     file = files.get('file')
     filename = file.filename
     content_type = file.mimetype
-    file_data = file.read()
-    size = len(file_data)
-    c = k + l
 
-    db = get_db()
-    insert_into_file = db.execute(
-        'INSERT INTO file (filename, size, content_type, k_fragments, node_losses, c_fragments) VALUES (?, ?, ?, ?, ?, ?)',
-        (filename, size, content_type, k, l, c)
-    )
-
-    file_id = insert_into_file.lastrowid
-
-    cursor = db.execute('SELECT COUNT(*) as count from storage_node where status = 1')
-    storage_nodes_count = cursor.fetchone()['count']
+    # The uploaded file is spooled to a temporary file by werkzeug, and store_file reads it
+    # window by window instead of us reading the whole file into memory
+    file_stream = file.stream
+    file_stream.seek(0, os.SEEK_END)
+    size = file_stream.tell()
+    file_stream.seek(0)
+    c = k + l
 
-    fragment_meta, matrix = store_file(
-        file_data = file_data, 
-        send_task_socket = socket_push, 
-        response_socket = socket_pull, 
-        k = k, 
-        l = l,
-        storage_nodes_count=storage_nodes_count
-    )
+    # A compression codec can be chosen with the compression form field
+    compression = payload.get('compression')
+    stored_size = size
+    if compression:
+        try:
+            file_stream, stored_size, compression = compress_upload(file_stream, size, compression)
+        except ValueError as e:
+            return make_response({'message': str(e)}, 400)
+
+    # How far the storage nodes write the fragments to disk before acknowledging them, with the durability form field
+    try:
+        durability = durability_level(payload.get('durability', 'none'))
+    except ValueError as e:
+        return make_response({'message': str(e)}, 400)
+
+    # Bytes per encoded stripe with the stripe_size form field, 0 encodes the file as one stripe
+    try:
+        stripe_size = stripe_size_for(payload.get('stripe_size', STRIPE_SIZE), k)
+    except ValueError as e:
+        return make_response({'message': str(e)}, 400)
 
+    db = get_db()
     retrieve_active_nodes = db.execute('SELECT id from storage_node where status = 1')
-    storage_nodes = [row['id'] for row in retrieve_active_nodes.fetchall()]
-
-    for name, index in fragment_meta.items():
-        selected_nodes = placement_strategy(strategy, replication_factor, index, storage_nodes)
-        for node in selected_nodes:
-            db.execute(
-                'INSERT INTO file_fragment (file_id, storage_node_id, fragment_name, fragment_index, coefficients) VALUES (?, ?, ?, ?, ?)',
-                (file_id, node, name, index, bytes(matrix[index]))
-            )
-    
+    storage_nodes = [row['id'] for row in retrieve_active_nodes.fetchall() if dispatcher.membership.writable(row['id'])]
+    storage_nodes_count = len(storage_nodes)
+
+    # Fragments the storage nodes may have stored before the upload failed
+    sent = set()
+    try:
+        fragment_meta, fragment_nodes, matrix, fragment_checksums, stripe_checksums = store_file(
+            file_stream = file_stream, 
+            file_size = stored_size,
+            send_task_socket = socket_router, 
+            dispatcher = dispatcher, 
+            k = k, 
+            l = l,
+            storage_nodes_count=storage_nodes_count,
+            select_nodes = lambda index: placement_strategy(strategy, replication_factor, index, storage_nodes),
+            durability = durability,
+            stripe_size = stripe_size,
+            sent = sent
+        )
+    except (zmq.ZMQError, IOError) as e:
+        abandon_fragments(db, sent)
+        db.commit()
+        logging.error(f"Storing fragments failed: {e}")
+        return make_response({'message': f'Storing fragments failed: {e}'}, 503)
+
+    # The file is only inserted once its fragments are stored, in one short transaction with its fragments
+    fragment_rows = [
+        (node, name, index, bytes(matrix[index]), fragment_checksums[name],
+         pack_checksums(stripe_checksums[name]) if stripe_size else None)
+        for name, index in fragment_meta.items()
+        for node in fragment_nodes[name]
+    ]
+    file_id = insert_file(db, (filename, size, content_type, k, l, c, compression, stored_size, stripe_size), fragment_rows)
     db.commit()
 
     end = time.time()
@@ -274,4 +335,7 @@ def server_error(e):
 host_local_computer = "localhost"
 host_local_addr = "0.0.0.0"
 
-app.run(host = host_local_computer, port = 9000) # The base url is http://localhost:9000
\ No newline at end of file
+# Every request is served in its own thread. This is safe because sends on the shared sockets are
+# serialized by LockedSocket, and replies are handed to the right request by the dispatcher. 
+# The controller binds its zmq ports itself, so it must run as a single process, not as several WSGI workers
+app.run(host = host_local_computer, port = 9000, threaded = True) # The base url is http://localhost:9000
\ No newline at end of file
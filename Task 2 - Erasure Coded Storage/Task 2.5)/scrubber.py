@@ -0,0 +1,56 @@
+import threading
+import time
+
+# A storage node re-reads the objects it stores in the background and compares them with the checksums
+# the store recorded when they were written, so bit rot is found before a download needs the object.
+
+# Default number of bytes re-read per second, so scrubbing does not take the disk away from uploads and downloads
+SCRUB_RATE = 16 * 1024 * 1024
+
+# Seconds between the end of a pass over all objects and the start of the next one
+SCRUB_INTERVAL = 600
+
+
+class Scrubber(threading.Thread):
+    """
+        Verifies every object of store with a checksum, paced to rate bytes per second. Every object is
+        verified by the disk workers like a read, so it is never verified halfway through a write.
+        on_corrupt is called with the name of every object that does not match its checksum.
+    """
+    def __init__(self, store, disk_workers, on_corrupt, rate = SCRUB_RATE, interval = SCRUB_INTERVAL):
+        super().__init__(daemon = True)
+        self.store = store
+        self.disk_workers = disk_workers
+        self.on_corrupt = on_corrupt
+        self.rate = rate
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.objects = 0
+        self.bytes = 0
+        self.corrupt = 0
+
+    def run(self):
+        while True:
+            for name, (length, _) in list(self.store.checksums.items()):
+                if name in self.store.checksums:
+                    self.disk_workers.submit(name, 'scrub', self.scrub, name)
+                    time.sleep(length / self.rate)
+            time.sleep(self.interval)
+
+    def scrub(self, name):
+        data = self.store.view(name)
+        if data is None:
+            return
+        valid = self.store.verify(name, data)
+        with self.lock:
+            self.objects += 1
+            self.bytes += len(data)
+            if not valid:
+                self.corrupt += 1
+        del data
+        if not valid:
+            self.on_corrupt(name)
+
+    def stats(self):
+        with self.lock:
+            return {'objects': self.objects, 'bytes': self.bytes, 'corrupt': self.corrupt}
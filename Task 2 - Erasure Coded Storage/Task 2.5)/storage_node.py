@@ -1,41 +1,63 @@
 import messages_pb2
-import random
-import string
 import zmq
 import sys
 import os
+import shutil
+import time
+import threading
+import argparse
+import zlib
+from disk_io import GROUP_COMMIT_DELAY, DiskWorkers, Completion, GroupCommit
+from object_store import STORE_KINDS, SEGMENT_SIZE, MAP_CACHE_SIZE, open_store
+from object_cache import CACHE_SIZE, CachedStore
+from scrubber import SCRUB_RATE, Scrubber
+from reclaimer import Reclaimer
+from membership import HEARTBEAT_INTERVAL
 
-def random_string(length = 8):
-    return ''.join(random.SystemRandom().choice(string.ascii_letters) for _ in range(length))
+parser = argparse.ArgumentParser(description = "Storage node")
+parser.add_argument('data_folder', nargs = '?', default = "./")
+parser.add_argument('node_id', nargs = '?', default = None,
+                    help = "id of the node in the storage_node table (defaults to the digits in the data folder name)")
+parser.add_argument('--window', type = int, default = 8,
+                    help = "number of unacknowledged fragment pieces the controller may send to this node")
+parser.add_argument('--io-workers', type = int, default = 4,
+                    help = "number of threads that write and read fragments")
+parser.add_argument('--stats-interval', type = int, default = 30,
+                    help = "seconds between reports of the queue and service times of disk operations")
+parser.add_argument('--store', choices = STORE_KINDS, default = 'files',
+                    help = "keep every fragment in a file of its own, or append fragments to large segment files")
+parser.add_argument('--segment-size', type = int, default = SEGMENT_SIZE // (1024 * 1024),
+                    help = "size in MB of a segment file when fragments are kept in segments")
+parser.add_argument('--map-cache-size', type = int, default = MAP_CACHE_SIZE // (1024 * 1024),
+                    help = "address space in MB of the memory maps fragments are sent from")
+parser.add_argument('--cache-size', type = int, default = CACHE_SIZE // (1024 * 1024),
+                    help = "MB of recently stored and read fragments kept in memory, 0 disables the cache")
+parser.add_argument('--scrub-rate', type = int, default = SCRUB_RATE // (1024 * 1024),
+                    help = "MB per second of stored fragments re-read in the background to find corrupt ones, 0 disables scrubbing")
+parser.add_argument('--group-commit-delay', type = float, default = GROUP_COMMIT_DELAY * 1000,
+                    help = "milliseconds the first of the fragment pieces stored with group commit waits for others to share its fsync")
+args = parser.parse_args()
+
+data_folder = args.data_folder
+node_id = args.node_id or ''.join(c for c in data_folder if c.isdigit())
+if not node_id:
+    sys.exit("A storage node id is required when the data folder name has no digits")
 
-def write_to_file(data, filename = None):
-    if filename is None: 
-        filename = random_string(8)
-        filename += '.bin'
-    
-    try: 
-        with open('./' + filename, 'wb') as f: 
-            f.write(data)
-    except EnvironmentError as e: 
-        print(f"Error writing to file: {e}", file=sys.stderr)
-        return None
-    
-    return filename
-
-data_folder = sys.argv[1] if len(sys.argv) > 1 else "./"
 if data_folder != "./":
     try: 
         os.mkdir('./' + data_folder)
     except FileExistsError as _:
         pass
 
-print(f"Data folder: {data_folder}")
+print(f"Data folder: {data_folder}, storage node id: {node_id}")
 
 #-----------------ZMQ Setup-----------------#
 context = zmq.Context()
 
-socket_pull = context.socket(zmq.PULL)
-socket_pull.connect("tcp://localhost:5557")
+# The routing id registers this node on the controller's ROUTER socket
+socket_dealer = context.socket(zmq.DEALER)
+socket_dealer.setsockopt(zmq.ROUTING_ID, node_id.encode('utf-8'))
+socket_dealer.connect("tcp://localhost:5557")
 
 socket_push = context.socket(zmq.PUSH)
 socket_push.connect("tcp://localhost:5558")
@@ -44,64 +66,247 @@ socket_sub = context.socket(zmq.SUB)
 socket_sub.connect("tcp://localhost:5559")
 socket_sub.setsockopt(zmq.SUBSCRIBE, b'') 
 
+# Replies of the disk workers are sent on a PUSH socket of each worker thread, since zmq sockets
+# must not be shared between threads. The main thread replies on socket_push
+thread_sockets = threading.local()
+
+def reply_socket():
+    if threading.current_thread() is threading.main_thread():
+        return socket_push
+    if not hasattr(thread_sockets, 'socket_push'):
+        thread_sockets.socket_push = context.socket(zmq.PUSH)
+        thread_sockets.socket_push.connect("tcp://localhost:5558")
+    return thread_sockets.socket_push
+
+disk_workers = DiskWorkers(args.io_workers)
+
+# The store knows which fragments it holds, so status requests are answered without touching the disk.
+# A fragment is known once its first piece is written
+disk_store = open_store(args.store, data_folder, segment_size = args.segment_size * 1024 * 1024,
+                        map_cache_size = args.map_cache_size * 1024 * 1024)
+store = disk_store
+if args.cache_size > 0:
+    store = CachedStore(disk_store, args.cache_size * 1024 * 1024)
+
+# Pieces sent with group commit durability are forced to disk in batches, on a thread of their own
+group_commit = GroupCommit(store.commit, disk_workers.stats, args.group_commit_delay / 1000)
+
+# A fragment that does not match its checksum is deleted, so status requests stop reporting it
+# and the controller fetches a healthy copy or another fragment instead
+def drop_corrupt(filename):
+    print(f"Fragment {filename} does not match its checksum, deleting it", file = sys.stderr)
+    store.delete(filename)
+
+# The scrubber reads the store directly, so it does not fill the cache with fragments nobody asked for
+scrubber = None
+if args.scrub_rate > 0:
+    scrubber = Scrubber(disk_store, disk_workers, drop_corrupt, rate = args.scrub_rate * 1024 * 1024)
+    scrubber.start()
+
+# Fragments of deleted files are deleted in the background, after the reads and writes waiting for the disk
+reclaimer = Reclaimer(store, disk_workers)
+reclaimer.start()
+
 poller = zmq.Poller()
-poller.register(socket_pull, zmq.POLLIN)
+poller.register(socket_dealer, zmq.POLLIN)
 poller.register(socket_sub, zmq.POLLIN)
 
-while True: 
-    socks = dict(poller.poll())
+# Every reply starts with a header carrying the request_id of the controller operation it belongs to.
+# Store acknowledgements also carry our node id and window, which gives the controller its credit back
+def reply_header(request_type, request_id, window = 0):
+    header = messages_pb2.header()
+    header.request_type = request_type
+    header.request_id = request_id
+    if window:
+        header.node_id = node_id
+        header.window = window
+    return header.SerializeToString()
 
-    if socket_pull in socks: 
-        message = socket_pull.recv_multipart()
-        file_msg = messages_pb2.StoreData()
-        file_msg.ParseFromString(message[0])
-        data = message[1]
-        print(f"Chunk to store: {file_msg.filename} with size {len(data)} bytes")
+# Advertise our window, so the controller knows how many fragment pieces it may send before we acknowledge them
+socket_push.send(reply_header(messages_pb2.NODE_READY, 0, window = args.window))
 
-        filename = write_to_file(data, filename = os.path.join(data_folder, file_msg.filename))
-        print(f"Data stored  in data folder: /{file_msg.filename}")
+# Heartbeats tell the controller that we are up, how much disk space is free and how much disk work waits.
+# A heartbeat is dropped instead of queued when the controller has not been reachable for a while
+def send_heartbeat():
+    heartbeat = messages_pb2.Heartbeat(
+        node_id = node_id,
+        free_bytes = shutil.disk_usage(data_folder).free,
+        queue_depth = disk_workers.queue_depth()
+    )
+    try:
+        socket_push.send_multipart([
+            reply_header(messages_pb2.HEARTBEAT, 0),
+            heartbeat.SerializeToString()
+        ], flags = zmq.NOBLOCK)
+    except zmq.Again:
+        pass
 
-        socket_push.send_string(file_msg.filename)
-        continue
+# Fragment status and data requests arrive either routed to this node only (DEALER)
+# or broadcast to every node (SUB) when the controller has no placement metadata
+def handle_fragment_request(header, message):
+    if header.request_type == messages_pb2.FRAGMENT_STATUS_REQ:
+        req = messages_pb2.Fragment_Status_Request()
+        req.ParseFromString(message[1].bytes)
+        check_exists = req.fragment_name in store
 
+        response = messages_pb2.Fragment_Status_Response(
+            fragment_name = req.fragment_name, 
+            is_present = check_exists,
+            node_id = node_id,
+            request_id = header.request_id
+        )
 
-    if socket_sub in socks: 
-        message = socket_sub.recv_multipart()
+        socket_push.send_multipart([
+            reply_header(messages_pb2.FRAGMENT_STATUS_REQ, header.request_id),
+            response.SerializeToString()
+        ])
 
-        header = messages_pb2.header()
-        header.ParseFromString(message[0])
+    elif header.request_type == messages_pb2.FRAGMENT_STATUS_BULK_REQ:
+        req = messages_pb2.Fragment_Status_Bulk_Request()
+        req.ParseFromString(message[1].bytes)
 
-        if header.request_type == messages_pb2.FRAGMENT_STATUS_REQ:
-            req = messages_pb2.Fragment_Status_Request()
-            req.ParseFromString(message[1])
-            fragment_path = os.path.join(data_folder, req.fragment_name)
-            check_exists = os.path.exists(fragment_path)
+        response = messages_pb2.Fragment_Status_Bulk_Response(
+            present = [name for name in req.fragment_names if name in store],
+            node_id = node_id,
+            request_id = header.request_id
+        )
 
-            response = messages_pb2.Fragment_Status_Response(
-                fragment_name = req.fragment_name, 
-                is_present = check_exists,
-                node_id = data_folder
-            )
+        socket_push.send_multipart([
+            reply_header(messages_pb2.FRAGMENT_STATUS_BULK_REQ, header.request_id),
+            response.SerializeToString()
+        ])
 
-            socket_push.send(response.SerializeToString())
-            continue
+    elif header.request_type == messages_pb2.FRAGMENT_DATA_REQ:
+        req = messages_pb2.GetData()
+        req.ParseFromString(message[1].bytes)
+        if req.filename in store:
+            disk_workers.submit(req.filename, 'fetch', send_fragment, req, header.request_id)
+
+    elif header.request_type == messages_pb2.DELETE_REQ:
+        req = messages_pb2.DeleteBatch()
+        req.ParseFromString(message[1].bytes)
+        reclaimer.delete(req.filenames, lambda deleted, request_id = header.request_id: acknowledge_delete(request_id, deleted))
 
-        elif header.request_type == messages_pb2.FRAGMENT_DATA_REQ:
-            req = messages_pb2.GetData()
-            req.ParseFromString(message[1])
-            try: 
-                with open(os.path.join(data_folder, req.filename), "rb") as f:
-                    file_data = f.read()
-                socket_push.send_multipart([
-                    header.SerializeToString(),
-                    req.filename.encode('utf-8'),
-                    file_data
-                ])
-                print(f"Sent data for fragment: {req.filename} with size {len(data)} bytes")
-            except FileNotFoundError as e:
-                pass
+# Reply with the names of the fragments of a DeleteBatch that are gone, on the reclaimer thread
+def acknowledge_delete(request_id, deleted):
+    reply_socket().send_multipart([
+        reply_header(messages_pb2.DELETE_REQ, request_id)
+    ] + [filename.encode('utf-8') for filename in deleted])
+
+# Send a fragment, or the range of it that req asks for, to the controller, on a disk worker thread. The data
+# is sent from the cache, or from a memory map of the file or segment that holds it, and is not copied into
+# a zmq message. A corrupt fragment is answered with its name only, so the controller asks for another one right
+# away. Only whole fragments are verified here: the controller verifies ranges with the checksums of its stripes,
+# and the scrubber finds corrupt fragments that are only ever read in ranges
+def send_fragment(req, request_id):
+    filename = req.filename
+    file_data = store.view(filename)
+    if file_data is None:
+        return
+    if req.HasField('length'):
+        file_data = file_data[req.offset:req.offset + req.length]
+    elif not store.verify(filename, file_data):
+        del file_data
+        drop_corrupt(filename)
+        reply_socket().send_multipart([
+            reply_header(messages_pb2.FRAGMENT_DATA_REQ, request_id),
+            filename.encode('utf-8')
+        ])
+        return
+    reply_socket().send_multipart([
+        reply_header(messages_pb2.FRAGMENT_DATA_REQ, request_id),
+        filename.encode('utf-8'),
+        file_data
+    ], copy = False)
+    print(f"Sent data for fragment: {filename} with size {len(file_data)} bytes")
+
+# Write a fragment piece on a disk worker thread, unless it does not match the checksum it was sent with.
+# A piece counts as stored once it is as durable as its message asks: written (none), forced to disk with
+# an fsync of its own (fsync), or forced to disk together with the pieces written around it (group commit).
+# The names of the pieces that were stored are added to stored
+def store_piece(file_msg, data, completion, stored):
+    try:
+        print(f"Chunk to store: {file_msg.filename} with size {len(data)} bytes at offset {file_msg.offset}")
+        if file_msg.HasField('checksum') and zlib.crc32(data) != file_msg.checksum:
+            print(f"Piece of {file_msg.filename} at offset {file_msg.offset} does not match its checksum, not storing it", file = sys.stderr)
+        elif store.write(file_msg.filename, data, offset = file_msg.offset) is not None:
+            if file_msg.durability == messages_pb2.DURABILITY_GROUP_COMMIT:
+                group_commit.submit(file_msg.filename, lambda committed, completion = completion:
+                                    piece_committed(file_msg.filename, committed, completion, stored))
+                completion = None
+                return
+            if file_msg.durability == messages_pb2.DURABILITY_FSYNC:
+                store.commit([file_msg.filename])
+            print(f"Data stored  in data folder: /{file_msg.filename}")
+            stored.append(file_msg.filename)
+    finally:
+        if completion is not None:
+            completion.finish()
+
+def piece_committed(filename, committed, completion, stored):
+    if committed:
+        print(f"Data stored  in data folder: /{filename}")
+        stored.append(filename)
+    completion.finish()
+
+# One acknowledgement with the names of all pieces in a message that were written, sent once all of them
+# are done. The controller fails the upload if a piece is missing
+def acknowledge(header, stored):
+    reply_socket().send_multipart([
+        reply_header(header.request_type, header.request_id, window = args.window)
+    ] + [filename.encode('utf-8') for filename in stored])
+
+last_report = time.time()
+last_heartbeat = 0
+
+while True: 
+    socks = dict(poller.poll(HEARTBEAT_INTERVAL * 1000))
+
+    if time.time() - last_heartbeat >= HEARTBEAT_INTERVAL:
+        send_heartbeat()
+        last_heartbeat = time.time()
+
+    if time.time() - last_report >= args.stats_interval:
+        for line in disk_workers.stats.report():
+            print(f"Disk I/O {line}")
+        if isinstance(store, CachedStore):
+            print(f"Cache {store.stats()}")
+        if scrubber is not None:
+            print(f"Scrubbed {scrubber.stats()}")
+        print(f"Reclaimed {reclaimer.stats()}")
+        last_report = time.time()
+
+    if socket_dealer in socks: 
+        # Fragment pieces are received without copying, and written from a view of the zmq frame
+        message = socket_dealer.recv_multipart(copy = False)
+        header = messages_pb2.header()
+        header.ParseFromString(message[0].bytes)
+        if header.request_type not in (messages_pb2.STORE_FRAGMENT_DATA_REQ, messages_pb2.STORE_BATCH_REQ):
+            handle_fragment_request(header, message)
             continue
 
+        # A StoreBatch message carries several fragment pieces, followed by the data of each of them
+        if header.request_type == messages_pb2.STORE_FRAGMENT_DATA_REQ:
+            file_msg = messages_pb2.StoreData()
+            file_msg.ParseFromString(message[1].bytes)
+            file_msgs = [file_msg]
         else:
-            pass
+            batch = messages_pb2.StoreBatch()
+            batch.ParseFromString(message[1].bytes)
+            file_msgs = list(batch.fragments)
+
+        # The pieces are written by the disk workers, and the last one to finish acknowledges the message
+        pieces = list(zip(file_msgs, message[2:]))
+        stored = []
+        completion = Completion(len(pieces), lambda header = header, stored = stored: acknowledge(header, stored))
+        for file_msg, frame in pieces:
+            disk_workers.submit(file_msg.filename, 'store', store_piece, file_msg, frame.buffer, completion, stored)
+        continue
 
+
+    if socket_sub in socks: 
+        message = socket_sub.recv_multipart(copy = False)
+
+        header = messages_pb2.header()
+        header.ParseFromString(message[0].bytes)
+        handle_fragment_request(header, message)
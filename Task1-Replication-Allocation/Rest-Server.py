@@ -6,6 +6,9 @@ import zmq
 import time
 import string
 import random
+import queue
+import threading
+from contextlib import contextmanager
 
 # ================= CONFIG =================
 
@@ -51,6 +54,58 @@ zmq_pub_fetch.bind("tcp://*:5559")
 # Allow storage nodes to connect
 time.sleep(1)
 
+# ================= REPLY ROUTER =================
+
+# Flask serves every request in its own thread, but all storage nodes reply on the
+# one PULL socket. The router thread owns that socket and hands every reply to the
+# request waiting for replies about the same filename. Sends on the shared PUSH and
+# PUB sockets are serialized with send_lock.
+
+# Seconds to wait for a storage node to reply
+REPLY_TIMEOUT = 5
+
+send_lock = threading.Lock()
+
+class ReplyRouter:
+    def __init__(self, socket):
+        self.socket = socket
+        self.waiting = {}
+        self.condition = threading.Condition()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    @contextmanager
+    def waiting_for(self, filename):
+        # Only one request waits for replies about a filename at a time
+        with self.condition:
+            self.condition.wait_for(lambda: filename not in self.waiting)
+            replies = self.waiting[filename] = queue.Queue()
+        try:
+            yield replies
+        finally:
+            with self.condition:
+                del self.waiting[filename]
+                self.condition.notify_all()
+
+    def run(self):
+        while True:
+            reply = self.socket.recv_multipart()
+
+            with self.condition:
+                # ACKs are a single "ACK <filename> R.. C.." string, fetch replies start with the filename
+                if len(reply) == 1:
+                    ack = reply[0].decode(errors="ignore")
+                    filename = next((name for name in self.waiting if ack.startswith(f"ACK {name} ")), None)
+                else:
+                    filename = reply[0].decode(errors="ignore")
+                replies = self.waiting.get(filename)
+
+            if replies is None:
+                print(f"REST: discarding reply nobody is waiting for: {reply[0][:64]}")
+                continue
+            replies.put(reply)
+
+reply_router = ReplyRouter(zmq_pull_response)
+
 # ================= HELPERS =================
 
 def random_string(length=8):
@@ -59,41 +114,55 @@ def random_string(length=8):
 NUM_REPLICAS = 4
 NUM_CHUNKS = 4
 
+# First frame of a store message, naming the message that follows it
+STORE_BATCH = b"storeBatch"
+
 def nodeStore(file):
     print("REST: entering nodeStore()")
 
     data = file.read()
     size = len(data)
+    # Chunks are views of the file data, and are sent without copying them into zmq messages
+    view = memoryview(data)
     chunk_size = size // NUM_CHUNKS
 
-    for replica_id in range(NUM_REPLICAS):
-        print(f"REST: processing replica {replica_id}")
-
+    with reply_router.waiting_for(file.filename) as replies:
+        # All replicas of a chunk go in one storeBatch message with a single ACK,
+        # instead of one message and ACK per chunk replica. The PUSH socket hands the
+        # messages to the storage nodes in turn, so node i gets every replica of chunk i,
+        # the same placement as when every replica was sent on its own
         for chunk_id in range(NUM_CHUNKS):
             start = chunk_id * chunk_size
             end = size if chunk_id == NUM_CHUNKS - 1 else (chunk_id + 1) * chunk_size
-            chunk = data[start:end]
-
-            msg = messages_pb2.storeData()
-            msg.filename = file.filename
-            msg.replica_id = replica_id
-            msg.chunk_id = chunk_id
-            msg.total_chunks = NUM_CHUNKS
-
-            zmq_push_store.send_multipart([
-                msg.SerializeToString(),
-                chunk
-            ])
+            chunk = view[start:end]
+
+            batch = messages_pb2.storeBatch()
+            for replica_id in range(NUM_REPLICAS):
+                msg = batch.chunks.add()
+                msg.filename = file.filename
+                msg.replica_id = replica_id
+                msg.chunk_id = chunk_id
+                msg.total_chunks = NUM_CHUNKS
+
+            with send_lock:
+                zmq_push_store.send_multipart([
+                    STORE_BATCH,
+                    batch.SerializeToString()
+                ] + [chunk] * NUM_REPLICAS, copy=False)
 
             print(
-                f"REST: sent R{replica_id}C{chunk_id} "
-                f"({len(chunk)} bytes) to node {chunk_id}"
+                f"REST: sent C{chunk_id} "
+                f"({NUM_REPLICAS} replicas, {len(chunk)} bytes) to node {chunk_id}"
             )
 
-    # Wait for ACKs (16 total)
-    for i in range(NUM_REPLICAS * NUM_CHUNKS):
-        ack = zmq_pull_response.recv_string()
-        print(f"REST: ACK {i+1}: {ack}")
+        # Wait for ACKs (one per chunk)
+        for i in range(NUM_CHUNKS):
+            try:
+                ack = replies.get(timeout=REPLY_TIMEOUT)[0].decode()
+            except queue.Empty:
+                print(f"REST: timed out waiting for ACK {i+1}")
+                return False
+            print(f"REST: ACK {i+1}: {ack}")
 
     return True
 
@@ -102,9 +171,14 @@ def nodeFetchFile(filename):
     msg = messages_pb2.getData()
     msg.filename = filename
 
-    zmq_pub_fetch.send(msg.SerializeToString())
+    with reply_router.waiting_for(filename) as replies:
+        with send_lock:
+            zmq_pub_fetch.send(msg.SerializeToString())
 
-    result = zmq_pull_response.recv_multipart()
+        try:
+            result = replies.get(timeout=REPLY_TIMEOUT)
+        except queue.Empty:
+            return None
 
     returned_filename = result[0].decode()
     data = result[1]
@@ -162,5 +236,6 @@ if __name__ == "__main__":
         host="127.0.0.1",
         port=5000,
         debug=True,
-        use_reloader=False
+        use_reloader=False,
+        threaded=True
     )
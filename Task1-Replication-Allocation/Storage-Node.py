@@ -15,6 +15,10 @@ def write_to_file(content, filepath):
     with open(filepath, 'wb') as f:
         f.write(content)
 
+# First frame of a store message, naming the message that follows it
+STORE_DATA = b"storeData"
+STORE_BATCH = b"storeBatch"
+
 # ------------------ setup ------------------
 
 data_folder = sys.argv[1] if len(sys.argv) > 1 else "data"
@@ -52,41 +56,60 @@ while True:
 
     # ---------- STORE ----------
     if zmq_pull_socket in socks and socks[zmq_pull_socket] == zmq.POLLIN:
-        message = zmq_pull_socket.recv_multipart()
+        # Received without copying; the chunk is written from a view of the zmq frame
+        message = zmq_pull_socket.recv_multipart(copy=False)
 
-        if len(message) != 2:
+        if len(message) < 3:
             print("Invalid STORE message received")
             continue
 
-        task = messages_pb2.storeData()
-        task.ParseFromString(message[0])
-        data = message[1]
+        # The message type, then a storeData message with one chunk, or a
+        # storeBatch message with any number of chunks, followed by one frame per chunk
+        message_type = message[0].bytes
+        if message_type == STORE_DATA:
+            task = messages_pb2.storeData()
+            task.ParseFromString(message[1].bytes)
+            tasks = [task]
+        elif message_type == STORE_BATCH:
+            batch = messages_pb2.storeBatch()
+            batch.ParseFromString(message[1].bytes)
+            tasks = list(batch.chunks)
+        else:
+            print(f"Unknown STORE message type: {message_type[:32]}")
+            continue
 
-        # Build unique chunk filename
-        chunk_filename = (
-            f"{task.filename}_R{task.replica_id}_C{task.chunk_id}.bin"
-        )
+        if not tasks or len(tasks) != len(message) - 2:
+            print("Invalid STORE message received")
+            continue
 
-        filepath = os.path.join(data_folder, chunk_filename)
+        for task, frame in zip(tasks, message[2:]):
+            data = frame.buffer
 
-        print(
-            f"Store request: {task.filename} | "
-            f"Replica {task.replica_id}, Chunk {task.chunk_id} "
-            f"({len(data)} bytes)"
-        )
+            # Build unique chunk filename
+            chunk_filename = (
+                f"{task.filename}_R{task.replica_id}_C{task.chunk_id}.bin"
+            )
+
+            filepath = os.path.join(data_folder, chunk_filename)
+
+            print(
+                f"Store request: {task.filename} | "
+                f"Replica {task.replica_id}, Chunk {task.chunk_id} "
+                f"({len(data)} bytes)"
+            )
 
-        write_to_file(data, filepath)
+            write_to_file(data, filepath)
 
-        print(f"Stored at: {filepath}")
+            print(f"Stored at: {filepath}")
 
-        # ACK includes replica + chunk info
+        # One ACK for the whole message, listing replica + chunk info of every chunk
+        stored = ", ".join(f"R{task.replica_id} C{task.chunk_id}" for task in tasks)
         zmq_push_socket.send_string(
-            f"ACK {task.filename} R{task.replica_id} C{task.chunk_id}"
+            f"ACK {tasks[0].filename} {stored}"
         )
 
         print(
-            f"ACK sent: {task.filename} "
-            f"R{task.replica_id} C{task.chunk_id}"
+            f"ACK sent: {tasks[0].filename} {stored}"
         )
 
     # ---------- GET ----------
@@ -106,7 +129,7 @@ while True:
             zmq_push_socket.send_multipart([
                 task.filename.encode(),
                 data
-            ])
+            ], copy=False)
 
             print(f"Fetch sent: {task.filename} ({len(data)} bytes)")
 
@@ -33,6 +33,7 @@ def store_file():
     # replicate to all nodes (4)
     for _ in range(4):
         store_socket.send_multipart([
+            b"storeData",
             task.SerializeToString(),
             data
         ])
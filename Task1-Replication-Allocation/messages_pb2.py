@@ -24,7 +24,7 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0emessages.proto\"Y\n\tstoreData\x12\x10\n\x08\x66ilename\x18\x01 \x01(\t\x12\x12\n\nreplica_id\x18\x02 \x01(\x05\x12\x10\n\x08\x63hunk_id\x18\x03 \x01(\x05\x12\x14\n\x0ctotal_chunks\x18\x04 \x01(\x05\"\x1b\n\x07getData\x12\x10\n\x08\x66ilename\x18\x01 \x01(\tb\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0emessages.proto\"Y\n\tstoreData\x12\x10\n\x08\x66ilename\x18\x01 \x01(\t\x12\x12\n\nreplica_id\x18\x02 \x01(\x05\x12\x10\n\x08\x63hunk_id\x18\x03 \x01(\x05\x12\x14\n\x0ctotal_chunks\x18\x04 \x01(\x05\"(\n\nstoreBatch\x12\x1a\n\x06\x63hunks\x18\x01 \x03(\x0b\x32\n.storeData\"\x1b\n\x07getData\x12\x10\n\x08\x66ilename\x18\x01 \x01(\tb\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
@@ -33,6 +33,8 @@ if not _descriptor._USE_C_DESCRIPTORS:
   DESCRIPTOR._loaded_options = None
   _globals['_STOREDATA']._serialized_start=18
   _globals['_STOREDATA']._serialized_end=107
-  _globals['_GETDATA']._serialized_start=109
-  _globals['_GETDATA']._serialized_end=136
+  _globals['_STOREBATCH']._serialized_start=109
+  _globals['_STOREBATCH']._serialized_end=149
+  _globals['_GETDATA']._serialized_start=151
+  _globals['_GETDATA']._serialized_end=178
 # @@protoc_insertion_point(module_scope)